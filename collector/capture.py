@@ -1,49 +1,467 @@
-from pathlib import Path
-from urllib.parse import urlparse
-from datetime import datetime, timezone
-from playwright.sync_api import sync_playwright
+"""
+SCRACHER v3 — Capture
+Servicio de capturas de pantalla sobre la API asíncrona de Playwright.
+Un hilo propio ejecuta un event loop con CAPTURE_BROWSERS navegadores
+persistentes; cada uno atiende hasta CAPTURE_CONTEXTS capturas a la vez, cada
+una en un contexto nuevo y aislado (cookies, caché, storage) que se cierra al
+terminar. Las peticiones llegan por una cola (submit() devuelve un Future), así
+que las capturas avanzan a su propio ritmo, fuera del camino fetch → análisis
+de scrape_one().
+Un navegador se recicla tras CAPTURE_RECYCLE_PAGES páginas (cuando terminan
+las que tiene abiertas), si se cae (la captura se reintenta una vez en uno
+nuevo) o tras CAPTURE_IDLE_S sin trabajo. El servicio es único por proceso:
+CLI, dashboard, scheduler y workers lo comparten.
+Con CAPTURE_FROM_HTML el documento principal no se vuelve a pedir por Tor: se
+sirve interceptando la petición con el HTML que ya descargó fetch().
+Las capturas salen como PNG en memoria; codificarlas y guardarlas en disco
+(collector.shotstore) queda fuera del event loop, en el hilo que las recoge.
+"""
 
-ROOT = Path(__file__).resolve().parents[1]
-SHOT_DIR = ROOT / "dashboard" / "static" / "screenshots"
+import os
+import atexit
+import asyncio
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from concurrent.futures import Future
+from playwright.async_api import async_playwright
 
 TOR_PROXY = "socks5://127.0.0.1:9050"  # Playwright usa socks5 (no socks5h aquí)
 
-def _safe_name(s: str) -> str:
-    return "".join(ch if ch.isalnum() or ch in ("-", "_", ".") else "_" for ch in s)
+CAPTURE_BROWSERS      = int(os.getenv("CAPTURE_BROWSERS", os.getenv("SCAN_SHOT_LIMIT", "2")))
+CAPTURE_CONTEXTS      = int(os.getenv("CAPTURE_CONTEXTS", "4"))         # capturas a la vez por navegador
+CAPTURE_QUEUE         = int(os.getenv("CAPTURE_QUEUE", "500"))          # pendientes antes de rechazar
+CAPTURE_RECYCLE_PAGES = int(os.getenv("CAPTURE_RECYCLE_PAGES", "100"))  # 0 = no reciclar
+CAPTURE_IDLE_S        = float(os.getenv("CAPTURE_IDLE_S", "300"))       # 0 = no cerrar en reposo
+# Documento principal servido desde el HTML que ya bajó fetch(); solo los recursos van por Tor
+CAPTURE_FROM_HTML     = os.getenv("CAPTURE_FROM_HTML", "true").lower() == "true"
+
+def _csv(v: str) -> set[str]:
+    return {t.strip().lower() for t in v.split(",") if t.strip()}
+
+def _caps(v: str) -> dict[str, int]:
+    """'image:60,script:20' → {'image': 60, 'script': 20}"""
+    out = {}
+    for part in _csv(v):
+        rt, _, n = part.partition(":")
+        if n.isdigit():
+            out[rt] = int(n)
+    return out
+
+# Enrutado de recursos (tipos de Playwright: image, media, font, script, stylesheet, xhr…)
+CAPTURE_BLOCK             = _csv(os.getenv("CAPTURE_BLOCK", "media,font,websocket,eventsource,manifest,texttrack"))
+CAPTURE_CAPS              = _caps(os.getenv("CAPTURE_CAPS", "image:60,stylesheet:20,script:20"))
+CAPTURE_BLOCK_THIRD_PARTY = _csv(os.getenv("CAPTURE_BLOCK_THIRD_PARTY", "script,xhr,fetch"))
+CAPTURE_MAX_BYTES         = int(os.getenv("CAPTURE_MAX_BYTES", str(4 * 1024 * 1024)))  # por captura, 0 = sin límite
+# Espera tras domcontentloaded: hasta CAPTURE_QUIET_MS sin peticiones en vuelo, como mucho CAPTURE_MAX_WAIT_MS
+CAPTURE_QUIET_MS          = int(os.getenv("CAPTURE_QUIET_MS", "500"))
+CAPTURE_MAX_WAIT_MS       = int(os.getenv("CAPTURE_MAX_WAIT_MS", "8000"))
+
+_service      = None
+_service_lock = threading.Lock()
+
+
+def _host(url: str) -> str:
+    return (urlparse(url).hostname or "").lower()
+
+
+class _Network:
+    """
+    Enrutado de peticiones de una página:
+      - la primera petición de documento a `url` se responde con `html` (CAPTURE_FROM_HTML)
+      - tipos de recurso en CAPTURE_BLOCK se abortan; los de CAPTURE_CAPS, a partir del tope
+      - los de CAPTURE_BLOCK_THIRD_PARTY se abortan si van a otro host
+      - superado CAPTURE_MAX_BYTES, se aborta todo lo que quede
+    Además cuenta peticiones en vuelo para quiet(), que sustituye a la espera fija.
+    """
+
+    def __init__(self, url: str, html: str | None = None):
+        self.url      = url.split("#", 1)[0]
+        self.host     = _host(url)
+        self.html     = html
+        self.inflight = 0
+        self.changed  = monotonic()
+        self.counts   = {}
+        self.bytes    = 0
+        self.blocked  = 0
+        self.over_budget = False
+        self._sizes   = set()
+
+    async def attach(self, page):
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_finished)
+        page.on("requestfailed", self._on_failed)
+        await page.route("**/*", self._route)
+
+    def _on_request(self, request):
+        self.inflight += 1
+        self.changed   = monotonic()
 
-def take_screenshot(url: str, timeout_ms: int = 90000) -> tuple[str, int | None, int | None]:
-    SHOT_DIR.mkdir(parents=True, exist_ok=True)
+    def _on_failed(self, request):
+        self.inflight -= 1
+        self.changed   = monotonic()
 
-    parsed = urlparse(url)
-    domain = parsed.netloc or "site"
-    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-    fname = f"{_safe_name(domain)}_{stamp}.png"
+    def _on_finished(self, request):
+        self.inflight -= 1
+        self.changed   = monotonic()
+        t = asyncio.ensure_future(self._add_size(request))
+        self._sizes.add(t)
+        t.add_done_callback(self._sizes.discard)
 
-    abs_path = SHOT_DIR / fname
-    rel_path = f"screenshots/{fname}"
+    async def _add_size(self, request):
+        try:
+            sz = await request.sizes()
+            self.bytes += sz.get("responseBodySize", 0) + sz.get("responseHeadersSize", 0)
+        except Exception:
+            pass
 
-    width = height = None
+    def _reason(self, req) -> str | None:
+        rt = req.resource_type
+        if rt in CAPTURE_BLOCK:
+            return "type"
+        if rt in CAPTURE_BLOCK_THIRD_PARTY and _host(req.url) != self.host:
+            return "third_party"
+        if rt in CAPTURE_CAPS:
+            self.counts[rt] = self.counts.get(rt, 0) + 1
+            if self.counts[rt] > CAPTURE_CAPS[rt]:
+                return "cap"
+        if CAPTURE_MAX_BYTES and self.bytes >= CAPTURE_MAX_BYTES:
+            self.over_budget = True
+            return "budget"
+        return None
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True,
-            proxy={"server": TOR_PROXY},
-            args=[
-                "--disable-dev-shm-usage",
-                "--no-sandbox",
-            ],
-        )
-        context = browser.new_context(ignore_https_errors=True, viewport={"width": 1365, "height": 768})
-        page = context.new_page()
+    async def _route(self, route):
+        req = route.request
+        if (self.html is not None and req.resource_type == "document"
+                and req.url.split("#", 1)[0] == self.url):
+            html, self.html = self.html, None
+            await route.fulfill(status=200, body=html, content_type="text/html; charset=utf-8")
+        elif self._reason(req):
+            self.blocked += 1
+            await route.abort("blockedbyclient")
+        else:
+            await route.continue_()
 
-        page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
-        page.wait_for_timeout(2500)  # onion = lento
+    async def quiet(self, quiet_ms: int = None, max_ms: int = None) -> bool:
+        """
+        Espera a que no quede nada en vuelo durante quiet_ms (como mucho max_ms).
+        False si se agotó max_ms con peticiones aún abiertas.
+        """
+        quiet_s = (CAPTURE_QUIET_MS if quiet_ms is None else quiet_ms) / 1000
+        end     = monotonic() + (CAPTURE_MAX_WAIT_MS if max_ms is None else max_ms) / 1000
+        while monotonic() < end:
+            if self.inflight <= 0 and monotonic() - self.changed >= quiet_s:
+                return True
+            await asyncio.sleep(0.05)
+        return False
 
-        page.screenshot(path=str(abs_path), full_page=True)
+async def _shoot(browser, url: str, timeout_ms: int, html: str | None = None,
+                 stats: dict | None = None) -> tuple[bytes, int | None, int | None]:
+    """
+    Una captura en un contexto nuevo de `browser`. Con `html` (el cuerpo que
+    devolvió fetch para `url`) el documento no se vuelve a descargar: la
+    captura corresponde exactamente al contenido analizado. En `stats` deja
+    bytes, bloqueadas, si se alcanzó el presupuesto y la espera en ms.
+    """
+    net = _Network(url, html)
+    context = await browser.new_context(ignore_https_errors=True,
+                                        viewport={"width": 1365, "height": 768})
+    try:
+        page = await context.new_page()
+        await net.attach(page)
+
+        await page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
+        t0 = monotonic()
+        quiet = await net.quiet()   # onion = lento, pero sin esperar de más
+
+        png = await page.screenshot(full_page=True)
         width = page.viewport_size["width"]
         height = page.viewport_size["height"]
+    finally:
+        await context.close()
+
+    if stats is not None:
+        stats.update(bytes=net.bytes, blocked=net.blocked, over_budget=net.over_budget,
+                     quiet=quiet, wait_ms=int((monotonic() - t0) * 1000))
+    return png, width, height
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  SERVICIO
+# ─────────────────────────────────────────────────────────────────────────────
+
+class _Browser:
+    """Un Chromium lanzado y sus contadores."""
+    __slots__ = ("browser", "pages", "active", "retired", "last_used")
+
+    def __init__(self, browser):
+        self.browser   = browser
+        self.pages     = 0
+        self.active    = 0
+        self.retired   = False
+        self.last_used = monotonic()
+
+
+class _Slot:
+    """Hueco de navegador: el actual y un lock para no lanzar dos a la vez."""
+
+    def __init__(self):
+        self.current = None
+        self.lock    = asyncio.Lock()
+
+
+class CaptureService:
+    """
+    `browsers` navegadores × `contexts` capturas concurrentes, alimentados por
+    una cola. submit() es thread-safe; todo lo de Playwright ocurre en el hilo
+    del servicio.
+    """
+
+    def __init__(self, browsers: int = CAPTURE_BROWSERS, contexts: int = CAPTURE_CONTEXTS,
+                 recycle_pages: int = CAPTURE_RECYCLE_PAGES, idle_s: float = CAPTURE_IDLE_S,
+                 max_pending: int = CAPTURE_QUEUE):
+        self.browsers      = max(1, browsers)
+        self.contexts      = max(1, contexts)
+        self.recycle_pages = recycle_pages
+        self.idle_s        = idle_s
+        self.max_pending   = max_pending
+        self._lock    = threading.Lock()
+        self._ready   = threading.Event()
+        self._pending = 0
+        self._m = {"submitted": 0, "pages": 0, "errors": 0, "rejected": 0, "from_html": 0,
+                   "launches": 0, "recycled": 0, "crashes": 0, "idle_closed": 0,
+                   "bytes": 0, "blocked": 0, "over_budget": 0, "quiet_timeouts": 0, "wait_ms": 0}
+        self._loop = self._q = self._closing = self._pw = None
+        self._slots = []
+        self._thread = threading.Thread(target=self._run, name="scracher-capture", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._m[key] += n
+
+    # ── API (cualquier hilo) ─────────────────────────────────────────────────
+
+    def submit(self, url: str, timeout_ms: int = 90000, html: str | None = None) -> Future:
+        """
+        Encola una captura; el Future resuelve a (png, width, height).
+        html: cuerpo ya descargado de `url` (ver CAPTURE_FROM_HTML).
+        """
+        if not CAPTURE_FROM_HTML:
+            html = None
+        fut = Future()
+        with self._lock:
+            if self.max_pending and self._pending >= self.max_pending:
+                self._m["rejected"] += 1
+                fut.set_exception(RuntimeError("cola de capturas llena"))
+                return fut
+            self._pending += 1
+            self._m["submitted"] += 1
+        self._loop.call_soon_threadsafe(self._q.put_nowait, (fut, url, timeout_ms, html))
+        return fut
+
+    def capture(self, url: str, timeout_ms: int = 90000,
+                html: str | None = None) -> tuple[bytes, int | None, int | None]:
+        return self.submit(url, timeout_ms, html).result()
+
+    def drain(self, timeout: float | None = None) -> bool:
+        """Espera a que se vacíe la cola. False si vence el timeout antes."""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._pending == 0:
+                    return True
+            if deadline is not None and monotonic() > deadline:
+                return False
+            sleep(0.2)
+
+    def shutdown(self, timeout: float = 30):
+        if self._loop is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._closing.set)
+        self._thread.join(timeout=timeout)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            m = dict(self._m)
+            m["pending"] = self._pending
+        active  = sum(s.current.active for s in self._slots if s.current)
+        m.update(browsers=self.browsers, contexts=self.contexts,
+                 recycle_pages=self.recycle_pages, idle_s=self.idle_s,
+                 max_pending=self.max_pending, active=active,
+                 queued=max(0, m["pending"] - active),
+                 running_browsers=sum(1 for s in self._slots if s.current),
+                 avg_bytes=m["bytes"] // m["pages"] if m["pages"] else 0,
+                 avg_wait_ms=m["wait_ms"] // m["pages"] if m["pages"] else 0)
+        return m
+
+    # ── event loop (hilo del servicio) ───────────────────────────────────────
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop    = asyncio.get_running_loop()
+        self._q       = asyncio.Queue()
+        self._closing = asyncio.Event()
+        self._slots   = [_Slot() for _ in range(self.browsers)]
+        self._ready.set()
+        tasks = [asyncio.create_task(self._worker(self._slots[i % self.browsers]))
+                 for i in range(self.browsers * self.contexts)]
+        tasks.append(asyncio.create_task(self._reaper()))
+        await self._closing.wait()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not self._q.empty():
+            fut = self._q.get_nowait()[0]
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(RuntimeError("servicio de capturas detenido"))
+            with self._lock:
+                self._pending -= 1
+        for s in self._slots:
+            if s.current is not None:
+                await self._close(s.current)
+                s.current = None
+        if self._pw is not None:
+            try:
+                await self._pw.stop()
+            except Exception:
+                pass
+
+    async def _worker(self, slot: _Slot):
+        while True:
+            fut, url, timeout_ms, html = await self._q.get()
+            try:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    fut.set_result(await self._capture(slot, url, timeout_ms, html))
+                    self._count("pages")
+                    if html is not None:
+                        self._count("from_html")
+                except asyncio.CancelledError:
+                    fut.set_exception(RuntimeError("servicio de capturas detenido"))
+                    raise
+                except Exception as e:
+                    fut.set_exception(e)
+                    self._count("errors")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+    async def _capture(self, slot: _Slot, url: str, timeout_ms: int, html: str | None = None):
+        for attempt in (1, 2):
+            b = await self._acquire(slot)
+            try:
+                st  = {}
+                res = await _shoot(b.browser, url, timeout_ms, html, st)
+                with self._lock:
+                    for k in ("bytes", "blocked", "wait_ms"):
+                        self._m[k] += st[k]
+                    self._m["over_budget"]    += st["over_budget"]
+                    self._m["quiet_timeouts"] += not st["quiet"]
+                return res
+            except Exception:
+                # Navegador caído a mitad de captura: uno nuevo y un reintento
+                if b.browser.is_connected() or attempt == 2:
+                    raise
+            finally:
+                await self._release(slot, b)
+
+    async def _acquire(self, slot: _Slot) -> _Browser:
+        async with slot.lock:
+            cur = slot.current
+            if cur is not None and not cur.browser.is_connected():
+                self._count("crashes")
+                cur.retired, slot.current = True, None
+            if slot.current is None:
+                if self._pw is None:
+                    self._pw = await async_playwright().start()
+                browser = await self._pw.chromium.launch(
+                    headless=True,
+                    proxy={"server": TOR_PROXY},
+                    args=[
+                        "--disable-dev-shm-usage",
+                        "--no-sandbox",
+                    ],
+                )
+                slot.current = _Browser(browser)
+                self._count("launches")
+            cur = slot.current
+            cur.active   += 1
+            cur.last_used = monotonic()
+            return cur
+
+    async def _release(self, slot: _Slot, b: _Browser):
+        b.active -= 1
+        b.pages  += 1
+        b.last_used = monotonic()
+        if not b.retired and self.recycle_pages and b.pages >= self.recycle_pages:
+            b.retired = True
+            self._count("recycled")
+        if b.retired and slot.current is b:
+            slot.current = None
+        if b.retired and b.active == 0:
+            await self._close(b)
+
+    async def _close(self, b: _Browser):
+        try:
+            await b.browser.close()
+        except Exception:
+            pass
+
+    async def _reaper(self):
+        """Cierra navegadores sin capturas en curso tras idle_s de reposo."""
+        if not self.idle_s:
+            return
+        while True:
+            await asyncio.sleep(min(self.idle_s, 30))
+            for s in self._slots:
+                async with s.lock:
+                    cur = s.current
+                    if cur and cur.active == 0 and monotonic() - cur.last_used > self.idle_s:
+                        s.current = None
+                        await self._close(cur)
+                        self._count("idle_closed")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_capture_service() -> CaptureService:
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = CaptureService()
+        return _service
+
+def stop_capture_service(drain_s: float = 0, timeout: float = 30):
+    """Para el servicio; con drain_s espera antes a que terminen las capturas pendientes."""
+    global _service
+    with _service_lock:
+        if _service is not None:
+            if drain_s:
+                _service.drain(drain_s)
+            _service.shutdown(timeout)
+            _service = None
+
+def capture_status() -> dict:
+    from collector.shotstore import shotstore_status
+    s  = _service
+    st = s.metrics() if s is not None else {"browsers": CAPTURE_BROWSERS,
+                                            "contexts": CAPTURE_CONTEXTS, "pending": 0}
+    st["store"] = shotstore_status()
+    return st
+
+atexit.register(stop_capture_service, 0, 5)
+
 
-        context.close()
-        browser.close()
+def submit_capture(url: str, timeout_ms: int = 90000, html: str | None = None) -> Future:
+    return get_capture_service().submit(url, timeout_ms, html)
 
-    return rel_path, width, height
+def take_screenshot(url: str, timeout_ms: int = 90000,
+                    html: str | None = None) -> tuple[str, int | None, int | None]:
+    """Captura y guarda en el almacén (sin descartar duplicados): (rel_path, w, h)."""
+    from collector.shotstore import store_screenshot
+    png, w, h = get_capture_service().capture(url, timeout_ms, html)
+    return store_screenshot(png)["path"], w, h
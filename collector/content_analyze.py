@@ -5,6 +5,7 @@ Categorías: drugs, weapons, fraud, exploitation, cybercrime, counterfeit, viole
 """
 
 import re
+import html as _html
 from collections import Counter
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -217,3 +218,15 @@ def detect_language(html: str) -> str | None:
     if not scores:
         return None
     return scores.most_common(1)[0][0]
+
+
+_SCRIPT_RE = re.compile(r"<(script|style|noscript|template)\b.*?</\1\s*>", re.I | re.S)
+_TAG_RE    = re.compile(r"<[^>]+>")
+_WS_RE     = re.compile(r"\s+")
+
+def extract_text(html: str, max_chars: int = 20000) -> str:
+    """Texto visible aproximado (sin scripts/estilos ni etiquetas) para el índice de búsqueda."""
+    text = _SCRIPT_RE.sub(" ", html)
+    text = _TAG_RE.sub(" ", text)
+    text = _html.unescape(text)
+    return _WS_RE.sub(" ", text).strip()[:max_chars]
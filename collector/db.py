@@ -3,169 +3,1291 @@ SCRACHER v3 — Database layer
 Schema v3: añade wallets, threat_intel, alert_log, rescan_log.
 """
 
+import os
+import random
 import sqlite3
+import threading
+import weakref
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 ROOT    = Path(__file__).resolve().parents[1]
 DB_PATH = ROOT / "data" / "scrs.db"
 
+# PRAGMAs por conexión (ajustables desde .env)
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")   # WAL + NORMAL = sin fsync por commit
+SQLITE_CACHE_KB    = int(os.getenv("SQLITE_CACHE_KB", "65536"))  # 64 MB de page cache
+SQLITE_MMAP_MB     = int(os.getenv("SQLITE_MMAP_MB", "256"))
+SQLITE_BUSY_MS     = int(os.getenv("SQLITE_BUSY_MS", "10000"))
+
+# Tablas de escritura intensiva en ficheros propios (ATTACH), cada uno con su
+# writer: alert_log/rescan_log → scrs_logs.db, links → scrs_frontier.db
+SQLITE_SPLIT_HOT = os.getenv("SQLITE_SPLIT_HOT", "false").lower() == "true"
+HOT_TABLES = {
+    "logs":     ("alert_log", "rescan_log"),
+    "frontier": ("discovered_links", "discovered_hosts", "link_sources"),
+}
+
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat(timespec="seconds")
 
-def connect() -> sqlite3.Connection:
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+# ─────────────────────────────────────────────────────────────────────────────
+#  CONNECTION POOL — una conexión persistente por hilo
+# ─────────────────────────────────────────────────────────────────────────────
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Conexión reutilizada por hilo.
+    close() no cierra: deshace cualquier transacción abierta y la deja en el pool,
+    así el código existente que hace conn.close() sigue siendo correcto.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+_local      = threading.local()
+_pool       = weakref.WeakSet()
+_pool_lock  = threading.Lock()
+_generation = 0   # se incrementa en close_all_connections() para invalidar cachés
+
+def hot_path(alias: str, base: Path | None = None) -> Path:
+    base = base or DB_PATH
+    return base.with_name(f"{base.stem}_{alias}{base.suffix}")
+
+def split_aliases(base: Path | None = None) -> list[str]:
+    """
+    Ficheros separados en uso. Un fichero ya creado se adjunta siempre, aunque
+    luego se quite SQLITE_SPLIT_HOT: sus tablas ya no están en scrs.db.
+    """
+    return [a for a in HOT_TABLES if SQLITE_SPLIT_HOT or hot_path(a, base).exists()]
+
+def table_schema(table: str) -> str:
+    """Esquema ("main", "logs", "frontier") donde vive `table`."""
+    for alias, tables in HOT_TABLES.items():
+        if table in tables:
+            return alias if alias in split_aliases() else "main"
+    return "main"
+
+def _open(path: Path, attach: bool = True) -> PooledConnection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # check_same_thread=False solo para poder cerrarla desde close_all_connections();
+    # cada conexión se usa exclusivamente desde el hilo que la abrió.
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_MS / 1000,
+                           factory=PooledConnection, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Los nombres sin esquema se resuelven main → adjuntas: las consultas de
+    # lectura (dashboard, export) no cambian con las tablas en otro fichero.
+    for alias in (split_aliases(path) if attach else []):
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (str(hot_path(alias, path)),))
+        conn.execute(f"PRAGMA {alias}.journal_mode=WAL")
+        conn.execute(f"PRAGMA {alias}.synchronous={SQLITE_SYNCHRONOUS}")
+    with _pool_lock:
+        _pool.add(conn)
     return conn
 
-def init_db():
+def connect() -> sqlite3.Connection:
+    """Devuelve la conexión del hilo actual (la abre la primera vez)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH or _local.gen != _generation:
+        if conn is not None:
+            conn.really_close()
+        conn = _open(DB_PATH)
+        _local.conn, _local.path, _local.gen = conn, DB_PATH, _generation
+    return conn
+
+def connect_file(alias: str = "main") -> sqlite3.Connection:
+    """
+    Conexión del hilo a UN solo fichero, sin ATTACH; la usan los escritores.
+    BEGIN IMMEDIATE toma el lock de todas las DBs adjuntas, así que escribir
+    por connect() volvería a serializar scrs.db con los ficheros separados.
+    Sin ficheros separados es la misma conexión que connect().
+    """
+    aliases = split_aliases()
+    if not aliases:
+        return connect()
+    if alias not in aliases:
+        alias = "main"
+    path  = DB_PATH if alias == "main" else hot_path(alias)
+    files = getattr(_local, "files", None)
+    if files is None:
+        files = _local.files = {}
+    conn, opened, gen = files.get(alias, (None, None, None))
+    if conn is None or opened != path or gen != _generation:
+        if conn is not None:
+            conn.really_close()
+        conn = _open(path, attach=False)
+        files[alias] = (conn, path, _generation)
+    return conn
+
+def connect_table(table: str) -> sqlite3.Connection:
+    """connect_file() del fichero que guarda `table`."""
+    return connect_file(table_schema(table))
+
+def close_thread_connection():
+    """Cierra de verdad las conexiones del hilo actual (fin de un worker)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.really_close()
+        _local.conn = None
+    for conn, _, _ in (getattr(_local, "files", None) or {}).values():
+        conn.really_close()
+    _local.files = {}
+
+def close_all_connections():
+    """Cierra todas las conexiones del pool (apagado del proceso)."""
+    global _generation, _fts_ready
+    _fts_ready = False      # la próxima DB (otro DB_PATH) puede no tener FTS5
+    with _pool_lock:
+        _generation += 1
+        conns = list(_pool)
+        _pool.clear()
+    for conn in conns:
+        try:
+            conn.really_close()
+        except Exception:
+            pass
+    _local.conn  = None
+    _local.files = {}
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  MATERIALIZED STATS — contadores mantenidos por triggers (get_stats = O(1))
+# ─────────────────────────────────────────────────────────────────────────────
+
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stat_counters (
+  name  TEXT PRIMARY KEY NOT NULL,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS stat_groups (
+  kind TEXT NOT NULL,
+  key  TEXT NOT NULL,
+  c    INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(kind, key)
+);
+
+-- refcount por dirección para COUNT(DISTINCT address) por moneda
+CREATE TABLE IF NOT EXISTS stat_wallet_refs (
+  coin    TEXT NOT NULL,
+  address TEXT NOT NULL,
+  refs    INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(coin, address)
+) WITHOUT ROWID;
+
+-- shops: total, por status y por risk_level
+CREATE TRIGGER IF NOT EXISTS trg_stats_shops_ins AFTER INSERT ON shops BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('shops',1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+  INSERT INTO stat_counters(name,value) VALUES ('status:'||COALESCE(NEW.status,''),1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+  INSERT INTO stat_counters(name,value) VALUES ('risk:'||COALESCE(NEW.risk_level,''),1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_shops_del AFTER DELETE ON shops BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='shops';
+  UPDATE stat_counters SET value=value-1 WHERE name='status:'||COALESCE(OLD.status,'');
+  UPDATE stat_counters SET value=value-1 WHERE name='risk:'||COALESCE(OLD.risk_level,'');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_shops_status AFTER UPDATE OF status ON shops
+WHEN OLD.status IS NOT NEW.status BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='status:'||COALESCE(OLD.status,'');
+  INSERT INTO stat_counters(name,value) VALUES ('status:'||COALESCE(NEW.status,''),1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_shops_risk AFTER UPDATE OF risk_level ON shops
+WHEN OLD.risk_level IS NOT NEW.risk_level BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='risk:'||COALESCE(OLD.risk_level,'');
+  INSERT INTO stat_counters(name,value) VALUES ('risk:'||COALESCE(NEW.risk_level,''),1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+END;
+
+-- discovered_links: total y pendientes
+CREATE TRIGGER IF NOT EXISTS trg_stats_links_ins AFTER INSERT ON discovered_links BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('links',1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+  INSERT INTO stat_counters(name,value) VALUES ('links:pending',NEW.scanned=0)
+    ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_links_del AFTER DELETE ON discovered_links BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='links';
+  UPDATE stat_counters SET value=value-(OLD.scanned=0) WHERE name='links:pending';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_links_scanned AFTER UPDATE OF scanned ON discovered_links
+WHEN OLD.scanned IS NOT NEW.scanned BEGIN
+  UPDATE stat_counters SET value=value+(NEW.scanned=0)-(OLD.scanned=0)
+    WHERE name='links:pending';
+END;
+
+-- wallets: total y direcciones distintas por moneda
+CREATE TRIGGER IF NOT EXISTS trg_stats_wallets_ins AFTER INSERT ON wallets BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('wallets',1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+  INSERT INTO stat_groups(kind,key,c) SELECT 'coin', NEW.coin, 1
+    WHERE NOT EXISTS (SELECT 1 FROM stat_wallet_refs
+                      WHERE coin=NEW.coin AND address=NEW.address AND refs>0)
+    ON CONFLICT(kind,key) DO UPDATE SET c=c+1;
+  INSERT INTO stat_wallet_refs(coin,address,refs) VALUES (NEW.coin,NEW.address,1)
+    ON CONFLICT(coin,address) DO UPDATE SET refs=refs+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_wallets_del AFTER DELETE ON wallets BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='wallets';
+  UPDATE stat_wallet_refs SET refs=refs-1 WHERE coin=OLD.coin AND address=OLD.address;
+  UPDATE stat_groups SET c=c-1 WHERE kind='coin' AND key=OLD.coin
+    AND EXISTS (SELECT 1 FROM stat_wallet_refs
+                WHERE coin=OLD.coin AND address=OLD.address AND refs<=0);
+  DELETE FROM stat_wallet_refs WHERE coin=OLD.coin AND address=OLD.address AND refs<=0;
+END;
+
+-- threat_keywords: filas por categoría
+CREATE TRIGGER IF NOT EXISTS trg_stats_kwds_ins AFTER INSERT ON threat_keywords BEGIN
+  INSERT INTO stat_groups(kind,key,c) VALUES ('threat_category',NEW.category,1)
+    ON CONFLICT(kind,key) DO UPDATE SET c=c+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_kwds_del AFTER DELETE ON threat_keywords BEGIN
+  UPDATE stat_groups SET c=c-1 WHERE kind='threat_category' AND key=OLD.category;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_kwds_upd AFTER UPDATE OF category ON threat_keywords
+WHEN OLD.category IS NOT NEW.category BEGIN
+  UPDATE stat_groups SET c=c-1 WHERE kind='threat_category' AND key=OLD.category;
+  INSERT INTO stat_groups(kind,key,c) VALUES ('threat_category',NEW.category,1)
+    ON CONFLICT(kind,key) DO UPDATE SET c=c+1;
+END;
+
+-- alert_log: alertas enviadas
+CREATE TRIGGER IF NOT EXISTS trg_stats_alerts_ins AFTER INSERT ON alert_log BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('alerts:sent',NEW.sent=1)
+    ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_alerts_del AFTER DELETE ON alert_log BEGIN
+  UPDATE stat_counters SET value=value-(OLD.sent=1) WHERE name='alerts:sent';
+END;
+"""
+
+# Los contadores 'archived:*' (filas que collector.retention ya movió al
+# archivo) no se pueden recalcular desde las tablas: el rebuild los conserva.
+_STATS_REBUILD = [
+    "DELETE FROM stat_counters WHERE name NOT LIKE 'archived:%'",
+    "DELETE FROM stat_groups",
+    "DELETE FROM stat_wallet_refs",
+    "INSERT INTO stat_counters(name,value) SELECT 'shops', COUNT(*) FROM shops",
+    """INSERT INTO stat_counters(name,value)
+       SELECT 'status:'||COALESCE(status,''), COUNT(*) FROM shops GROUP BY 1""",
+    """INSERT INTO stat_counters(name,value)
+       SELECT 'risk:'||COALESCE(risk_level,''), COUNT(*) FROM shops GROUP BY 1""",
+    "INSERT INTO stat_counters(name,value) SELECT 'wallets', COUNT(*) FROM wallets",
+    """INSERT INTO stat_wallet_refs(coin,address,refs)
+       SELECT coin, address, COUNT(*) FROM wallets GROUP BY coin, address""",
+    """INSERT INTO stat_groups(kind,key,c)
+       SELECT 'coin', coin, COUNT(*) FROM stat_wallet_refs GROUP BY coin""",
+    """INSERT INTO stat_groups(kind,key,c)
+       SELECT 'threat_category', category, COUNT(*) FROM threat_keywords GROUP BY category""",
+]
+
+# Contadores de las tablas calientes: viven en el stat_counters del fichero que
+# guarda la tabla (un trigger solo puede tocar tablas de su propia DB).
+_HOT_COUNTERS = [
+    ("discovered_links", "links",         "SELECT COUNT(*) FROM {db}.discovered_links"),
+    ("discovered_links", "links:pending", "SELECT COUNT(*) FROM {db}.discovered_links WHERE scanned=0"),
+    ("alert_log",        "alerts:sent",   "SELECT COUNT(*) FROM {db}.alert_log WHERE sent=1"),
+]
+
+def _attached(conn) -> list[str]:
+    return [r["name"] for r in conn.execute("PRAGMA database_list").fetchall()
+            if r["name"] in HOT_TABLES]
+
+def _table_db(conn, table) -> str:
+    """Esquema donde está hoy `table` en esta conexión (adjuntas antes que main)."""
+    for alias in _attached(conn):
+        if conn.execute(f"SELECT 1 FROM {alias}.sqlite_master WHERE type='table' AND name=?",
+                        (table,)).fetchone():
+            return alias
+    return "main"
+
+def _rebuild_hot_counters(conn):
+    for table, name, sql in _HOT_COUNTERS:
+        db = _table_db(conn, table)
+        conn.execute("DELETE FROM main.stat_counters WHERE name=?", (name,))
+        conn.execute(f"""
+            INSERT INTO {db}.stat_counters(name,value) VALUES (?, ({sql.format(db=db)}))
+            ON CONFLICT(name) DO UPDATE SET value=excluded.value
+        """, (name,))
+
+def _rebuild_stats(conn):
+    """Recalcula todas las tablas stat_* y wallet_clusters desde cero (sin commit)."""
+    for sql in _STATS_REBUILD + _CLUSTERS_REBUILD:
+        conn.execute(sql)
+    _rebuild_hot_counters(conn)
+
+def rebuild_stats():
+    """Reconstruye los contadores materializados (p.ej. tras editar la DB a mano)."""
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _rebuild_stats(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  WALLET CLUSTERS — índice inverso dirección→sitios y pares de sitios que
+#  comparten direcciones, mantenidos por triggers en cada alta/baja de wallet
+# ─────────────────────────────────────────────────────────────────────────────
+
+WALLET_SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_wallets_address ON wallets(address, coin);
+
+-- par (shop_a < shop_b) → nº de direcciones compartidas
+CREATE TABLE IF NOT EXISTS wallet_clusters (
+  shop_a INTEGER NOT NULL,
+  shop_b INTEGER NOT NULL,
+  shared INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(shop_a, shop_b)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_wclusters_b ON wallet_clusters(shop_b);
+
+CREATE TRIGGER IF NOT EXISTS trg_wclusters_ins AFTER INSERT ON wallets BEGIN
+  INSERT INTO wallet_clusters(shop_a,shop_b,shared)
+    SELECT MIN(NEW.shop_id,w.shop_id), MAX(NEW.shop_id,w.shop_id), 1 FROM wallets w
+    WHERE w.address=NEW.address AND w.coin=NEW.coin AND w.shop_id!=NEW.shop_id
+    ON CONFLICT(shop_a,shop_b) DO UPDATE SET shared=shared+1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_wclusters_del AFTER DELETE ON wallets BEGIN
+  UPDATE wallet_clusters SET shared=shared-1
+    WHERE (shop_a,shop_b) IN (
+      SELECT MIN(OLD.shop_id,w.shop_id), MAX(OLD.shop_id,w.shop_id) FROM wallets w
+      WHERE w.address=OLD.address AND w.coin=OLD.coin AND w.shop_id!=OLD.shop_id);
+  DELETE FROM wallet_clusters
+    WHERE shared<=0 AND (shop_a=OLD.shop_id OR shop_b=OLD.shop_id);
+END;
+"""
+
+_CLUSTERS_REBUILD = [
+    "DELETE FROM wallet_clusters",
+    """INSERT INTO wallet_clusters(shop_a,shop_b,shared)
+       SELECT a.shop_id, b.shop_id, COUNT(*) FROM wallets a
+       JOIN wallets b ON b.address=a.address AND b.coin=a.coin AND b.shop_id>a.shop_id
+       GROUP BY a.shop_id, b.shop_id""",
+]
+
+def get_wallet_shops(address: str) -> list[dict]:
+    """Todos los sitios que publican una dirección (vía idx_wallets_address)."""
+    conn = connect()
+    rows = [dict(r) for r in conn.execute("""
+        SELECT w.coin, w.address, w.addr_type, s.id AS shop_id, s.url, s.domain,
+               s.title, s.risk_level, s.risk_score, s.last_scanned
+        FROM wallets w JOIN shops s ON s.id=w.shop_id
+        WHERE w.address=? ORDER BY s.risk_score DESC
+    """, (address,)).fetchall()]
+    conn.close(); return rows
+
+def get_related_shops(shop_id) -> list[dict]:
+    """Sitios que comparten al menos una dirección con shop_id, con las direcciones en común."""
+    conn = connect()
+    rows = [dict(r) for r in conn.execute("""
+        SELECT c.other AS shop_id, c.shared, s.url, s.domain, s.title, s.risk_level,
+               (SELECT GROUP_CONCAT(w1.coin||':'||w1.address, ' ')
+                FROM wallets w1 JOIN wallets w2
+                  ON w2.address=w1.address AND w2.coin=w1.coin AND w2.shop_id=c.other
+                WHERE w1.shop_id=?) AS addresses
+        FROM (SELECT shop_b AS other, shared FROM wallet_clusters WHERE shop_a=?
+              UNION ALL
+              SELECT shop_a AS other, shared FROM wallet_clusters WHERE shop_b=?) c
+        JOIN shops s ON s.id=c.other
+        ORDER BY c.shared DESC, s.risk_score DESC
+    """, (shop_id, shop_id, shop_id)).fetchall()]
+    for r in rows:
+        r["addresses"] = (r["addresses"] or "").split()
+    conn.close(); return rows
+
+def list_wallet_clusters(limit=100, min_shared=1) -> list[dict]:
+    """Pares de sitios que comparten direcciones, de más a menos direcciones en común."""
+    conn = connect()
+    rows = [dict(r) for r in conn.execute("""
+        SELECT c.shop_a, c.shop_b, c.shared,
+               a.domain AS domain_a, a.title AS title_a, a.risk_level AS risk_a,
+               b.domain AS domain_b, b.title AS title_b, b.risk_level AS risk_b
+        FROM wallet_clusters c
+        JOIN shops a ON a.id=c.shop_a
+        JOIN shops b ON b.id=c.shop_b
+        WHERE c.shared>=?
+        ORDER BY c.shared DESC LIMIT ?
+    """, (min_shared, limit)).fetchall()]
+    conn.close(); return rows
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  FULL-TEXT SEARCH — FTS5 sobre url/domain/título, texto de página y OCR
+#  rowid = shops.id. Si SQLite no trae FTS5, la búsqueda cae a LIKE.
+# ─────────────────────────────────────────────────────────────────────────────
+
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+  url, domain, title, page_text, ocr_text,
+  tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_fts_shops_ins AFTER INSERT ON shops BEGIN
+  INSERT INTO search_fts(rowid,url,domain,title) VALUES (NEW.id,NEW.url,NEW.domain,NEW.title);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fts_shops_upd AFTER UPDATE OF url,domain,title ON shops
+WHEN OLD.url IS NOT NEW.url OR OLD.domain IS NOT NEW.domain OR OLD.title IS NOT NEW.title BEGIN
+  UPDATE search_fts SET url=NEW.url, domain=NEW.domain, title=NEW.title WHERE rowid=NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fts_shops_del AFTER DELETE ON shops BEGIN
+  DELETE FROM search_fts WHERE rowid=OLD.id;
+END;
+
+-- el OCR indexado es siempre el de la captura más reciente
+CREATE TRIGGER IF NOT EXISTS trg_fts_ocr AFTER INSERT ON screenshots
+WHEN NEW.ocr_text IS NOT NULL AND NEW.ocr_text != '' BEGIN
+  UPDATE search_fts SET ocr_text=NEW.ocr_text WHERE rowid=NEW.shop_id;
+END;
+"""
+
+# Marcadores de resaltado: caracteres de control, se escapan y convierten a <mark> en Python
+_HL_OPEN, _HL_CLOSE = "\x02", "\x03"
+
+_fts_ready = False
+
+def fts_available(conn=None) -> bool:
+    global _fts_ready
+    if not _fts_ready:
+        c = conn or connect()
+        _fts_ready = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='search_fts'"
+        ).fetchone() is not None
+    return _fts_ready
+
+def fts_query(q: str) -> str:
+    """Convierte texto libre en una expresión MATCH segura: cada término entre comillas, con prefijo."""
+    terms = [t.replace('"', '""') for t in q.split() if t.strip('"')]
+    return " ".join(f'"{t}"*' for t in terms)
+
+def render_highlight(text) -> str:
+    """Escapa HTML (contenido hostil) y convierte los marcadores de FTS en <mark>."""
+    import html
+    if not text:
+        return ""
+    return (html.escape(text)
+            .replace(_HL_OPEN, "<mark>")
+            .replace(_HL_CLOSE, "</mark>"))
+
+# Columnas de snippet para SELECT sobre search_fts (rank: menor = más relevante)
+SEARCH_COLUMNS = (
+    f"bm25(search_fts, 2.0, 4.0, 8.0, 1.0, 1.0) AS rank, "
+    f"highlight(search_fts, 2, '{_HL_OPEN}', '{_HL_CLOSE}') AS title_hl, "
+    f"snippet(search_fts, -1, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16) AS snippet"
+)
+
+def _write_search_text(conn, shop_id, text):
+    if text and fts_available(conn):
+        conn.execute("UPDATE search_fts SET page_text=? WHERE rowid=?", (text, shop_id))
+
+def _rebuild_search(conn):
+    """Rellena search_fts desde shops + último OCR (el texto de página llega al re-escanear)."""
+    conn.execute("DELETE FROM search_fts")
+    conn.execute("""
+        INSERT INTO search_fts(rowid,url,domain,title,ocr_text)
+        SELECT s.id, s.url, s.domain, s.title,
+               (SELECT ocr_text FROM screenshots
+                WHERE shop_id=s.id AND ocr_text IS NOT NULL AND ocr_text != ''
+                ORDER BY created_at DESC LIMIT 1)
+        FROM shops s
+    """)
+
+def search_shops(q: str, limit: int = 50, risk_level: str = "") -> list[dict]:
+    """Búsqueda ordenada por relevancia con título resaltado y snippet HTML seguro."""
     conn = connect()
-    conn.executescript("""
-    CREATE TABLE IF NOT EXISTS shops (
-      id            INTEGER PRIMARY KEY AUTOINCREMENT,
-      url           TEXT UNIQUE NOT NULL,
-      domain        TEXT,
-      title         TEXT,
-      detected_at   TEXT,
-      last_scanned  TEXT,
-      scan_count    INTEGER DEFAULT 1,
-      status        TEXT,
-      risk_score    REAL DEFAULT 0,
-      risk_level    TEXT DEFAULT 'unknown',
-      external_risk TEXT DEFAULT 'unknown',
-      content_hash  TEXT,
-      notes         TEXT,
-      language      TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS tech (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id    INTEGER NOT NULL,
-      name       TEXT NOT NULL,
-      category   TEXT,
-      version    TEXT,
-      confidence REAL,
-      source     TEXT,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS screenshots (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id    INTEGER NOT NULL,
-      path       TEXT NOT NULL,
-      width      INTEGER,
-      height     INTEGER,
-      ocr_text   TEXT,
-      created_at TEXT,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS threat_keywords (
-      id       INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id  INTEGER NOT NULL,
-      keyword  TEXT NOT NULL,
-      category TEXT NOT NULL,
-      severity TEXT NOT NULL,
-      count    INTEGER DEFAULT 1,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS tags (
-      id      INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id INTEGER NOT NULL,
-      tag     TEXT NOT NULL,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS wallets (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id    INTEGER NOT NULL,
-      coin       TEXT NOT NULL,
-      address    TEXT NOT NULL,
-      addr_type  TEXT,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS threat_intel (
-      id            INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id       INTEGER NOT NULL UNIQUE,
-      vt_malicious  INTEGER DEFAULT 0,
-      vt_suspicious INTEGER DEFAULT 0,
-      vt_harmless   INTEGER DEFAULT 0,
-      vt_engines    TEXT,
-      uh_found      INTEGER DEFAULT 0,
-      uh_status     TEXT,
-      uh_threat     TEXT,
-      uh_tags       TEXT,
-      external_risk TEXT DEFAULT 'unknown',
-      checked_at    TEXT,
-      FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
-    );
-
-    CREATE TABLE IF NOT EXISTS alert_log (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id    INTEGER,
-      channel    TEXT,
-      risk_level TEXT,
-      sent       INTEGER DEFAULT 0,
-      reason     TEXT,
-      sent_at    TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS discovered_links (
-      id            INTEGER PRIMARY KEY AUTOINCREMENT,
-      source_id     INTEGER,
-      url           TEXT UNIQUE NOT NULL,
-      domain        TEXT,
-      discovered_at TEXT,
-      scanned       INTEGER DEFAULT 0,
-      FOREIGN KEY(source_id) REFERENCES shops(id) ON DELETE SET NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS rescan_log (
-      id      INTEGER PRIMARY KEY AUTOINCREMENT,
-      shop_id INTEGER,
-      url     TEXT,
-      status  TEXT,
-      detail  TEXT,
-      ran_at  TEXT
-    );
-
-    CREATE INDEX IF NOT EXISTS idx_tech_shop        ON tech(shop_id);
-    CREATE INDEX IF NOT EXISTS idx_shops_domain     ON shops(domain);
-    CREATE INDEX IF NOT EXISTS idx_shops_risk       ON shops(risk_score);
-    CREATE INDEX IF NOT EXISTS idx_shops_risk_level ON shops(risk_level);
-    CREATE INDEX IF NOT EXISTS idx_kwds_shop        ON threat_keywords(shop_id);
-    CREATE INDEX IF NOT EXISTS idx_tags_shop        ON tags(shop_id);
-    CREATE INDEX IF NOT EXISTS idx_wallets_shop     ON wallets(shop_id);
-    CREATE INDEX IF NOT EXISTS idx_wallets_coin     ON wallets(coin);
-    CREATE INDEX IF NOT EXISTS idx_disc_scanned     ON discovered_links(scanned);
+    match = fts_query(q)
+    if not match:
+        conn.close(); return []
+    if fts_available(conn):
+        sql = f"""
+          SELECT s.id,s.url,s.domain,s.title,s.risk_level,s.risk_score,s.last_scanned,
+                 f.rank,f.title_hl,f.snippet
+          FROM (SELECT rowid AS fid, {SEARCH_COLUMNS} FROM search_fts
+                WHERE search_fts MATCH ?) f
+          JOIN shops s ON s.id=f.fid
+        """
+        params = [match]
+        if risk_level:
+            sql += " WHERE s.risk_level=?"; params.append(risk_level)
+        sql += " ORDER BY f.rank LIMIT ?"; params.append(limit)
+    else:
+        like = f"%{q}%"
+        sql = """
+          SELECT id,url,domain,title,risk_level,risk_score,last_scanned,
+                 0 AS rank, title AS title_hl, NULL AS snippet
+          FROM shops WHERE (url LIKE ? OR domain LIKE ? OR title LIKE ?)
+        """
+        params = [like, like, like]
+        if risk_level:
+            sql += " AND risk_level=?"; params.append(risk_level)
+        sql += " ORDER BY risk_score DESC LIMIT ?"; params.append(limit)
+    rows = []
+    for r in conn.execute(sql, params).fetchall():
+        d = dict(r)
+        d["title_hl"] = render_highlight(d["title_hl"])
+        d["snippet"]  = render_highlight(d["snippet"])
+        rows.append(d)
+    conn.close(); return rows
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  SCAN HISTORY — snapshots por escaneo con solo los cambios (delta)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _backfill_history(conn):
+    """Crea un scan base por sitio con todas sus filas hijas actuales como altas (+)."""
+    import json
+    conn.execute("""
+        INSERT INTO scans(shop_id,scanned_at,status,title,risk_level,risk_score,content_hash)
+        SELECT id,last_scanned,status,title,risk_level,risk_score,content_hash FROM shops
+    """)
+    base = {r["shop_id"]: r["id"] for r in conn.execute(
+        "SELECT shop_id, MIN(id) AS id FROM scans GROUP BY shop_id").fetchall()}
+    for kind, (table, key_cols, det_cols) in _CHILD_SPECS.items():
+        cols = key_cols + det_cols
+        changes = [
+            (base[r["shop_id"]], r["shop_id"], kind, "+",
+             _item_key(tuple(r[c] for c in key_cols)),
+             json.dumps({c: r[c] for c in cols}, ensure_ascii=False))
+            for r in conn.execute(f"SELECT shop_id,{','.join(cols)} FROM {table}").fetchall()
+            if r["shop_id"] in base
+        ]
+        conn.executemany("""
+            INSERT INTO scan_changes(scan_id,shop_id,kind,op,item,detail)
+            VALUES (?,?,?,?,?,?)
+        """, changes)
+    conn.execute("""
+        UPDATE scans SET changes=(SELECT COUNT(*) FROM scan_changes WHERE scan_id=scans.id)
     """)
 
-    # Migración: añadir columnas v3 si la DB viene de v2
-    migrations = [
-        "ALTER TABLE shops ADD COLUMN external_risk TEXT DEFAULT 'unknown'",
-        "ALTER TABLE screenshots ADD COLUMN ocr_text TEXT",
-    ]
-    for sql in migrations:
+def get_scan_history(shop_id, limit=50) -> list[dict]:
+    """Scans de un sitio (más reciente primero) con sus cambios agrupados por tipo."""
+    conn = connect()
+    scans = [dict(r) for r in conn.execute("""
+        SELECT id,scanned_at,status,title,risk_level,risk_score,content_hash,changes
+        FROM scans WHERE shop_id=? ORDER BY id DESC LIMIT ?
+    """, (shop_id, limit)).fetchall()]
+    if scans:
+        by_id = {s["id"]: s for s in scans}
+        for s in scans:
+            s["diff"] = {kind: {"+": [], "-": [], "~": []} for kind in _CHILD_SPECS}
+        for r in conn.execute("""
+            SELECT scan_id,kind,op,item FROM scan_changes
+            WHERE shop_id=? AND scan_id>=? ORDER BY id
+        """, (shop_id, scans[-1]["id"])).fetchall():
+            if r["scan_id"] in by_id:
+                by_id[r["scan_id"]]["diff"][r["kind"]][r["op"]].append(r["item"])
+    conn.close(); return scans
+
+def get_state_at_scan(shop_id, scan_id) -> dict | None:
+    """Reconstruye tech/keywords/tags/wallets tal como quedaron tras un scan concreto."""
+    import json
+    conn = connect()
+    scan = conn.execute("SELECT * FROM scans WHERE id=? AND shop_id=?",
+                        (scan_id, shop_id)).fetchone()
+    if not scan:
+        conn.close(); return None
+    state = {kind: {} for kind in _CHILD_SPECS}
+    for r in conn.execute("""
+        SELECT kind,op,item,detail FROM scan_changes
+        WHERE shop_id=? AND scan_id<=? ORDER BY id
+    """, (shop_id, scan_id)).fetchall():
+        if r["op"] == "-":
+            state[r["kind"]].pop(r["item"], None)
+        else:
+            state[r["kind"]][r["item"]] = json.loads(r["detail"])
+    conn.close()
+    return {
+        "scan":     dict(scan),
+        "tech":     list(state["tech"].values()),
+        "keywords": list(state["keyword"].values()),
+        "tags":     [t["tag"] for t in state["tag"].values()],
+        "wallets":  list(state["wallet"].values()),
+    }
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  SCHEMA — migraciones versionadas con PRAGMA user_version
+#  Cada paso se aplica una sola vez, en orden y dentro de la misma transacción
+#  que sube la versión. Los pasos son idempotentes (IF NOT EXISTS, comprobación
+#  de columnas) para adoptar DBs anteriores al versionado (user_version=0).
+# ─────────────────────────────────────────────────────────────────────────────
+
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shops (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  url           TEXT UNIQUE NOT NULL,
+  domain        TEXT,
+  title         TEXT,
+  detected_at   TEXT,
+  last_scanned  TEXT,
+  scan_count    INTEGER DEFAULT 1,
+  status        TEXT,
+  risk_score    REAL DEFAULT 0,
+  risk_level    TEXT DEFAULT 'unknown',
+  external_risk TEXT DEFAULT 'unknown',
+  content_hash  TEXT,
+  notes         TEXT,
+  language      TEXT
+);
+
+CREATE TABLE IF NOT EXISTS tech (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id    INTEGER NOT NULL,
+  name       TEXT NOT NULL,
+  category   TEXT,
+  version    TEXT,
+  confidence REAL,
+  source     TEXT,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS screenshots (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id    INTEGER NOT NULL,
+  path       TEXT NOT NULL,
+  width      INTEGER,
+  height     INTEGER,
+  ocr_text   TEXT,
+  created_at TEXT,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS threat_keywords (
+  id       INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id  INTEGER NOT NULL,
+  keyword  TEXT NOT NULL,
+  category TEXT NOT NULL,
+  severity TEXT NOT NULL,
+  count    INTEGER DEFAULT 1,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+  id      INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id INTEGER NOT NULL,
+  tag     TEXT NOT NULL,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS wallets (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id    INTEGER NOT NULL,
+  coin       TEXT NOT NULL,
+  address    TEXT NOT NULL,
+  addr_type  TEXT,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS threat_intel (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id       INTEGER NOT NULL UNIQUE,
+  vt_malicious  INTEGER DEFAULT 0,
+  vt_suspicious INTEGER DEFAULT 0,
+  vt_harmless   INTEGER DEFAULT 0,
+  vt_engines    TEXT,
+  uh_found      INTEGER DEFAULT 0,
+  uh_status     TEXT,
+  uh_threat     TEXT,
+  uh_tags       TEXT,
+  external_risk TEXT DEFAULT 'unknown',
+  checked_at    TEXT,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS alert_log (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id    INTEGER,
+  channel    TEXT,
+  risk_level TEXT,
+  sent       INTEGER DEFAULT 0,
+  reason     TEXT,
+  sent_at    TEXT
+);
+
+CREATE TABLE IF NOT EXISTS discovered_links (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  source_id     INTEGER,
+  url           TEXT UNIQUE NOT NULL,
+  domain        TEXT,
+  discovered_at TEXT,
+  scanned       INTEGER DEFAULT 0,
+  FOREIGN KEY(source_id) REFERENCES shops(id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS rescan_log (
+  id      INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id INTEGER,
+  url     TEXT,
+  status  TEXT,
+  detail  TEXT,
+  ran_at  TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_tech_shop        ON tech(shop_id);
+CREATE INDEX IF NOT EXISTS idx_shops_domain     ON shops(domain);
+CREATE INDEX IF NOT EXISTS idx_shops_risk       ON shops(risk_score);
+CREATE INDEX IF NOT EXISTS idx_shops_risk_level ON shops(risk_level);
+CREATE INDEX IF NOT EXISTS idx_kwds_shop        ON threat_keywords(shop_id);
+CREATE INDEX IF NOT EXISTS idx_tags_shop        ON tags(shop_id);
+CREATE INDEX IF NOT EXISTS idx_wallets_shop     ON wallets(shop_id);
+CREATE INDEX IF NOT EXISTS idx_wallets_coin     ON wallets(coin);
+CREATE INDEX IF NOT EXISTS idx_disc_scanned     ON discovered_links(scanned);
+CREATE INDEX IF NOT EXISTS idx_disc_domain      ON discovered_links(domain);
+
+CREATE INDEX IF NOT EXISTS idx_shots_shop       ON screenshots(shop_id, created_at DESC);
+"""
+
+HOSTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS discovered_hosts (
+  host       TEXT PRIMARY KEY NOT NULL,
+  first_seen TEXT,
+  last_seen  TEXT,
+  times_seen INTEGER DEFAULT 0
+);
+"""
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id      INTEGER NOT NULL,
+  scanned_at   TEXT,
+  status       TEXT,
+  title        TEXT,
+  risk_level   TEXT,
+  risk_score   REAL,
+  content_hash TEXT,
+  changes      INTEGER DEFAULT 0,
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS scan_changes (
+  id      INTEGER PRIMARY KEY AUTOINCREMENT,
+  scan_id INTEGER NOT NULL,
+  shop_id INTEGER NOT NULL,
+  kind    TEXT NOT NULL,   -- tech / keyword / tag / wallet
+  op      TEXT NOT NULL,   -- + alta / - baja / ~ modificada
+  item    TEXT NOT NULL,   -- clave de la fila (p.ej. "BTC|1abc...")
+  detail  TEXT,            -- JSON de la fila completa (en + y ~)
+  FOREIGN KEY(shop_id) REFERENCES shops(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_scans_shop   ON scans(shop_id, id);
+CREATE INDEX IF NOT EXISTS idx_changes_shop ON scan_changes(shop_id, scan_id);
+"""
+
+RETENTION_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_rescan_ran     ON rescan_log(ran_at);
+CREATE INDEX IF NOT EXISTS idx_alerts_sent    ON alert_log(sent_at);
+CREATE INDEX IF NOT EXISTS idx_shots_created  ON screenshots(created_at);
+CREATE INDEX IF NOT EXISTS idx_disc_last_seen ON discovered_links(scanned, last_seen);
+"""
+
+# Capturas direccionadas por contenido (collector.shotstore): varias filas por fichero
+SHOT_STORE_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_shots_path ON screenshots(path);
+"""
+
+# Cola de re-escaneo: índice parcial, solo los sitios programados ocupan entradas
+SCHEDULE_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_shops_next_scan ON shops(next_scan_at)
+  WHERE next_scan_at IS NOT NULL;
+"""
+
+# Cola de trabajo con leases para varios procesos worker (collector.worker).
+# status: queued → leased → done | failed. Un lease vencido (lease_until < ahora)
+# vuelve a ser reclamable; el índice único parcial evita duplicar un objetivo
+# que ya está en cola o en curso.
+WORK_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_queue (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind         TEXT NOT NULL,
+  target       TEXT NOT NULL,
+  payload      TEXT,
+  priority     INTEGER DEFAULT 0,
+  status       TEXT NOT NULL DEFAULT 'queued',
+  attempts     INTEGER DEFAULT 0,
+  max_attempts INTEGER DEFAULT 3,
+  available_at TEXT NOT NULL,
+  lease_owner  TEXT,
+  lease_until  TEXT,
+  heartbeat_at TEXT,
+  enqueued_at  TEXT,
+  finished_at  TEXT,
+  last_error   TEXT,
+  result       TEXT
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_wq_active ON work_queue(kind, target)
+  WHERE status IN ('queued','leased');
+CREATE INDEX IF NOT EXISTS idx_wq_ready    ON work_queue(priority DESC, available_at)
+  WHERE status='queued';
+CREATE INDEX IF NOT EXISTS idx_wq_leases   ON work_queue(lease_until)
+  WHERE status='leased';
+CREATE INDEX IF NOT EXISTS idx_wq_finished ON work_queue(finished_at)
+  WHERE status IN ('done','failed');
+"""
+
+# Frontera de crawl: discovered_links.priority se mantiene por triggers y el
+# índice (scanned, priority) sirve los N mejores pendientes sin ordenar la tabla.
+#   priority = 4·riesgo de la fuente (máx. visto, 0–1)
+#            + 2·times_seen/(times_seen+3)       (sitios distintos que lo enlazan; satura ≈ 2)
+#            + 2/(1+escaneos ya hechos en su host) (hosts nuevos primero)
+#            − 1.5·fallos
+#            + 2·link_rank del host              (PageRank normalizado 0–1, desde v12;
+#                                                 lo escribe collector.linkgraph)
+# Los pesos viven en los triggers: cambiarlos exige una migración nueva.
+FRONTIER_RISK = {"critical": 1.0, "high": 0.7, "medium": 0.4, "low": 0.2}
+FRONTIER_RISK_DEFAULT = 0.05
+FRONTIER_MAX_FAILURES = int(os.getenv("FRONTIER_MAX_FAILURES", "3"))  # luego se abandona
+FRONTIER_ROUND        = int(os.getenv("FRONTIER_ROUND", "100"))        # links por ronda de crawl
+
+def _frontier_score(row: str, crawled: str, rank: str | None = None) -> str:
+    return (f"(4.0*{row}.source_risk + 2.0*{row}.times_seen/({row}.times_seen+3.0)"
+            f" + 2.0/(1+{crawled}) - 1.5*{row}.failures"
+            + (f" + 2.0*{rank})" if rank else ")"))
+
+_HOST_CRAWLED = "COALESCE((SELECT crawled FROM discovered_hosts WHERE host=NEW.domain),0)"
+_HOST_RANK    = "COALESCE((SELECT link_rank FROM discovered_hosts WHERE host=NEW.domain),0)"
+
+FRONTIER_SCHEMA = f"""
+CREATE INDEX IF NOT EXISTS {{db}}.idx_disc_frontier ON discovered_links(scanned, priority DESC, id);
+
+CREATE TRIGGER IF NOT EXISTS {{db}}.trg_frontier_ins AFTER INSERT ON discovered_links BEGIN
+  UPDATE discovered_links SET priority={_frontier_score("NEW", _HOST_CRAWLED)} WHERE id=NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS {{db}}.trg_frontier_upd
+AFTER UPDATE OF times_seen, source_risk, failures ON discovered_links BEGIN
+  UPDATE discovered_links SET priority={_frontier_score("NEW", _HOST_CRAWLED)} WHERE id=NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS {{db}}.trg_frontier_host AFTER UPDATE OF crawled ON discovered_hosts
+WHEN OLD.crawled IS NOT NEW.crawled BEGIN
+  UPDATE discovered_links SET priority={_frontier_score("discovered_links", "NEW.crawled")}
+  WHERE domain=NEW.host AND scanned=0;
+END;
+"""
+
+# v12: los mismos triggers con el término de link_rank (sustituyen a los de v11)
+FRONTIER_RANK_SCHEMA = f"""
+DROP TRIGGER IF EXISTS {{db}}.trg_frontier_ins;
+DROP TRIGGER IF EXISTS {{db}}.trg_frontier_upd;
+DROP TRIGGER IF EXISTS {{db}}.trg_frontier_host;
+
+CREATE TRIGGER {{db}}.trg_frontier_ins AFTER INSERT ON discovered_links BEGIN
+  UPDATE discovered_links SET priority={_frontier_score("NEW", _HOST_CRAWLED, _HOST_RANK)}
+  WHERE id=NEW.id;
+END;
+
+CREATE TRIGGER {{db}}.trg_frontier_upd
+AFTER UPDATE OF times_seen, source_risk, failures ON discovered_links BEGIN
+  UPDATE discovered_links SET priority={_frontier_score("NEW", _HOST_CRAWLED, _HOST_RANK)}
+  WHERE id=NEW.id;
+END;
+
+CREATE TRIGGER {{db}}.trg_frontier_host AFTER UPDATE OF crawled, link_rank ON discovered_hosts
+WHEN OLD.crawled IS NOT NEW.crawled OR OLD.link_rank IS NOT NEW.link_rank BEGIN
+  UPDATE discovered_links
+  SET priority={_frontier_score("discovered_links", "NEW.crawled", "NEW.link_rank")}
+  WHERE domain=NEW.host AND scanned=0;
+END;
+"""
+
+# Pares (link, sitio fuente) distintos: times_seen de links y hosts solo sube
+# cuando aparece un par nuevo, no cada vez que se re-escanea la misma fuente.
+# source_id=0: link sin sitio fuente. Sin FK a shops (las filas sobreviven al sitio).
+LINK_SOURCES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {db}.link_sources (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  url        TEXT NOT NULL,
+  source_id  INTEGER NOT NULL,
+  domain     TEXT,
+  first_seen TEXT,
+  UNIQUE(url, source_id)
+);
+"""
+
+# Tablas calientes en su propio fichero (SQLITE_SPLIT_HOT); {db} = alias adjunto.
+# discovered_links pierde la FK a shops (no cruza ficheros): source_id se pone
+# a NULL a mano al borrar sitios.
+HOT_SCHEMAS = {
+    "logs": """
+CREATE TABLE IF NOT EXISTS {db}.stat_counters (
+  name  TEXT PRIMARY KEY NOT NULL,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS {db}.alert_log (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id    INTEGER,
+  channel    TEXT,
+  risk_level TEXT,
+  sent       INTEGER DEFAULT 0,
+  reason     TEXT,
+  sent_at    TEXT
+);
+
+CREATE TABLE IF NOT EXISTS {db}.rescan_log (
+  id      INTEGER PRIMARY KEY AUTOINCREMENT,
+  shop_id INTEGER,
+  url     TEXT,
+  status  TEXT,
+  detail  TEXT,
+  ran_at  TEXT
+);
+
+CREATE INDEX IF NOT EXISTS {db}.idx_alerts_sent ON alert_log(sent_at);
+CREATE INDEX IF NOT EXISTS {db}.idx_rescan_ran  ON rescan_log(ran_at);
+
+CREATE TRIGGER IF NOT EXISTS {db}.trg_stats_alerts_ins AFTER INSERT ON alert_log BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('alerts:sent',NEW.sent=1)
+    ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;
+
+CREATE TRIGGER IF NOT EXISTS {db}.trg_stats_alerts_del AFTER DELETE ON alert_log BEGIN
+  UPDATE stat_counters SET value=value-(OLD.sent=1) WHERE name='alerts:sent';
+END;
+""",
+    "frontier": """
+CREATE TABLE IF NOT EXISTS {db}.stat_counters (
+  name  TEXT PRIMARY KEY NOT NULL,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS {db}.discovered_links (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  source_id     INTEGER,
+  url           TEXT UNIQUE NOT NULL,
+  domain        TEXT,
+  discovered_at TEXT,
+  scanned       INTEGER DEFAULT 0,
+  times_seen    INTEGER DEFAULT 1,
+  last_seen     TEXT,
+  source_risk   REAL DEFAULT 0,
+  failures      INTEGER DEFAULT 0,
+  priority      REAL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS {db}.discovered_hosts (
+  host       TEXT PRIMARY KEY NOT NULL,
+  first_seen TEXT,
+  last_seen  TEXT,
+  times_seen INTEGER DEFAULT 0,
+  crawled    INTEGER DEFAULT 0,
+  link_rank  REAL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS {db}.idx_disc_scanned   ON discovered_links(scanned);
+CREATE INDEX IF NOT EXISTS {db}.idx_disc_domain    ON discovered_links(domain);
+CREATE INDEX IF NOT EXISTS {db}.idx_disc_last_seen ON discovered_links(scanned, last_seen);
+CREATE INDEX IF NOT EXISTS {db}.idx_disc_source    ON discovered_links(source_id);
+
+CREATE TRIGGER IF NOT EXISTS {db}.trg_stats_links_ins AFTER INSERT ON discovered_links BEGIN
+  INSERT INTO stat_counters(name,value) VALUES ('links',1)
+    ON CONFLICT(name) DO UPDATE SET value=value+1;
+  INSERT INTO stat_counters(name,value) VALUES ('links:pending',NEW.scanned=0)
+    ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;
+
+CREATE TRIGGER IF NOT EXISTS {db}.trg_stats_links_del AFTER DELETE ON discovered_links BEGIN
+  UPDATE stat_counters SET value=value-1 WHERE name='links';
+  UPDATE stat_counters SET value=value-(OLD.scanned=0) WHERE name='links:pending';
+END;
+
+CREATE TRIGGER IF NOT EXISTS {db}.trg_stats_links_scanned AFTER UPDATE OF scanned ON discovered_links
+WHEN OLD.scanned IS NOT NEW.scanned BEGIN
+  UPDATE stat_counters SET value=value+(NEW.scanned=0)-(OLD.scanned=0)
+    WHERE name='links:pending';
+END;
+""" + FRONTIER_SCHEMA + FRONTIER_RANK_SCHEMA + LINK_SOURCES_SCHEMA,
+}
+
+def _exec_script(conn, script: str):
+    """
+    Como executescript() pero sin su COMMIT implícito: ejecuta sentencia a
+    sentencia dentro de la transacción abierta (los triggers cuentan como una).
+    """
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            conn.execute(stmt)
+            stmt = ""
+    if stmt.strip():
+        conn.execute(stmt)
+
+def _add_column(conn, table, column, decl):
+    """table admite prefijo de esquema ('frontier.discovered_links')."""
+    db, _, name = table.rpartition(".")
+    pragma = f"PRAGMA {db}.table_info({name})" if db else f"PRAGMA table_info({name})"
+    cols = {r["name"] for r in conn.execute(pragma).fetchall()}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _m1_base(conn):
+    """Esquema v3 (y columnas añadidas sobre v2)."""
+    _exec_script(conn, BASE_SCHEMA)
+    _add_column(conn, "shops", "external_risk", "TEXT DEFAULT 'unknown'")
+    _add_column(conn, "screenshots", "ocr_text", "TEXT")
+
+def _m2_discovered(conn):
+    """Contadores times_seen/last_seen en links y tabla de hosts descubiertos."""
+    _add_column(conn, "discovered_links", "times_seen", "INTEGER DEFAULT 1")
+    _add_column(conn, "discovered_links", "last_seen", "TEXT")
+    _exec_script(conn, HOSTS_SCHEMA)
+    if conn.execute("SELECT 1 FROM discovered_hosts LIMIT 1").fetchone() is None:
+        conn.execute("""
+            INSERT OR IGNORE INTO discovered_hosts(host,first_seen,last_seen,times_seen)
+            SELECT LOWER(domain), MIN(discovered_at), MAX(discovered_at), COUNT(*)
+            FROM discovered_links WHERE domain IS NOT NULL GROUP BY LOWER(domain)
+        """)
+
+def _m3_history(conn):
+    """Historial por escaneo; snapshot base con el estado actual de los sitios previos."""
+    _exec_script(conn, HISTORY_SCHEMA)
+    if conn.execute("SELECT 1 FROM scans LIMIT 1").fetchone() is None:
+        _backfill_history(conn)
+
+def _m4_stats(conn):
+    """Estadísticas materializadas (stat_*)."""
+    _exec_script(conn, STATS_SCHEMA)
+    for sql in _STATS_REBUILD:
+        conn.execute(sql)
+    _rebuild_hot_counters(conn)
+
+def _m5_search(conn):
+    """Índice FTS5. Opcional: si SQLite no trae FTS5 el paso queda vacío y se busca con LIKE."""
+    try:
+        _exec_script(conn, SEARCH_SCHEMA)
+    except sqlite3.OperationalError:
+        return
+    _rebuild_search(conn)
+
+def _m6_wallet_clusters(conn):
+    """Índice por dirección y pares de sitios que comparten wallets."""
+    _exec_script(conn, WALLET_SCHEMA)
+    for sql in _CLUSTERS_REBUILD:
+        conn.execute(sql)
+
+def _m7_retention(conn):
+    """Índices sobre las marcas de tiempo que usa la retención."""
+    _exec_script(conn, RETENTION_INDEXES)
+
+def _m8_schedule(conn):
+    """
+    Cola de re-escaneo en shops.next_scan_at (sustituye a los jobs de
+    data/scheduler.db). Sitios ya escaneados: último escaneo + intervalo de su riesgo.
+    """
+    from collector.scheduler import RESCAN_INTERVALS, DEFAULT_INTERVAL_H
+    _add_column(conn, "shops", "next_scan_at", "TEXT")
+    _exec_script(conn, SCHEDULE_INDEX)
+    whens  = " ".join("WHEN ? THEN ?" for _ in RESCAN_INTERVALS)
+    params = [v for item in RESCAN_INTERVALS.items() for v in item]
+    conn.execute(f"""
+        UPDATE shops SET next_scan_at = strftime('%Y-%m-%dT%H:%M:%S+00:00', last_scanned,
+          '+' || (CASE risk_level {whens} ELSE ? END) || ' hours')
+        WHERE status='ok' AND last_scanned IS NOT NULL AND next_scan_at IS NULL
+    """, params + [DEFAULT_INTERVAL_H])
+
+def _m9_adaptive_interval(conn):
+    """Intervalo de re-escaneo propio de cada sitio (adaptado a su ritmo de cambios)."""
+    _add_column(conn, "shops", "rescan_interval_h", "REAL")
+
+def _m10_work_queue(conn):
+    """Cola de trabajo con leases para workers en varios procesos/hosts."""
+    _exec_script(conn, WORK_QUEUE_SCHEMA)
+
+def _m11_frontier(conn):
+    """
+    Prioridad de crawl en discovered_links (riesgo de la fuente, veces visto,
+    novedad del host, fallos). Con SQLITE_SPLIT_HOT ya activo las tablas están
+    en scrs_frontier.db y todo se crea allí.
+    """
+    db = _table_db(conn, "discovered_links")
+    for table, column, decl in (("discovered_links", "source_risk", "REAL DEFAULT 0"),
+                                ("discovered_links", "failures", "INTEGER DEFAULT 0"),
+                                ("discovered_links", "priority", "REAL DEFAULT 0"),
+                                ("discovered_hosts", "crawled", "INTEGER DEFAULT 0")):
+        _add_column(conn, f"{db}.{table}", column, decl)
+    _exec_script(conn, FRONTIER_SCHEMA.format(db=db))
+    whens  = " ".join("WHEN ? THEN ?" for _ in FRONTIER_RISK)
+    params = [v for item in FRONTIER_RISK.items() for v in item]
+    conn.execute(f"""
+        UPDATE {db}.discovered_links SET source_risk = COALESCE(
+          (SELECT CASE s.risk_level {whens} ELSE ? END FROM main.shops s
+           WHERE s.id = discovered_links.source_id), 0)
+    """, params + [FRONTIER_RISK_DEFAULT])
+    conn.execute(f"""
+        UPDATE {db}.discovered_hosts SET crawled = (
+          SELECT COUNT(*) FROM {db}.discovered_links l
+          WHERE l.domain = discovered_hosts.host AND l.scanned = 1)
+    """)
+    crawled = (f"COALESCE((SELECT crawled FROM {db}.discovered_hosts h "
+               f"WHERE h.host=discovered_links.domain),0)")
+    conn.execute(f"UPDATE {db}.discovered_links SET priority={_frontier_score('discovered_links', crawled)}")
+
+def _m12_link_rank(conn):
+    """PageRank por host (discovered_hosts.link_rank) como término de la prioridad de crawl."""
+    db = _table_db(conn, "discovered_hosts")
+    _add_column(conn, f"{db}.discovered_hosts", "link_rank", "REAL DEFAULT 0")
+    _exec_script(conn, FRONTIER_RANK_SCHEMA.format(db=db))
+
+def _m13_shot_store(conn):
+    """sha256 del fichero y dHash de cada captura; índice por path para el GC."""
+    _add_column(conn, "screenshots", "sha256", "TEXT")
+    _add_column(conn, "screenshots", "phash", "TEXT")
+    _exec_script(conn, SHOT_STORE_INDEX)
+
+def _m14_link_sources(conn):
+    """
+    times_seen = sitios fuente distintos (tabla link_sources). Los contadores
+    anteriores sumaban cada re-escaneo de la misma fuente y no se pueden
+    separar: se rehacen desde la única fuente conocida (source_id de cada link).
+    """
+    db = _table_db(conn, "discovered_links")
+    _exec_script(conn, LINK_SOURCES_SCHEMA.format(db=db))
+    conn.execute(f"""
+        INSERT OR IGNORE INTO {db}.link_sources(url, source_id, domain, first_seen)
+        SELECT url, COALESCE(source_id, 0), domain, discovered_at
+        FROM {db}.discovered_links ORDER BY id
+    """)
+    conn.execute(f"UPDATE {db}.discovered_links SET times_seen=1 WHERE times_seen IS NOT 1")
+    conn.execute(f"""
+        UPDATE {db}.discovered_hosts SET times_seen = (
+          SELECT COUNT(*) FROM {db}.link_sources s WHERE s.domain = discovered_hosts.host)
+    """)
+
+def _m15_shot_content(conn):
+    """content_hash del escaneo que produjo cada captura: con HTML nuevo no se deduplica."""
+    _add_column(conn, "screenshots", "content_hash", "TEXT")
+
+# Orden definitivo: añadir pasos solo al final, nunca reordenar ni editar los aplicados
+MIGRATIONS = [
+    _m1_base,
+    _m2_discovered,
+    _m3_history,
+    _m4_stats,
+    _m5_search,
+    _m6_wallet_clusters,
+    _m7_retention,
+    _m8_schedule,
+    _m9_adaptive_interval,
+    _m10_work_queue,
+    _m11_frontier,
+    _m12_link_rank,
+    _m13_shot_store,
+    _m14_link_sources,
+    _m15_shot_content,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_schema_ready = None    # DB_PATH ya verificada en este proceso
+
+def schema_version(conn=None) -> int:
+    return (conn or connect()).execute("PRAGMA user_version").fetchone()[0]
+
+def _move_table(conn, table, alias):
+    """Copia main.<table> al fichero `alias` (mismos ids) y la borra de scrs.db."""
+    if conn.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?",
+                    (table,)).fetchone() is None:
+        return
+    have = {r["name"] for r in conn.execute(f"PRAGMA main.table_info({table})").fetchall()}
+    cols = ",".join(r["name"] for r in conn.execute(f"PRAGMA {alias}.table_info({table})").fetchall()
+                    if r["name"] in have)
+    conn.execute(f"INSERT INTO {alias}.{table}({cols}) SELECT {cols} FROM main.{table}")
+    conn.execute(f"DROP TABLE main.{table}")
+
+def _init_split(conn):
+    """
+    Prepara los ficheros separados y mueve a ellos las tablas calientes que
+    sigan en scrs.db (una vez). Cada fichero lleva su propio user_version.
+    """
+    for alias in _attached(conn):
+        pending = conn.execute(f"PRAGMA {alias}.user_version").fetchone()[0] < 1 or any(
+            conn.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?",
+                         (t,)).fetchone() for t in HOT_TABLES[alias])
+        if not pending:
+            continue
+        if conn.execute(f"SELECT COUNT(*) FROM {alias}.sqlite_master").fetchone()[0] == 0:
+            conn.execute(f"PRAGMA {alias}.auto_vacuum=INCREMENTAL")
+            conn.execute(f"VACUUM {alias}")
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn.execute(sql)
+            _exec_script(conn, HOT_SCHEMAS[alias].format(db=alias))
+            for table in HOT_TABLES[alias]:
+                _move_table(conn, table, alias)
+            _rebuild_hot_counters(conn)
+            conn.execute(f"PRAGMA {alias}.user_version=1")
+            conn.commit()
         except Exception:
-            pass
+            conn.rollback()
+            raise
 
-    conn.commit()
+def init_db():
+    """
+    Lleva la DB a SCHEMA_VERSION. Si ya está al día cuesta una lectura de
+    PRAGMA user_version (y ninguna más en este proceso). Seguro entre procesos:
+    la versión se vuelve a leer con el lock de escritura (BEGIN IMMEDIATE)
+    tomado, así que cada paso lo aplica un único proceso.
+    """
+    global _schema_ready
+    if _schema_ready == DB_PATH:
+        return
+    conn = connect()
+    if schema_version(conn) < SCHEMA_VERSION:
+        # DB nueva: auto_vacuum incremental. Con WAL ya activo solo surte efecto
+        # tras un VACUUM, que sobre un fichero vacío es instantáneo.
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = schema_version(conn)
+            for n in range(version, SCHEMA_VERSION):
+                MIGRATIONS[n](conn)
+                conn.execute(f"PRAGMA user_version={n + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _init_split(conn)
     conn.close()
+    _schema_ready = DB_PATH
 
 # ─────────────────────────────────────────────────────────────────────────────
-#  SHOPS
+#  WRITE HELPERS — operan sobre una conexión abierta, sin commit
 # ─────────────────────────────────────────────────────────────────────────────
 
-def upsert_shop(url, domain, title, status, risk_score=0.0, risk_level="unknown",
+def _write_shop(conn, url, domain, title, status, risk_score=0.0, risk_level="unknown",
                 external_risk="unknown", content_hash=None, language=None, notes=None):
-    conn = connect()
     now = utc_now_iso()
     conn.execute("""
         INSERT INTO shops(url,domain,title,detected_at,last_scanned,scan_count,
@@ -180,65 +1302,148 @@ def upsert_shop(url, domain, title, status, risk_score=0.0, risk_level="unknown"
           notes=excluded.notes
     """, (url,domain,title,now,now,status,risk_score,risk_level,external_risk,
           content_hash,language,notes))
-    conn.commit()
     row = conn.execute("SELECT id FROM shops WHERE url=?", (url,)).fetchone()
-    conn.close()
     return int(row["id"])
 
-def replace_tech(shop_id, tech_items):
-    conn = connect()
-    conn.execute("DELETE FROM tech WHERE shop_id=?", (shop_id,))
-    conn.executemany("""
-        INSERT INTO tech(shop_id,name,category,version,confidence,source)
-        VALUES (?,?,?,?,?,?)
-    """, [(shop_id,t.get("name"),t.get("category"),t.get("version"),
-           float(t.get("confidence",0.0) or 0.0),t.get("source")) for t in tech_items])
-    conn.commit(); conn.close()
+# Tablas hijas versionadas: (tabla, columnas clave, columnas de detalle)
+_CHILD_SPECS = {
+    "tech":    ("tech",            ("name", "category"),  ("version", "confidence", "source")),
+    "keyword": ("threat_keywords", ("keyword",),          ("category", "severity", "count")),
+    "tag":     ("tags",            ("tag",),              ()),
+    "wallet":  ("wallets",         ("coin", "address"),   ("addr_type",)),
+}
 
-def add_screenshot(shop_id, rel_path, width, height, ocr_text=None):
-    conn = connect()
-    conn.execute("""
-        INSERT INTO screenshots(shop_id,path,width,height,ocr_text,created_at)
-        VALUES (?,?,?,?,?,?)
-    """, (shop_id,rel_path,width,height,ocr_text,utc_now_iso()))
-    conn.commit(); conn.close()
+def _item_key(key: tuple) -> str:
+    return "|".join("" if v is None else str(v) for v in key)
 
-def replace_keywords(shop_id, keywords):
-    conn = connect()
-    conn.execute("DELETE FROM threat_keywords WHERE shop_id=?", (shop_id,))
-    conn.executemany("""
-        INSERT INTO threat_keywords(shop_id,keyword,category,severity,count)
-        VALUES (?,?,?,?,?)
-    """, [(shop_id,k["keyword"],k["category"],k["severity"],k.get("count",1))
-          for k in keywords])
-    conn.commit(); conn.close()
+def _plan_children(shop_id, kind, current_rows, rows: list[dict], scan_id=None) -> dict:
+    """
+    Calcula las diferencias entre las filas hijas actuales (con id) y las nuevas.
+    Devuelve los parámetros listos para executemany: delete [(id,)] (también
+    las filas duplicadas de una misma clave),
+    insert [(shop_id, *cols)], update [(*det_cols, id)] y changes (scan_changes).
+    Común a todos los backends de almacenamiento.
+    """
+    import json
+    table, key_cols, det_cols = _CHILD_SPECS[kind]
+    cols = key_cols + det_cols
+    wanted = {tuple(r[c] for c in key_cols): tuple(r.get(c) for c in det_cols) for r in rows}
+    # Bases anteriores pueden tener varias filas por clave: se conserva una
+    # (la que ya coincide con la nueva, si la hay) y el resto se borra.
+    current, dupes = {}, []
+    for r in current_rows:
+        k, row = tuple(r[c] for c in key_cols), (r["id"], tuple(r[c] for c in det_cols))
+        if k in current:
+            keep, drop = current[k], row
+            if k in wanted and row[1] == wanted[k] and keep[1] != wanted[k]:
+                keep, drop = row, keep
+            current[k] = keep
+            dupes.append((drop[0],))
+        else:
+            current[k] = row
 
-def replace_tags(shop_id, tag_list):
-    conn = connect()
-    conn.execute("DELETE FROM tags WHERE shop_id=?", (shop_id,))
-    conn.executemany("INSERT INTO tags(shop_id,tag) VALUES (?,?)",
-                     [(shop_id,t) for t in set(tag_list)])
-    conn.commit(); conn.close()
+    removed  = [k for k in current if k not in wanted]
+    added    = [k for k in wanted if k not in current]
+    modified = [k for k in wanted if k in current and current[k][1] != wanted[k]]
 
-def replace_wallets(shop_id, wallets: dict):
-    """wallets: {"BTC": [{"address":..., "type":...}], "XMR": [...]}"""
-    conn = connect()
-    conn.execute("DELETE FROM wallets WHERE shop_id=?", (shop_id,))
-    rows = []
-    for coin, addrs in wallets.items():
-        for w in addrs:
-            rows.append((shop_id, coin, w["address"], w.get("type")))
-    if rows:
+    changes = []
+    if scan_id is not None:
+        def detail(k):
+            return json.dumps(dict(zip(cols, k + wanted[k])), ensure_ascii=False)
+        changes  = [(scan_id, shop_id, kind, "-", _item_key(k), None) for k in removed]
+        changes += [(scan_id, shop_id, kind, "+", _item_key(k), detail(k)) for k in added]
+        changes += [(scan_id, shop_id, kind, "~", _item_key(k), detail(k)) for k in modified]
+    return {
+        "delete":  [(current[k][0],) for k in removed] + dupes,
+        "insert":  [(shop_id, *k, *wanted[k]) for k in added],
+        "update":  [(*wanted[k], current[k][0]) for k in modified],
+        "changes": changes,
+        "n":       len(removed) + len(added) + len(modified),
+    }
+
+def _sync_children(conn, shop_id, kind, rows: list[dict], scan_id=None) -> int:
+    """
+    Aplica a la tabla hija solo las diferencias con su estado actual
+    (altas, bajas y filas modificadas) y, si hay scan_id, las registra en
+    scan_changes. Devuelve el número de cambios.
+    """
+    table, key_cols, det_cols = _CHILD_SPECS[kind]
+    cols = key_cols + det_cols
+    current = conn.execute(f"SELECT id,{','.join(cols)} FROM {table} WHERE shop_id=?",
+                           (shop_id,)).fetchall()
+    plan = _plan_children(shop_id, kind, current, rows, scan_id)
+    if plan["delete"]:
+        conn.executemany(f"DELETE FROM {table} WHERE id=?", plan["delete"])
+    if plan["insert"]:
+        conn.executemany(
+            f"INSERT INTO {table}(shop_id,{','.join(cols)}) VALUES (?{',?' * len(cols)})",
+            plan["insert"])
+    if plan["update"]:
+        conn.executemany(
+            f"UPDATE {table} SET {','.join(c + '=?' for c in det_cols)} WHERE id=?",
+            plan["update"])
+    if plan["changes"]:
         conn.executemany("""
-            INSERT INTO wallets(shop_id,coin,address,addr_type) VALUES (?,?,?,?)
-        """, rows)
-    conn.commit(); conn.close()
+            INSERT INTO scan_changes(scan_id,shop_id,kind,op,item,detail)
+            VALUES (?,?,?,?,?,?)
+        """, plan["changes"])
+    return plan["n"]
 
-def upsert_threat_intel(shop_id, ti: dict):
+# Normalización de las filas hijas a partir del resultado de scrape_one()
+# (compartida con los demás backends de collector.storage)
+
+def _tech_rows(tech_items) -> list[dict]:
+    return [{"name": t.get("name"), "category": t.get("category"), "version": t.get("version"),
+             "confidence": float(t.get("confidence",0.0) or 0.0), "source": t.get("source")}
+            for t in tech_items]
+
+def _keyword_rows(keywords) -> list[dict]:
+    return [{"keyword": k["keyword"], "category": k["category"], "severity": k["severity"],
+             "count": k.get("count",1)}
+            for k in keywords]
+
+def _tag_rows(tag_list) -> list[dict]:
+    return [{"tag": t} for t in set(tag_list)]
+
+def _wallet_rows(wallets: dict) -> list[dict]:
+    return [{"coin": coin, "address": w["address"], "addr_type": w.get("type")}
+            for coin, addrs in wallets.items() for w in addrs]
+
+def _threat_intel_row(shop_id, ti: dict) -> tuple:
     import json
-    conn = connect()
     vt = ti.get("virustotal") or {}
     uh_url = ti.get("urlhaus_url") or {}
+    return (
+        shop_id,
+        vt.get("malicious",0), vt.get("suspicious",0), vt.get("harmless",0),
+        json.dumps(vt.get("engines",[])[:10]),
+        1 if uh_url.get("found") else 0,
+        uh_url.get("status"), uh_url.get("threat"),
+        json.dumps(uh_url.get("tags",[])),
+        ti.get("external_risk","unknown"),
+        utc_now_iso(),
+    )
+
+def _write_tech(conn, shop_id, tech_items, scan_id=None):
+    return _sync_children(conn, shop_id, "tech", _tech_rows(tech_items), scan_id)
+
+def _write_screenshot(conn, shop_id, rel_path, width, height, ocr_text=None,
+                      sha256=None, phash=None, content_hash=None):
+    conn.execute("""
+        INSERT INTO screenshots(shop_id,path,width,height,ocr_text,sha256,phash,content_hash,created_at)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    """, (shop_id,rel_path,width,height,ocr_text,sha256,phash,content_hash,utc_now_iso()))
+
+def _write_keywords(conn, shop_id, keywords, scan_id=None):
+    return _sync_children(conn, shop_id, "keyword", _keyword_rows(keywords), scan_id)
+
+def _write_tags(conn, shop_id, tag_list, scan_id=None):
+    return _sync_children(conn, shop_id, "tag", _tag_rows(tag_list), scan_id)
+
+def _write_wallets(conn, shop_id, wallets: dict, scan_id=None):
+    return _sync_children(conn, shop_id, "wallet", _wallet_rows(wallets), scan_id)
+
+def _write_threat_intel(conn, shop_id, ti: dict):
     conn.execute("""
         INSERT INTO threat_intel(shop_id,vt_malicious,vt_suspicious,vt_harmless,
           vt_engines,uh_found,uh_status,uh_threat,uh_tags,external_risk,checked_at)
@@ -254,55 +1459,288 @@ def upsert_threat_intel(shop_id, ti: dict):
           uh_tags=excluded.uh_tags,
           external_risk=excluded.external_risk,
           checked_at=excluded.checked_at
-    """, (
-        shop_id,
-        vt.get("malicious",0), vt.get("suspicious",0), vt.get("harmless",0),
-        json.dumps(vt.get("engines",[])[:10]),
-        1 if uh_url.get("found") else 0,
-        uh_url.get("status"), uh_url.get("threat"),
-        json.dumps(uh_url.get("tags",[])),
-        ti.get("external_risk","unknown"),
-        utc_now_iso(),
-    ))
-    conn.commit(); conn.close()
+    """, _threat_intel_row(shop_id, ti))
 
-def log_alert(shop_id, channel, risk_level, sent, reason=None):
-    conn = connect()
+def _host_key(url: str) -> str:
+    """Host normalizado (minúsculas, sin esquema/puerto/ruta) sin pasar por urlparse."""
+    rest = url.split("://", 1)[-1]
+    return rest.split("/", 1)[0].split("?", 1)[0].split(":", 1)[0].lower()
+
+def _write_discovered_links(conn, source_id, links, risk_level=None):
+    """
+    Inserción masiva: un executemany para links, pares (link, fuente) por
+    lotes con RETURNING y un executemany para hosts.
+    times_seen (link y host) solo sube con una fuente nueva para el link:
+    re-escanear el mismo sitio actualiza last_seen, no la prioridad.
+    Un link archivado por la retención (quedan sus filas en link_sources) no
+    vuelve a la frontera.
+    risk_level: riesgo del sitio fuente; cada link guarda el máximo visto.
+    """
+    from collections import Counter
+    if not links:
+        return
+    now   = utc_now_iso()
+    risk  = FRONTIER_RISK.get(risk_level, FRONTIER_RISK_DEFAULT)
+    seen  = {lnk: _host_key(lnk) for lnk in links}     # dedup dentro del lote
+    conn.executemany("""
+        INSERT INTO discovered_links(source_id,url,domain,discovered_at,last_seen,times_seen,
+                                     source_risk)
+        SELECT :src, :url, :host, :now, :now, 0, :risk
+        WHERE EXISTS (SELECT 1 FROM discovered_links WHERE url=:url)
+           OR NOT EXISTS (SELECT 1 FROM link_sources WHERE url=:url)
+        ON CONFLICT(url) DO UPDATE SET
+          last_seen=excluded.last_seen,
+          source_risk=MAX(discovered_links.source_risk, excluded.source_risk)
+    """, [{"src": source_id, "url": lnk, "host": host, "now": now, "risk": risk}
+          for lnk, host in seen.items()])
+    pairs = [(lnk, source_id or 0, host, now) for lnk, host in seen.items()]
+    new   = []
+    for i in range(0, len(pairs), 200):
+        chunk = pairs[i:i + 200]
+        new += conn.execute(f"""
+            INSERT INTO link_sources(url,source_id,domain,first_seen)
+            VALUES {",".join("(?,?,?,?)" for _ in chunk)}
+            ON CONFLICT(url, source_id) DO NOTHING RETURNING url, domain
+        """, [v for row in chunk for v in row]).fetchall()
+    conn.executemany("UPDATE discovered_links SET times_seen=times_seen+1 WHERE url=?",
+                     [(r["url"],) for r in new])
+    fresh = Counter(r["domain"] for r in new)
+    conn.executemany("""
+        INSERT INTO discovered_hosts(host,first_seen,last_seen,times_seen)
+        VALUES (?,?,?,?)
+        ON CONFLICT(host) DO UPDATE SET
+          times_seen=discovered_hosts.times_seen+excluded.times_seen,
+          last_seen=excluded.last_seen
+    """, [(h, now, now, fresh[h]) for h in set(seen.values())])
+
+def _write_alert(conn, shop_id, channel, risk_level, sent, reason=None):
     conn.execute("""
         INSERT INTO alert_log(shop_id,channel,risk_level,sent,reason,sent_at)
         VALUES (?,?,?,?,?,?)
     """, (shop_id,channel,risk_level,1 if sent else 0,reason,utc_now_iso()))
+
+def _write_rescan(conn, shop_id, url, status, detail):
+    conn.execute("""
+        INSERT INTO rescan_log(shop_id, url, status, detail, ran_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (shop_id, url, status, str(detail)[:500], utc_now_iso()))
+
+def _mark_scanned(conn, link_id):
+    """Link escaneado: sale de la frontera y su host pierde novedad."""
+    if conn.execute("UPDATE discovered_links SET scanned=1 WHERE id=? AND scanned=0",
+                    (link_id,)).rowcount:
+        conn.execute("""
+            UPDATE discovered_hosts SET crawled=crawled+1
+            WHERE host=(SELECT domain FROM discovered_links WHERE id=?)
+        """, (link_id,))
+
+def _write_host_ranks(conn, ranks: list[tuple[str, float]], min_delta: float = 0.01) -> int:
+    """
+    Guarda link_rank por host. Solo se escriben los que cambian más de
+    min_delta: cada cambio re-puntúa (trigger) los links pendientes del host.
+    """
+    n = 0
+    for host, rank in ranks:
+        n += conn.execute("""
+            UPDATE discovered_hosts SET link_rank=?
+            WHERE host=? AND ABS(COALESCE(link_rank,0) - ?) > ?
+        """, (rank, host, rank, min_delta)).rowcount
+    return n
+
+def _mark_failed(conn, link_id):
+    """Escaneo fallido: baja su prioridad; tras FRONTIER_MAX_FAILURES se abandona."""
+    conn.execute("""
+        UPDATE discovered_links SET failures=failures+1,
+               scanned=CASE WHEN failures+1 >= ? THEN 1 ELSE scanned END
+        WHERE id=? AND scanned=0
+    """, (FRONTIER_MAX_FAILURES, link_id))
+
+def _unlink_sources(conn, where: str, params=()):
+    """
+    Con discovered_links en scrs_frontier.db no hay FK ON DELETE SET NULL:
+    se replica a mano antes de borrar los sitios que cumplen `where`.
+    """
+    if table_schema("discovered_links") != "main":
+        conn.execute(f"""
+            UPDATE discovered_links SET source_id=NULL
+            WHERE source_id IN (SELECT id FROM shops WHERE {where})
+        """, params)
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  SHOPS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def upsert_shop(url, domain, title, status, risk_score=0.0, risk_level="unknown",
+                external_risk="unknown", content_hash=None, language=None, notes=None):
+    conn = connect()
+    sid = _write_shop(conn, url, domain, title, status, risk_score, risk_level,
+                      external_risk, content_hash, language, notes)
     conn.commit(); conn.close()
+    return sid
 
-def add_discovered_links(source_id, links):
-    from urllib.parse import urlparse
+def replace_tech(shop_id, tech_items):
     conn = connect()
-    now = utc_now_iso()
-    for lnk in links:
-        domain = urlparse(lnk).netloc
-        try:
-            conn.execute("""
-                INSERT OR IGNORE INTO discovered_links(source_id,url,domain,discovered_at)
-                VALUES (?,?,?,?)
-            """, (source_id,lnk,domain,now))
-        except Exception:
-            pass
+    _write_tech(conn, shop_id, tech_items)
+    conn.commit(); conn.close()
+
+def add_screenshot(shop_id, rel_path, width, height, ocr_text=None, sha256=None, phash=None,
+                   content_hash=None):
+    conn = connect()
+    _write_screenshot(conn, shop_id, rel_path, width, height, ocr_text, sha256, phash, content_hash)
+    conn.commit(); conn.close()
+
+def last_screenshot(url) -> dict | None:
+    """Última captura guardada del sitio (path, sha256, phash, content_hash) para descartar duplicados."""
+    conn = connect()
+    row = conn.execute("""
+        SELECT sc.path, sc.sha256, sc.phash, sc.content_hash FROM screenshots sc
+        JOIN shops s ON s.id=sc.shop_id
+        WHERE s.url=? ORDER BY sc.created_at DESC, sc.id DESC LIMIT 1
+    """, (url,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def referenced_screenshots(paths) -> set[str]:
+    """Subconjunto de `paths` que aún referencia alguna fila de screenshots."""
+    paths = list(paths)
+    found = set()
+    conn = connect()
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        found.update(r["path"] for r in conn.execute(
+            f"SELECT DISTINCT path FROM screenshots WHERE path IN ({','.join('?' * len(chunk))})",
+            chunk).fetchall())
+    conn.close()
+    return found
+
+def _shot_paths(conn, where: str, params=()) -> list[str]:
+    return [r["path"] for r in conn.execute(f"""
+        SELECT DISTINCT path FROM screenshots
+        WHERE shop_id IN (SELECT id FROM shops WHERE {where})
+    """, params).fetchall()]
+
+def replace_keywords(shop_id, keywords):
+    conn = connect()
+    _write_keywords(conn, shop_id, keywords)
     conn.commit(); conn.close()
 
+def replace_tags(shop_id, tag_list):
+    conn = connect()
+    _write_tags(conn, shop_id, tag_list)
+    conn.commit(); conn.close()
+
+def replace_wallets(shop_id, wallets: dict):
+    """wallets: {"BTC": [{"address":..., "type":...}], "XMR": [...]}"""
+    conn = connect()
+    _write_wallets(conn, shop_id, wallets)
+    conn.commit(); conn.close()
+
+def upsert_threat_intel(shop_id, ti: dict):
+    conn = connect()
+    _write_threat_intel(conn, shop_id, ti)
+    conn.commit(); conn.close()
+
+def log_alert(shop_id, channel, risk_level, sent, reason=None):
+    conn = connect_table("alert_log")
+    _write_alert(conn, shop_id, channel, risk_level, sent, reason)
+    conn.commit(); conn.close()
+
+def add_discovered_links(source_id, links, risk_level=None):
+    conn = connect_table("discovered_links")
+    _write_discovered_links(conn, source_id, links, risk_level)
+    conn.commit(); conn.close()
+
+def write_scan_result(conn, data: dict, threat_intel: bool = True,
+                      links: bool = True) -> tuple[int, bool]:
+    """
+    Escribe un resultado de scrape_one() sobre una conexión ya en transacción (sin commit).
+    Lo usan persist_scan_result() y el writer por lotes (collector.writer).
+    links=False deja los onion_links para el escritor de scrs_frontier.db.
+    """
+    threat = data.get("threat", {})
+    ti     = data.get("threat_intel") or {}
+    prev = conn.execute("SELECT content_hash FROM shops WHERE url=?",
+                        (data["url"],)).fetchone()
+    sid = _write_shop(
+        conn, url=data["url"], domain=data.get("domain"),
+        title=data.get("title"), status="ok",
+        risk_score=threat.get("risk_score", 0),
+        risk_level=threat.get("risk_level", "unknown"),
+        external_risk=ti.get("external_risk", "unknown"),
+        content_hash=data.get("content_hash"),
+        language=data.get("language"),
+    )
+    scan_id = conn.execute("""
+        INSERT INTO scans(shop_id,scanned_at,status,title,risk_level,risk_score,content_hash)
+        VALUES (?,?,?,?,?,?,?)
+    """, (sid, utc_now_iso(), "ok", data.get("title"), threat.get("risk_level", "unknown"),
+          threat.get("risk_score", 0), data.get("content_hash"))).lastrowid
+    n_changes  = _write_tech(conn, sid, data.get("tech", []), scan_id)
+    n_changes += _write_keywords(conn, sid, threat.get("keywords", []), scan_id)
+    n_changes += _write_tags(conn, sid, threat.get("tags", []), scan_id)
+    n_changes += _write_wallets(conn, sid, data.get("wallets", {}), scan_id)
+    conn.execute("UPDATE scans SET changes=? WHERE id=?", (n_changes, scan_id))
+    if threat_intel and ti:
+        _write_threat_intel(conn, sid, ti)
+    sc = data.get("screenshot") or {}
+    if sc.get("path"):
+        _write_screenshot(conn, sid, sc["path"], sc.get("width"), sc.get("height"),
+                          (data.get("ocr") or {}).get("text") or None,
+                          sc.get("sha256"), sc.get("phash"), sc.get("content_hash"))
+    if links and data.get("onion_links"):
+        _write_discovered_links(conn, sid, data["onion_links"], threat.get("risk_level"))
+    _write_search_text(conn, sid, data.get("text"))
+    changed = prev is None or prev["content_hash"] != data.get("content_hash")
+    return sid, changed
+
+def persist_scan_result(data: dict, threat_intel: bool = True) -> tuple[int, bool]:
+    """
+    Guarda un resultado de scrape_one() — sitio + tech, keywords, tags, wallets,
+    threat intel, screenshot y links — en UNA sola transacción (un fsync).
+    threat_intel: si False no toca la fila de threat_intel existente.
+    Devuelve (shop_id, changed): changed=True si el sitio es nuevo o cambió su contenido.
+    Con SQLITE_SPLIT_HOT los links van después, en su propia transacción.
+    """
+    split = table_schema("discovered_links") != "main"
+    conn  = connect_file()
+    try:
+        # IMMEDIATE: toma el lock de escritura al principio, sin upgrade a mitad
+        conn.execute("BEGIN IMMEDIATE")
+        result = write_scan_result(conn, data, threat_intel, links=not split)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if split and data.get("onion_links"):
+        add_discovered_links(result[0], data["onion_links"],
+                             data.get("threat", {}).get("risk_level"))
+    return result
+
 def get_pending_discovered(limit=50):
+    """Los `limit` links pendientes de mayor prioridad (recorre idx_disc_frontier, sin sort)."""
     conn = connect()
     rows = conn.execute("""
-        SELECT id,url FROM discovered_links WHERE scanned=0
-        ORDER BY discovered_at ASC LIMIT ?
+        SELECT id, url, domain, priority, source_risk, times_seen, failures
+        FROM discovered_links WHERE scanned=0
+        ORDER BY priority DESC, id LIMIT ?
     """, (limit,)).fetchall()
     conn.close(); return rows
 
 def mark_discovered_scanned(link_id):
-    conn = connect()
-    conn.execute("UPDATE discovered_links SET scanned=1 WHERE id=?", (link_id,))
+    conn = connect_table("discovered_links")
+    _mark_scanned(conn, link_id)
+    conn.commit(); conn.close()
+
+def mark_discovered_failed(link_id):
+    conn = connect_table("discovered_links")
+    _mark_failed(conn, link_id)
     conn.commit(); conn.close()
 
 def list_shops(limit=50, q="", risk_level=""):
+    if q:
+        return search_shops(q, limit=limit, risk_level=risk_level)
     conn = connect()
     sql = """
       SELECT id,url,domain,title,detected_at,last_scanned,
@@ -310,10 +1748,6 @@ def list_shops(limit=50, q="", risk_level=""):
       FROM shops WHERE 1=1
     """
     params = []
-    if q:
-        like = f"%{q}%"
-        sql += " AND (url LIKE ? OR domain LIKE ? OR title LIKE ?)"
-        params += [like,like,like]
     if risk_level:
         sql += " AND risk_level=?"; params.append(risk_level)
     sql += " ORDER BY detected_at DESC LIMIT ?"; params.append(limit)
@@ -321,9 +1755,14 @@ def list_shops(limit=50, q="", risk_level=""):
     conn.close(); return rows
 
 def delete_shop_by_id(shop_id):
+    from collector.shotstore import release
     conn = connect()
+    _unlink_sources(conn, "id=?", (shop_id,))
+    paths = _shot_paths(conn, "id=?", (shop_id,))
     cur = conn.execute("DELETE FROM shops WHERE id=?", (shop_id,))
-    conn.commit(); conn.close(); return cur.rowcount
+    conn.commit(); conn.close()
+    release(paths)      # ficheros que solo usaba este sitio
+    return cur.rowcount
 
 def delete_shop_by_url(url):
     conn = connect()
@@ -333,40 +1772,559 @@ def delete_shop_by_url(url):
     return delete_shop_by_id(int(row["id"]))
 
 def get_stats():
+    """Lee los contadores materializados (stat_*): coste constante."""
     conn = connect()
-    s = {}
-    s["total"]    = conn.execute("SELECT COUNT(*) FROM shops").fetchone()[0]
-    s["ok"]       = conn.execute("SELECT COUNT(*) FROM shops WHERE status='ok'").fetchone()[0]
-    s["errors"]   = conn.execute("SELECT COUNT(*) FROM shops WHERE status='error'").fetchone()[0]
-    s["critical"] = conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='critical'").fetchone()[0]
-    s["high"]     = conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='high'").fetchone()[0]
-    s["medium"]   = conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='medium'").fetchone()[0]
-    s["low"]      = conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='low'").fetchone()[0]
-    s["clean"]    = conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='clean'").fetchone()[0]
-    s["pending_links"] = conn.execute("SELECT COUNT(*) FROM discovered_links WHERE scanned=0").fetchone()[0]
-    s["total_links"]   = conn.execute("SELECT COUNT(*) FROM discovered_links").fetchone()[0]
-    s["wallets_total"] = conn.execute("SELECT COUNT(*) FROM wallets").fetchone()[0]
-    s["top_threats"]   = [dict(r) for r in conn.execute("""
-        SELECT category,COUNT(*) AS c FROM threat_keywords
-        GROUP BY category ORDER BY c DESC LIMIT 8
+    # cada fichero separado guarda los contadores de sus tablas
+    parts = " UNION ALL ".join(f"SELECT name, value FROM {db}.stat_counters"
+                               for db in ["main"] + _attached(conn))
+    c = {r["name"]: r["value"] for r in conn.execute(
+        f"SELECT name, SUM(value) AS value FROM ({parts}) GROUP BY name").fetchall()}
+    s = {
+        "total":         c.get("shops", 0),
+        "ok":            c.get("status:ok", 0),
+        "errors":        c.get("status:error", 0),
+        "critical":      c.get("risk:critical", 0),
+        "high":          c.get("risk:high", 0),
+        "medium":        c.get("risk:medium", 0),
+        "low":           c.get("risk:low", 0),
+        "clean":         c.get("risk:clean", 0),
+        "pending_links": c.get("links:pending", 0),
+        # totales históricos: lo que hay en la DB + lo ya archivado
+        "total_links":   c.get("links", 0) + c.get("archived:links", 0),
+        "wallets_total": c.get("wallets", 0),
+        "alerts_sent":   c.get("alerts:sent", 0) + c.get("archived:alerts:sent", 0),
+    }
+    s["top_threats"] = [dict(r) for r in conn.execute("""
+        SELECT key AS category, c FROM stat_groups
+        WHERE kind='threat_category' AND c>0 ORDER BY c DESC LIMIT 8
     """).fetchall()]
     s["top_coins"] = [dict(r) for r in conn.execute("""
-        SELECT coin,COUNT(DISTINCT address) AS c FROM wallets
-        GROUP BY coin ORDER BY c DESC
+        SELECT key AS coin, c FROM stat_groups
+        WHERE kind='coin' AND c>0 ORDER BY c DESC
     """).fetchall()]
-    s["alerts_sent"] = conn.execute("SELECT COUNT(*) FROM alert_log WHERE sent=1").fetchone()[0]
     conn.close(); return s
 
-def export_all_json():
+def delete_error_shops() -> int:
+    from collector.shotstore import release
     conn = connect()
-    shops = [dict(r) for r in conn.execute("SELECT * FROM shops ORDER BY risk_score DESC").fetchall()]
-    for s in shops:
-        sid = s["id"]
-        s["tech"]     = [dict(r) for r in conn.execute("SELECT name,category,version,confidence FROM tech WHERE shop_id=?", (sid,)).fetchall()]
-        s["keywords"] = [dict(r) for r in conn.execute("SELECT keyword,category,severity,count FROM threat_keywords WHERE shop_id=?", (sid,)).fetchall()]
-        s["tags"]     = [r["tag"] for r in conn.execute("SELECT tag FROM tags WHERE shop_id=?", (sid,)).fetchall()]
-        s["wallets"]  = [dict(r) for r in conn.execute("SELECT coin,address,addr_type FROM wallets WHERE shop_id=?", (sid,)).fetchall()]
-        s["screenshots"] = [r["path"] for r in conn.execute("SELECT path FROM screenshots WHERE shop_id=? ORDER BY created_at DESC", (sid,)).fetchall()]
-        ti = conn.execute("SELECT * FROM threat_intel WHERE shop_id=?", (sid,)).fetchone()
-        s["threat_intel"] = dict(ti) if ti else {}
-    conn.close(); return shops
+    _unlink_sources(conn, "status='error'")
+    paths = _shot_paths(conn, "status='error'")
+    cur = conn.execute("DELETE FROM shops WHERE status='error'")
+    conn.commit(); conn.close()
+    release(paths)
+    return cur.rowcount
+
+def log_rescan(shop_id, url, status, detail):
+    conn = connect_table("rescan_log")
+    _write_rescan(conn, shop_id, url, status, detail)
+    conn.commit(); conn.close()
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  RESCAN QUEUE — shops.next_scan_at como cola de prioridad por fecha
+# ─────────────────────────────────────────────────────────────────────────────
+
+def set_next_scan(shop_id, next_at: str | None, interval_h: float | None = None) -> int:
+    """
+    Programa (ISO UTC) o desprograma (None) el siguiente re-escaneo de un sitio.
+    interval_h: intervalo adaptado que se guarda para las siguientes pasadas.
+    """
+    conn = connect_file()
+    cur = conn.execute("""
+        UPDATE shops SET next_scan_at=?, rescan_interval_h=COALESCE(?, rescan_interval_h)
+        WHERE id=?
+    """, (next_at, interval_h, shop_id))
+    conn.commit(); conn.close(); return cur.rowcount
+
+def claim_due_rescans(limit: int, intervals: dict, default_h: float = 48,
+                      jitter: float = 0.0, now: datetime | None = None) -> list[dict]:
+    """
+    Saca de la cola hasta `limit` sitios vencidos (los más atrasados primero)
+    y les fija ya la siguiente pasada: now + su intervalo adaptado (o el de su
+    riesgo si aún no tiene), ±jitter para que un atasco no vuelva a vencer
+    todo a la vez. El re-escaneo la recalcula al terminar.
+    Con BEGIN IMMEDIATE dos procesos nunca reclaman el mismo sitio, y un
+    sitio atrasado varias veces se escanea una sola (coalesce).
+    """
+    now     = now or datetime.now(timezone.utc)
+    now_iso = now.isoformat(timespec="seconds")
+    conn = connect_file()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = [dict(r) for r in conn.execute("""
+            SELECT id, url, risk_level, next_scan_at, rescan_interval_h FROM shops
+            WHERE next_scan_at <= ? ORDER BY next_scan_at LIMIT ?
+        """, (now_iso, limit)).fetchall()]
+        conn.executemany("UPDATE shops SET next_scan_at=? WHERE id=?", [
+            ((now + timedelta(hours=(r["rescan_interval_h"]
+                                     or intervals.get(r["risk_level"], default_h))
+                              * (1 + random.uniform(-jitter, jitter))))
+             .isoformat(timespec="seconds"), r["id"]) for r in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return rows
+
+def get_change_history(shop_id, limit=10) -> list[dict]:
+    """Últimos escaneos (más reciente primero): solo fecha y content_hash."""
+    conn = connect()
+    rows = conn.execute("""
+        SELECT scanned_at, content_hash FROM scans
+        WHERE shop_id=? ORDER BY id DESC LIMIT ?
+    """, (shop_id, limit)).fetchall()
+    conn.close(); return [dict(r) for r in rows]
+
+def rescan_load() -> list[dict]:
+    """
+    Sitios programados por riesgo: cuántos, cuántos sin intervalo propio y la
+    suma de 24/intervalo (re-escaneos diarios) de los que sí lo tienen.
+    """
+    conn = connect()
+    rows = conn.execute("""
+        SELECT risk_level, COUNT(*) AS shops,
+               SUM(rescan_interval_h IS NULL) AS unset,
+               COALESCE(SUM(24.0 / rescan_interval_h), 0) AS daily
+        FROM shops WHERE next_scan_at IS NOT NULL GROUP BY risk_level
+    """).fetchall()
+    conn.close(); return [dict(r) for r in rows]
+
+def rescan_queue(limit=50) -> list[dict]:
+    """Próximos re-escaneos por orden de vencimiento."""
+    conn = connect()
+    rows = conn.execute("""
+        SELECT id, url, risk_level, next_scan_at, rescan_interval_h FROM shops
+        WHERE next_scan_at IS NOT NULL ORDER BY next_scan_at LIMIT ?
+    """, (limit,)).fetchall()
+    conn.close(); return [dict(r) for r in rows]
+
+def rescan_queue_counts() -> dict:
+    """Programados, vencidos y vencimiento más antiguo; recorre solo el índice parcial."""
+    conn = connect()
+    row = conn.execute("""
+        SELECT COUNT(*) AS scheduled, COALESCE(SUM(next_scan_at <= ?), 0) AS due,
+               MIN(next_scan_at) AS oldest_due
+        FROM shops WHERE next_scan_at IS NOT NULL
+    """, (utc_now_iso(),)).fetchone()
+    conn.close(); return dict(row)
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  LINK GRAPH — aristas sitio→link para collector.linkgraph
+# ─────────────────────────────────────────────────────────────────────────────
+
+def iter_link_edges(after_id: int = 0, batch: int = 50000):
+    """
+    (id, url del sitio fuente, host destino) de los pares de link_sources con
+    id > after_id, en orden de id y por lotes: cada sitio que enlazó cada link,
+    incluidos los links ya archivados por la retención.
+    """
+    conn = connect()
+    last = after_id
+    while True:
+        rows = conn.execute("""
+            SELECT l.id, s.url AS source_url, l.domain AS target
+            FROM link_sources l JOIN shops s ON s.id = l.source_id
+            WHERE l.id > ? AND l.domain IS NOT NULL ORDER BY l.id LIMIT ?
+        """, (last, batch)).fetchall()
+        if not rows:
+            break
+        for r in rows:
+            yield r["id"], r["source_url"], r["target"]
+        last = rows[-1]["id"]
+    conn.close()
+
+def max_link_id() -> int:
+    conn = connect()
+    n = conn.execute("SELECT COALESCE(MAX(id),0) FROM link_sources").fetchone()[0]
+    conn.close(); return n
+
+def get_host_ranks() -> dict[str, float]:
+    """link_rank > 0 escrito en la DB, por host (punto de partida de LinkGraph.push_ranks)."""
+    conn = connect()
+    rows = conn.execute("SELECT host, link_rank FROM discovered_hosts WHERE link_rank > 0").fetchall()
+    conn.close(); return {r["host"]: r["link_rank"] for r in rows}
+
+def set_host_ranks(ranks: list[tuple[str, float]], min_delta: float = 0.01) -> int:
+    conn = connect_table("discovered_hosts")
+    n = _write_host_ranks(conn, ranks, min_delta)
+    conn.commit(); conn.close(); return n
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  WORK QUEUE — trabajos con lease (visibility timeout) para collector.worker
+#  Todas las escrituras van por connect_file() con BEGIN IMMEDIATE: la
+#  reclamación es atómica entre procesos que comparten scrs.db.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _iso_in(seconds: float, now: datetime | None = None) -> str:
+    return ((now or datetime.now(timezone.utc)) + timedelta(seconds=seconds)).isoformat(timespec="seconds")
+
+def enqueue_work(items: list[dict]) -> int:
+    """
+    Encola trabajos {kind, target, payload?, priority?, max_attempts?, delay_s?}.
+    Los objetivos que ya están en cola o en curso se ignoran. Devuelve los añadidos.
+    """
+    import json
+    now  = utc_now_iso()
+    conn = connect_file()
+    n = 0
+    for it in items:
+        n += conn.execute("""
+            INSERT OR IGNORE INTO work_queue(kind,target,payload,priority,max_attempts,
+                                             available_at,enqueued_at)
+            VALUES (?,?,?,?,?,?,?)
+        """, (it["kind"], it["target"],
+              json.dumps(it["payload"]) if it.get("payload") is not None else None,
+              it.get("priority", 0), it.get("max_attempts", 3),
+              _iso_in(it.get("delay_s", 0)), now)).rowcount
+    conn.commit(); conn.close(); return n
+
+def claim_work(worker: str, limit: int, lease_s: float) -> list[dict]:
+    """
+    Reclama hasta `limit` trabajos listos (prioridad, luego antigüedad) para
+    `worker` durante lease_s segundos. Antes devuelve a la cola los leases
+    vencidos (worker caído) o los da por fallidos si agotaron sus intentos.
+    """
+    import json
+    now  = datetime.now(timezone.utc)
+    iso  = now.isoformat(timespec="seconds")
+    conn = connect_file()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            UPDATE work_queue SET status='failed', finished_at=?, lease_owner=NULL,
+                   last_error=COALESCE(last_error, 'lease expired')
+            WHERE status='leased' AND lease_until < ? AND attempts >= max_attempts
+        """, (iso, iso))
+        conn.execute("""
+            UPDATE work_queue SET status='queued', lease_owner=NULL, lease_until=NULL
+            WHERE status='leased' AND lease_until < ?
+        """, (iso,))
+        rows = [dict(r) for r in conn.execute("""
+            SELECT id, kind, target, payload, priority, attempts, max_attempts, enqueued_at
+            FROM work_queue WHERE status='queued' AND available_at <= ?
+            ORDER BY priority DESC, available_at LIMIT ?
+        """, (iso, limit)).fetchall()]
+        until = _iso_in(lease_s, now)
+        conn.executemany("""
+            UPDATE work_queue SET status='leased', lease_owner=?, lease_until=?,
+                   heartbeat_at=?, attempts=attempts+1
+            WHERE id=?
+        """, [(worker, until, iso, r["id"]) for r in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    for r in rows:
+        r["attempts"] += 1
+        r["payload"] = json.loads(r["payload"]) if r["payload"] else {}
+    return rows
+
+def heartbeat_work(worker: str, ids: list[int], lease_s: float) -> list[int]:
+    """Prolonga los leases de `worker`; devuelve los ids que sigue teniendo."""
+    if not ids:
+        return []
+    now  = datetime.now(timezone.utc)
+    marks = ",".join("?" * len(ids))
+    conn = connect_file()
+    conn.execute(f"""
+        UPDATE work_queue SET lease_until=?, heartbeat_at=?
+        WHERE id IN ({marks}) AND lease_owner=? AND status='leased'
+    """, (_iso_in(lease_s, now), now.isoformat(timespec="seconds"), *ids, worker))
+    held = [r[0] for r in conn.execute(f"""
+        SELECT id FROM work_queue WHERE id IN ({marks}) AND lease_owner=? AND status='leased'
+    """, (*ids, worker)).fetchall()]
+    conn.commit(); conn.close(); return held
+
+def complete_work(worker: str, job_id: int, result=None) -> bool:
+    """Cierra un trabajo; False si el lease ya no era de `worker` (lo reclamó otro)."""
+    import json
+    conn = connect_file()
+    cur = conn.execute("""
+        UPDATE work_queue SET status='done', finished_at=?, lease_owner=NULL,
+               lease_until=NULL, result=?
+        WHERE id=? AND lease_owner=? AND status='leased'
+    """, (utc_now_iso(), json.dumps(result) if result is not None else None, job_id, worker))
+    conn.commit(); conn.close(); return cur.rowcount > 0
+
+def fail_work(worker: str, job_id: int, error: str, retry_s: float) -> str | None:
+    """
+    Registra un fallo: vuelve a la cola tras retry_s·2^(intentos-1) o queda
+    'failed' si agotó max_attempts. Devuelve el nuevo status (None si el lease
+    ya no era de `worker`). Un solo UPDATE condicionado al lease: entre leer
+    los intentos y escribir no puede colarse otro worker.
+    """
+    now  = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    conn = connect_file()
+    row = conn.execute("""
+        UPDATE work_queue SET
+               status       = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+               available_at = CASE WHEN attempts >= max_attempts THEN available_at
+                              ELSE strftime('%Y-%m-%dT%H:%M:%S', :now,
+                                            '+' || (:retry * (1 << (attempts - 1))) || ' seconds')
+                                   || '+00:00' END,
+               finished_at  = CASE WHEN attempts >= max_attempts THEN :now END,
+               lease_owner = NULL, lease_until = NULL, last_error = :error
+        WHERE id=:id AND lease_owner=:worker AND status='leased'
+        RETURNING status
+    """, {"now": now, "retry": float(retry_s), "error": (error or "")[:500],
+          "id": job_id, "worker": worker}).fetchone()
+    conn.commit(); conn.close()
+    return row["status"] if row else None
+
+def work_queue_counts() -> dict:
+    """Trabajos por status y cuántos de los 'queued' ya están listos."""
+    conn = connect()
+    counts = {r["status"]: r["n"] for r in conn.execute(
+        "SELECT status, COUNT(*) AS n FROM work_queue GROUP BY status").fetchall()}
+    ready = conn.execute("SELECT COUNT(*) FROM work_queue WHERE status='queued' AND available_at <= ?",
+                         (utc_now_iso(),)).fetchone()[0]
+    conn.close()
+    return {"queued": counts.get("queued", 0), "ready": ready, "leased": counts.get("leased", 0),
+            "done": counts.get("done", 0), "failed": counts.get("failed", 0)}
+
+def work_queue_workers() -> list[dict]:
+    """Workers con leases vivos: trabajos en curso y último heartbeat."""
+    conn = connect()
+    rows = conn.execute("""
+        SELECT lease_owner AS worker, COUNT(*) AS leased, MAX(heartbeat_at) AS last_heartbeat,
+               MIN(lease_until) AS next_expiry
+        FROM work_queue WHERE status='leased' GROUP BY lease_owner ORDER BY lease_owner
+    """).fetchall()
+    conn.close(); return [dict(r) for r in rows]
+
+def list_work(status="", limit=50) -> list[dict]:
+    conn = connect()
+    where = "WHERE status=?" if status else ""
+    rows = conn.execute(f"""
+        SELECT id, kind, target, priority, status, attempts, max_attempts, available_at,
+               lease_owner, lease_until, enqueued_at, finished_at, last_error
+        FROM work_queue {where} ORDER BY id DESC LIMIT ?
+    """, ((status,) if status else ()) + (limit,)).fetchall()
+    conn.close(); return [dict(r) for r in rows]
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  DASHBOARD — listados y detalle que sirve dashboard/app.py
+# ─────────────────────────────────────────────────────────────────────────────
+
+def list_dashboard_shops(q="", tech="", risk="", ext_risk="", limit=500) -> list[dict]:
+    """Tarjetas del índice: última captura y, si hay búsqueda, título resaltado + snippet."""
+    conn = connect()
+    fts = bool(q) and fts_available(conn) and bool(fts_query(q))
+    sql = f"""
+        SELECT s.*,
+               (SELECT path FROM screenshots WHERE shop_id=s.id
+                ORDER BY created_at DESC LIMIT 1) AS screenshot
+               {", f.title_hl, f.snippet" if fts else ""}
+        FROM shops s
+        {f"JOIN (SELECT rowid AS fid, {SEARCH_COLUMNS} FROM search_fts WHERE search_fts MATCH ?) f ON f.fid=s.id" if fts else ""}
+        WHERE 1=1
+    """
+    params = [fts_query(q)] if fts else []
+    if q and not fts:
+        like = f"%{q}%"
+        sql += " AND (s.url LIKE ? OR s.domain LIKE ? OR s.title LIKE ?)"
+        params += [like, like, like]
+    if risk:     sql += " AND s.risk_level=?";   params.append(risk)
+    if ext_risk: sql += " AND s.external_risk=?"; params.append(ext_risk)
+    if tech:
+        sql += " AND EXISTS (SELECT 1 FROM tech t WHERE t.shop_id=s.id AND t.name=?)"
+        params.append(tech)
+    sql += (" ORDER BY f.rank" if fts else " ORDER BY s.risk_score DESC, s.detected_at DESC") + " LIMIT ?"
+    params.append(limit)
+    rows = [dict(r) for r in conn.execute(sql, params).fetchall()]
+    if fts:
+        for r in rows:
+            r["title_hl"] = render_highlight(r["title_hl"])
+            r["snippet"]  = render_highlight(r["snippet"])
+    conn.close(); return rows
+
+def list_manage_shops(q="", risk="", limit=200) -> list[dict]:
+    conn = connect()
+    fts = bool(q) and fts_available(conn) and bool(fts_query(q))
+    sql = "SELECT id,url,domain,title,risk_level,risk_score,status,detected_at,scan_count FROM shops WHERE 1=1"
+    params = []
+    if fts:
+        sql = ("SELECT s.id,s.url,s.domain,s.title,s.risk_level,s.risk_score,s.status,"
+               "s.detected_at,s.scan_count FROM search_fts JOIN shops s ON s.id=search_fts.rowid "
+               "WHERE search_fts MATCH ?")
+        params.append(fts_query(q))
+    elif q:
+        like = f"%{q}%"
+        sql += " AND (url LIKE ? OR domain LIKE ? OR title LIKE ?)"
+        params += [like, like, like]
+    if risk: sql += " AND risk_level=?"; params.append(risk)
+    sql += " ORDER BY search_fts.rank LIMIT ?" if fts else " ORDER BY detected_at DESC LIMIT ?"
+    params.append(limit)
+    rows = [dict(r) for r in conn.execute(sql, params).fetchall()]
+    conn.close(); return rows
+
+def tech_counts(limit=60) -> list[dict]:
+    conn = connect()
+    rows = [dict(r) for r in conn.execute(
+        "SELECT name, COUNT(*) AS c FROM tech GROUP BY name ORDER BY c DESC LIMIT ?", (limit,)
+    ).fetchall()]
+    conn.close(); return rows
+
+def get_shop_detail(shop_id) -> dict | None:
+    """Ficha completa de un sitio (sin historial ni relacionados), o None si no existe."""
+    conn = connect()
+    shop = conn.execute("SELECT * FROM shops WHERE id=?", (shop_id,)).fetchone()
+    if not shop:
+        conn.close(); return None
+    def rows(sql):
+        return [dict(r) for r in conn.execute(sql, (shop_id,)).fetchall()]
+    ti = conn.execute("SELECT * FROM threat_intel WHERE shop_id=?", (shop_id,)).fetchone()
+    d = {
+        "shop": dict(shop),
+        "tech": rows("""
+            SELECT name, category, version, confidence, source FROM tech
+            WHERE shop_id=? ORDER BY confidence DESC, name
+        """),
+        "screenshots": rows("""
+            SELECT path, created_at, ocr_text FROM screenshots
+            WHERE shop_id=? ORDER BY created_at DESC LIMIT 10
+        """),
+        "keywords": rows("""
+            SELECT keyword, category, severity, count FROM threat_keywords
+            WHERE shop_id=? ORDER BY
+              CASE severity WHEN 'critical' THEN 1 WHEN 'high' THEN 2
+              WHEN 'medium' THEN 3 ELSE 4 END, count DESC
+        """),
+        "tags": [r["tag"] for r in rows("SELECT tag FROM tags WHERE shop_id=?")],
+        "links": rows("""
+            SELECT url, domain, discovered_at, scanned FROM discovered_links
+            WHERE source_id=? ORDER BY discovered_at DESC LIMIT 100
+        """),
+        "wallets": rows("""
+            SELECT coin, address, addr_type FROM wallets
+            WHERE shop_id=? ORDER BY coin, address
+        """),
+        "threat_intel": dict(ti) if ti else {},
+        "alerts": rows("""
+            SELECT channel, risk_level, sent, reason, sent_at FROM alert_log
+            WHERE shop_id=? ORDER BY sent_at DESC LIMIT 10
+        """),
+    }
+    conn.close(); return d
+
+def list_wallets(coin="", q="", limit=500) -> list[dict]:
+    """Wallets con su sitio y nº de sitios que comparten la dirección; q = prefijo."""
+    conn = connect()
+    sql = """
+        SELECT w.coin, w.address, w.addr_type,
+               s.id AS shop_id, s.domain, s.title, s.risk_level,
+               COALESCE(r.refs, 1) AS shared
+        FROM wallets w JOIN shops s ON w.shop_id=s.id
+        LEFT JOIN stat_wallet_refs r ON r.coin=w.coin AND r.address=w.address
+        WHERE 1=1
+    """
+    params = []
+    if coin: sql += " AND w.coin=?"; params.append(coin.upper())
+    if q:
+        # Búsqueda por prefijo: rangos sobre idx_wallets_address / idx_shops_domain
+        q = q.strip()
+        sql += " AND ((w.address>=? AND w.address<?) OR (s.domain>=? AND s.domain<?))"
+        params += [q, q + "\U0010ffff", q.lower(), q.lower() + "\U0010ffff"]
+    sql += " ORDER BY s.risk_score DESC LIMIT ?"; params.append(limit)
+    rows = [dict(r) for r in conn.execute(sql, params).fetchall()]
+    conn.close(); return rows
+
+def wallet_coins() -> list[dict]:
+    conn = connect()
+    rows = [dict(r) for r in conn.execute(
+        "SELECT key AS coin, c FROM stat_groups WHERE kind='coin' AND c>0 ORDER BY c DESC"
+    ).fetchall()]
+    conn.close(); return rows
+
+def list_wallet_rows(coin="") -> list[dict]:
+    conn = connect()
+    sql = "SELECT coin,address,addr_type,shop_id FROM wallets WHERE 1=1"
+    params = []
+    if coin: sql += " AND coin=?"; params.append(coin.upper())
+    rows = [dict(r) for r in conn.execute(sql, params).fetchall()]
+    conn.close(); return rows
+
+def list_discovered(scanned="", limit=500) -> list[dict]:
+    conn = connect()
+    sql = "SELECT * FROM discovered_links WHERE 1=1"
+    if scanned == "0": sql += " AND scanned=0 ORDER BY priority DESC, id"
+    elif scanned == "1": sql += " AND scanned=1 ORDER BY discovered_at DESC"
+    else: sql += " ORDER BY discovered_at DESC"
+    sql += " LIMIT ?"
+    rows = [dict(r) for r in conn.execute(sql, (limit,)).fetchall()]
+    conn.close(); return rows
+
+def top_threats(limit=50) -> list[dict]:
+    conn = connect()
+    rows = [dict(r) for r in conn.execute("""
+        SELECT category,severity,keyword,SUM(count) AS total
+        FROM threat_keywords GROUP BY keyword
+        ORDER BY total DESC LIMIT ?
+    """, (limit,)).fetchall()]
+    conn.close(); return rows
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  EXPORT — streaming, consultas por conjuntos ordenadas por shop_id
+# ─────────────────────────────────────────────────────────────────────────────
+
+_EXPORT_CHILDREN = [
+    # (clave, SQL ordenado por shop_id, transformación de fila)
+    ("tech",        "SELECT shop_id,name,category,version,confidence FROM tech "
+                    "ORDER BY shop_id,id", None),
+    ("keywords",    "SELECT shop_id,keyword,category,severity,count FROM threat_keywords "
+                    "ORDER BY shop_id,id", None),
+    ("tags",        "SELECT shop_id,tag FROM tags ORDER BY shop_id,id",
+                    lambda r: r["tag"]),
+    ("wallets",     "SELECT shop_id,coin,address,addr_type FROM wallets "
+                    "ORDER BY shop_id,id", None),
+    ("screenshots", "SELECT shop_id,path FROM screenshots "
+                    "ORDER BY shop_id,created_at DESC", lambda r: r["path"]),
+]
+
+class _ChildStream:
+    """Cursor ordenado por shop_id consumido en paralelo al de shops (merge join)."""
+
+    def __init__(self, cursor, transform=None):
+        self._it        = iter(cursor)
+        self._transform = transform or (lambda r: {k: r[k] for k in r.keys() if k != "shop_id"})
+        self._row       = next(self._it, None)
+
+    def take(self, shop_id) -> list:
+        out = []
+        while self._row is not None and self._row["shop_id"] < shop_id:
+            self._row = next(self._it, None)   # huérfanas: shop ya borrado
+        while self._row is not None and self._row["shop_id"] == shop_id:
+            out.append(self._transform(self._row))
+            self._row = next(self._it, None)
+        return out
+
+def iter_export_shops():
+    """
+    Genera los sitios con sus tablas hijas, en orden de id, sin materializar la DB:
+    7 consultas en total (una por tabla) leídas en paralelo dentro de un snapshot.
+    Usa una conexión propia para no retener la del hilo durante todo el export.
+    """
+    conn = _open(DB_PATH)
+    try:
+        conn.execute("BEGIN")   # snapshot de lectura consistente para todos los cursores
+        shops    = conn.execute("SELECT * FROM shops ORDER BY id")
+        children = [(key, _ChildStream(conn.execute(sql), fn))
+                    for key, sql, fn in _EXPORT_CHILDREN]
+        ti = _ChildStream(conn.execute("SELECT * FROM threat_intel ORDER BY shop_id"),
+                          lambda r: dict(r))
+        for row in shops:
+            s = dict(row)
+            for key, stream in children:
+                s[key] = stream.take(s["id"])
+            t = ti.take(s["id"])
+            s["threat_intel"] = t[0] if t else {}
+            yield s
+    finally:
+        conn.really_close()
+
+def export_all_json():
+    """Lista completa ordenada por riesgo (materializa; para volúmenes grandes usar iter_export_shops)."""
+    return sorted(iter_export_shops(), key=lambda s: s["risk_score"] or 0, reverse=True)
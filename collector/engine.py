@@ -0,0 +1,162 @@
+"""
+SCRACHER v3 — Scan engine
+Pool de escaneo compartido con límites por etapa. SCAN_WORKERS escaneos
+corren a la vez y, dentro de ellos, como mucho SCAN_FETCH_LIMIT peticiones
+por Tor, SCAN_SHOT_LIMIT capturas de Playwright y SCAN_OCR_LIMIT OCR.
+Los límites de etapa se aplican en scrape_one(), así que cuentan igual para
+CLI, dashboard y scheduler aunque no pasen por el pool.
+Con CAPTURE_ASYNC (por defecto) el escaneo no espera a la captura y la etapa
+"screenshot" no se usa: las capturas simultáneas las limita el servicio de
+capturas (CAPTURE_BROWSERS × CAPTURE_CONTEXTS, ver collector.capture).
+SCAN_SHOT_LIMIT solo cuenta con CAPTURE_ASYNC=false.
+"""
+
+import os
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "8"))
+STAGE_LIMITS = {
+    "fetch":      int(os.getenv("SCAN_FETCH_LIMIT", "8")),
+    "screenshot": int(os.getenv("SCAN_SHOT_LIMIT",  "2")),
+    "ocr":        int(os.getenv("SCAN_OCR_LIMIT",   "2")),
+}
+
+_engine      = None
+_engine_lock = threading.Lock()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  ETAPAS — semáforo + métricas por etapa
+# ─────────────────────────────────────────────────────────────────────────────
+
+class _Stage:
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.sem   = threading.BoundedSemaphore(self.limit)
+        self.lock  = threading.Lock()
+        self.m = {"active": 0, "waiting": 0, "done": 0, "errors": 0,
+                  "wait_s": 0.0, "run_s": 0.0, "max_wait_s": 0.0}
+
+    def metrics(self) -> dict:
+        with self.lock:
+            m = dict(self.m)
+        n = m["done"] + m["errors"]
+        return {
+            "limit": self.limit, "active": m["active"], "waiting": m["waiting"],
+            "done": m["done"], "errors": m["errors"],
+            "avg_wait_s": round(m["wait_s"] / n, 2) if n else 0.0,
+            "avg_run_s":  round(m["run_s"] / n, 2) if n else 0.0,
+            "max_wait_s": round(m["max_wait_s"], 2),
+        }
+
+_stages = {name: _Stage(limit) for name, limit in STAGE_LIMITS.items()}
+
+@contextmanager
+def stage(name: str):
+    """Ocupa un hueco de la etapa `name` mientras dura el bloque."""
+    st = _stages[name]
+    t0 = perf_counter()
+    with st.lock:
+        st.m["waiting"] += 1
+    st.sem.acquire()
+    waited = perf_counter() - t0
+    with st.lock:
+        st.m["waiting"]   -= 1
+        st.m["active"]    += 1
+        st.m["wait_s"]    += waited
+        st.m["max_wait_s"] = max(st.m["max_wait_s"], waited)
+    t1 = perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        st.sem.release()
+        with st.lock:
+            st.m["active"] -= 1
+            st.m["run_s"]  += perf_counter() - t1
+            st.m["done" if ok else "errors"] += 1
+
+def stage_status() -> dict:
+    return {name: st.metrics() for name, st in _stages.items()}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  POOL
+# ─────────────────────────────────────────────────────────────────────────────
+
+class ScanEngine:
+    """ThreadPoolExecutor con recuento de trabajos en curso y en cola."""
+
+    def __init__(self, workers: int = SCAN_WORKERS):
+        self.workers = max(1, workers)
+        self._pool   = ThreadPoolExecutor(max_workers=self.workers,
+                                          thread_name_prefix="scracher-scan")
+        self._lock   = threading.Lock()
+        self._m      = {"submitted": 0, "running": 0, "done": 0, "errors": 0}
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        def run():
+            with self._lock:
+                self._m["running"] += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._m["running"] -= 1
+        with self._lock:
+            self._m["submitted"] += 1
+        fut = self._pool.submit(run)
+        fut.add_done_callback(self._count)
+        return fut
+
+    def _count(self, fut: Future):
+        with self._lock:
+            self._m["errors" if fut.exception() else "done"] += 1
+
+    def pending(self) -> int:
+        """Trabajos enviados que aún no han terminado (en curso + en cola)."""
+        with self._lock:
+            return self._m["submitted"] - self._m["done"] - self._m["errors"]
+
+    def shutdown(self, wait: bool = False):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            m = dict(self._m)
+        m["workers"] = self.workers
+        m["queued"]  = max(0, m["submitted"] - m["done"] - m["errors"] - m["running"])
+        return m
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_engine() -> ScanEngine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ScanEngine()
+        return _engine
+
+
+def stop_engine(wait: bool = False):
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.shutdown(wait=wait)
+            _engine = None
+
+
+def engine_status() -> dict:
+    st = _engine.metrics() if _engine is not None else {"workers": SCAN_WORKERS, "running": 0}
+    st["stages"] = stage_status()
+    try:
+        from collector.capture import capture_status
+        st["capture"] = capture_status()
+    except ImportError:          # sin playwright
+        pass
+    return st
@@ -8,6 +8,7 @@ import csv
 import io
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Iterable
 
 ROOT = Path(__file__).resolve().parents[1]
 EXPORT_DIR = ROOT / "data" / "exports"
@@ -21,20 +22,26 @@ def _ts() -> str:
     return datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
 
 
-def export_json(shops: list[dict]) -> Path:
+def export_json(shops: Iterable[dict]) -> Path:
+    """Escribe sitio a sitio: acepta un iterador (db.iter_export_shops) sin cargarlo en memoria."""
     _ensure_dir()
     path = EXPORT_DIR / f"scracher_export_{_ts()}.json"
+    count = 0
     with open(path, "w", encoding="utf-8") as f:
-        json.dump({
-            "exported_at": datetime.now(timezone.utc).isoformat(),
-            "tool": "SCRACHER v2",
-            "count": len(shops),
-            "sites": shops,
-        }, f, indent=2, ensure_ascii=False, default=str)
+        f.write("{\n")
+        f.write(f'  "exported_at": {json.dumps(datetime.now(timezone.utc).isoformat())},\n')
+        f.write('  "tool": "SCRACHER v2",\n')
+        f.write('  "sites": [')
+        for s in shops:
+            site = json.dumps(s, indent=2, ensure_ascii=False, default=str)
+            f.write(("," if count else "") + "\n    " + site.replace("\n", "\n    "))
+            count += 1
+        f.write("\n  ]" if count else "]")
+        f.write(f',\n  "count": {count}\n}}\n')
     return path
 
 
-def export_csv(shops: list[dict]) -> Path:
+def export_csv(shops: Iterable[dict]) -> Path:
     _ensure_dir()
     path = EXPORT_DIR / f"scracher_export_{_ts()}.csv"
     fieldnames = ["id", "url", "domain", "title", "status", "risk_level",
@@ -52,8 +59,27 @@ def export_csv(shops: list[dict]) -> Path:
     return path
 
 
-def export_html_report(shops: list[dict], stats: dict) -> Path:
-    """Genera informe HTML legible para entrega a autoridades / CERT."""
+def _html_row(s: dict, risk_color: dict) -> str:
+    rl = s.get("risk_level", "unknown")
+    color = risk_color.get(rl, "#6b7280")
+    tags = ", ".join(s.get("tags", []))
+    kwds = ", ".join(k["keyword"] for k in s.get("keywords", [])[:8])
+    return f"""
+        <tr>
+          <td>{s.get('id','')}</td>
+          <td style="word-break:break-all;max-width:220px">{s.get('url','')}</td>
+          <td>{s.get('title','') or '-'}</td>
+          <td><span style="background:{color};color:#fff;padding:2px 8px;border-radius:4px;font-size:12px">{rl.upper()}</span></td>
+          <td>{s.get('risk_score',0):.2f}</td>
+          <td style="font-size:12px">{tags}</td>
+          <td style="font-size:12px;color:#666">{kwds}</td>
+          <td>{s.get('scan_count',1)}</td>
+          <td style="font-size:12px">{s.get('detected_at','')}</td>
+        </tr>"""
+
+
+def export_html_report(shops: Iterable[dict], stats: dict) -> Path:
+    """Genera informe HTML legible para entrega a autoridades / CERT (filas en streaming)."""
     _ensure_dir()
     path = EXPORT_DIR / f"scracher_report_{_ts()}.html"
 
@@ -68,30 +94,11 @@ def export_html_report(shops: list[dict], stats: dict) -> Path:
         "unknown":  "#6b7280",
     }
 
-    rows_html = ""
-    for s in shops:
-        rl = s.get("risk_level", "unknown")
-        color = RISK_COLOR.get(rl, "#6b7280")
-        tags = ", ".join(s.get("tags", []))
-        kwds = ", ".join(k["keyword"] for k in s.get("keywords", [])[:8])
-        rows_html += f"""
-        <tr>
-          <td>{s.get('id','')}</td>
-          <td style="word-break:break-all;max-width:220px">{s.get('url','')}</td>
-          <td>{s.get('title','') or '-'}</td>
-          <td><span style="background:{color};color:#fff;padding:2px 8px;border-radius:4px;font-size:12px">{rl.upper()}</span></td>
-          <td>{s.get('risk_score',0):.2f}</td>
-          <td style="font-size:12px">{tags}</td>
-          <td style="font-size:12px;color:#666">{kwds}</td>
-          <td>{s.get('scan_count',1)}</td>
-          <td style="font-size:12px">{s.get('detected_at','')}</td>
-        </tr>"""
-
     threat_rows = ""
     for t in stats.get("top_threats", []):
         threat_rows += f"<tr><td>{t['category']}</td><td>{t['c']}</td></tr>"
 
-    html = f"""<!DOCTYPE html>
+    head = f"""<!DOCTYPE html>
 <html lang="es">
 <head>
 <meta charset="utf-8">
@@ -129,13 +136,14 @@ def export_html_report(shops: list[dict], stats: dict) -> Path:
   {threat_rows}
 </table>
 
-<h2>Resultados ({len(shops)} sitios)</h2>
+<h2>Resultados ({stats.get('total',0)} sitios)</h2>
 <table>
   <tr>
     <th>#</th><th>URL</th><th>Título</th><th>Riesgo</th>
     <th>Score</th><th>Tags</th><th>Keywords</th><th>Scans</th><th>Fecha</th>
-  </tr>
-  {rows_html}
+  </tr>"""
+
+    foot = """
 </table>
 
 <div class="footer">
@@ -146,5 +154,8 @@ def export_html_report(shops: list[dict], stats: dict) -> Path:
 </html>"""
 
     with open(path, "w", encoding="utf-8") as f:
-        f.write(html)
+        f.write(head)
+        for s in shops:
+            f.write(_html_row(s, RISK_COLOR))
+        f.write(foot)
     return path
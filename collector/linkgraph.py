@@ -0,0 +1,408 @@
+"""
+SCRACHER v3 — Link graph
+Grafo host→host construido a partir de link_sources (source_id = sitio que
+publicó el link, domain = onion enlazado; incluye links ya archivados). Se
+guarda en memoria en formato CSR sobre array (indptr/indices/weights, más la
+traspuesta para vecinos de entrada) y se actualiza de forma incremental
+leyendo solo los pares con id mayor que el último procesado.
+Sobre él se calculan PageRank (arranque en caliente desde la pasada anterior)
+y HITS (hub/authority). El PageRank normalizado se escribe en
+discovered_hosts.link_rank, que los triggers de la frontera suman a la
+prioridad de crawl (+ 2·link_rank).
+  start_linkgraph()          → hilo que refresca cada GRAPH_INTERVAL_MIN
+  refresh_graph(full=True)   → reconstrucción completa (también cada GRAPH_REBUILD_H)
+  get_graph().subgraph(host) → nodos/aristas para visualización (/api/graph/subgraph)
+"""
+
+import os
+import math
+import threading
+from array import array
+from time import perf_counter, monotonic
+
+from collector.db import _host_key, utc_now_iso
+
+GRAPH_INTERVAL_MIN = float(os.getenv("GRAPH_INTERVAL_MIN", "30"))   # 0 = sin hilo
+GRAPH_REBUILD_H    = float(os.getenv("GRAPH_REBUILD_H", "24"))      # recoge links archivados/borrados
+GRAPH_DAMPING      = float(os.getenv("GRAPH_DAMPING", "0.85"))
+GRAPH_TOL          = float(os.getenv("GRAPH_TOL", "1e-6"))          # convergencia (norma L1)
+GRAPH_MAX_ITER     = int(os.getenv("GRAPH_MAX_ITER", "100"))
+GRAPH_RANK_DELTA   = float(os.getenv("GRAPH_RANK_DELTA", "0.01"))   # cambio mínimo para reescribir link_rank
+
+_graph   = None
+_thread  = None
+_stop    = threading.Event()
+_lock    = threading.Lock()
+_status  = {"last_refresh": None, "last_rebuild": None, "last_report": None, "runs": 0}
+
+
+class LinkGraph:
+    """
+    Grafo dirigido y ponderado (peso = nº de URLs distintas de A que apuntan a B).
+    Las aristas nuevas se acumulan en un delta y compact() las funde con el CSR
+    en O(E + D·log D); los autoenlaces (un sitio que enlaza su propio onion) se
+    descartan. Todas las operaciones públicas toman el lock del grafo.
+    """
+
+    def __init__(self):
+        self._lock   = threading.RLock()
+        self._pushed = {}             # host → último link_rank escrito
+        self._reset()
+
+    def _reset(self):
+        self.hosts    = []            # id → host
+        self.ids      = {}            # host → id
+        self.indptr   = array("l", [0])
+        self.indices  = array("l")
+        self.weights  = array("d")
+        self._rptr    = array("l", [0])
+        self._rind    = array("l")
+        self._rw      = array("d")
+        self._delta   = {}            # (src, dst) → peso pendiente de compactar
+        self._warm    = None          # PageRank previo por host tras una reconstrucción
+        self.last_link_id = 0
+        self.pagerank  = array("d")
+        self.hub       = array("d")
+        self.authority = array("d")
+        self.iterations = 0
+
+    # ── construcción ─────────────────────────────────────────────────────────
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.hosts)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.indices)
+
+    def _node(self, host: str) -> int:
+        i = self.ids.get(host)
+        if i is None:
+            i = self.ids[host] = len(self.hosts)
+            self.hosts.append(host)
+        return i
+
+    def add_edge(self, src: str, dst: str, weight: float = 1.0):
+        if not src or not dst or src == dst:
+            return
+        with self._lock:
+            key = (self._node(src), self._node(dst))
+            self._delta[key] = self._delta.get(key, 0.0) + weight
+
+    def compact(self) -> int:
+        """Funde el delta con el CSR (filas ordenadas por destino). Devuelve aristas fundidas."""
+        with self._lock:
+            n = self.n_nodes
+            if not self._delta and len(self.indptr) == n + 1:
+                return 0
+            by_src = {}
+            for (s, d), w in self._delta.items():
+                by_src.setdefault(s, []).append((d, w))
+            old_n = len(self.indptr) - 1
+            indptr, indices, weights = array("l", [0]), array("l"), array("d")
+            for u in range(n):
+                a, b = (self.indptr[u], self.indptr[u + 1]) if u < old_n else (0, 0)
+                new = sorted(by_src.get(u, ()))
+                i, j = a, 0
+                while i < b or j < len(new):
+                    if j >= len(new) or (i < b and self.indices[i] < new[j][0]):
+                        indices.append(self.indices[i]); weights.append(self.weights[i]); i += 1
+                    elif i >= b or new[j][0] < self.indices[i]:
+                        indices.append(new[j][0]); weights.append(new[j][1]); j += 1
+                    else:
+                        indices.append(self.indices[i]); weights.append(self.weights[i] + new[j][1])
+                        i += 1; j += 1
+                indptr.append(len(indices))
+            merged = len(self._delta)
+            self.indptr, self.indices, self.weights = indptr, indices, weights
+            self._delta = {}
+            self._transpose()
+            return merged
+
+    def _transpose(self):
+        n = self.n_nodes
+        count = array("l", [0]) * (n + 1)
+        for d in self.indices:
+            count[d + 1] += 1
+        for i in range(n):
+            count[i + 1] += count[i]
+        rptr = array("l", count)
+        rind = array("l", [0]) * self.n_edges
+        rw   = array("d", [0.0]) * self.n_edges
+        for u in range(n):
+            for k in range(self.indptr[u], self.indptr[u + 1]):
+                d = self.indices[k]
+                rind[count[d]] = u
+                rw[count[d]]   = self.weights[k]
+                count[d] += 1
+        self._rptr, self._rind, self._rw = rptr, rind, rw
+
+    def load(self, store, full: bool = False) -> int:
+        """Lee de `store` los links nuevos (todos si full) y compacta. Devuelve cuántos."""
+        with self._lock:
+            if full:
+                warm = dict(zip(self.hosts, self.pagerank))
+                self._reset()
+                self._warm = warm
+                # lo que hay escrito en la DB, no lo que recuerda este proceso
+                # (vacío tras reiniciar): así push_ranks corrige valores viejos
+                self._pushed = dict(store.get_host_ranks())
+            n = 0
+            for link_id, source_url, target in store.iter_link_edges(self.last_link_id):
+                self.add_edge(_host_key(source_url or ""), target)
+                self.last_link_id = link_id
+                n += 1
+            self.compact()
+            return n
+
+    # ── puntuaciones ─────────────────────────────────────────────────────────
+
+    def _out_weight(self) -> array:
+        out = array("d", [0.0]) * self.n_nodes
+        for u in range(self.n_nodes):
+            s = 0.0
+            for k in range(self.indptr[u], self.indptr[u + 1]):
+                s += self.weights[k]
+            out[u] = s
+        return out
+
+    def compute_pagerank(self, damping: float = GRAPH_DAMPING, tol: float = GRAPH_TOL,
+                         max_iter: int = GRAPH_MAX_ITER) -> int:
+        """
+        Iteración de potencias ponderada. La masa de los nodos sin salida se
+        reparte uniformemente. Parte del PageRank anterior (nodos nuevos con 1/n),
+        así que tras un refresco incremental converge en pocas iteraciones.
+        """
+        with self._lock:
+            self.compact()
+            n = self.n_nodes
+            if n == 0:
+                self.pagerank, self.iterations = array("d"), 0
+                return 0
+            if self._warm:
+                pr = array("d", (self._warm.get(h, 1.0 / n) for h in self.hosts))
+                self._warm = None
+            else:
+                pr = array("d", self.pagerank)
+                pr.extend([1.0 / n] * (n - len(pr)))
+            total = sum(pr) or 1.0
+            pr = array("d", (x / total for x in pr))
+            out = self._out_weight()
+            it = 0
+            for it in range(1, max_iter + 1):
+                dangling = sum(pr[u] for u in range(n) if out[u] == 0.0)
+                base = (1.0 - damping + damping * dangling) / n
+                new = array("d", [base]) * n
+                for u in range(n):
+                    if out[u] == 0.0:
+                        continue
+                    share = damping * pr[u] / out[u]
+                    for k in range(self.indptr[u], self.indptr[u + 1]):
+                        new[self.indices[k]] += share * self.weights[k]
+                err = sum(abs(new[i] - pr[i]) for i in range(n))
+                pr = new
+                if err < tol:
+                    break
+            self.pagerank, self.iterations = pr, it
+            return it
+
+    def compute_hits(self, iters: int = 30, tol: float = GRAPH_TOL):
+        """Hubs (enlazan a muchas autoridades) y authorities (enlazadas por muchos hubs)."""
+        with self._lock:
+            self.compact()
+            n = self.n_nodes
+            hub = array("d", [1.0]) * n
+            auth = array("d", [0.0]) * n
+            for _ in range(iters):
+                auth = array("d", [0.0]) * n
+                for u in range(n):
+                    h = hub[u]
+                    for k in range(self.indptr[u], self.indptr[u + 1]):
+                        auth[self.indices[k]] += h * self.weights[k]
+                norm = math.sqrt(sum(x * x for x in auth)) or 1.0
+                auth = array("d", (x / norm for x in auth))
+                new = array("d", [0.0]) * n
+                for u in range(n):
+                    s = 0.0
+                    for k in range(self.indptr[u], self.indptr[u + 1]):
+                        s += auth[self.indices[k]] * self.weights[k]
+                    new[u] = s
+                norm = math.sqrt(sum(x * x for x in new)) or 1.0
+                new = array("d", (x / norm for x in new))
+                err = sum(abs(new[i] - hub[i]) for i in range(n))
+                hub = new
+                if err < tol:
+                    break
+            self.hub, self.authority = hub, auth
+
+    def link_ranks(self) -> dict:
+        """
+        PageRank escalado a [0,1] para la frontera: log(1 + pr·n) / log(1 + max·n).
+        Con pr/max a secas casi todos los hosts quedarían en ~0 (la distribución
+        tiene cola larga); así un host con PageRank medio ronda 0.1–0.3.
+        """
+        with self._lock:
+            n = len(self.pagerank)
+            if n == 0:
+                return {}
+            top = math.log1p(max(self.pagerank) * n) or 1.0
+            return {h: round(math.log1p(self.pagerank[i] * n) / top, 4)
+                    for i, h in enumerate(self.hosts[:n])}
+
+    def push_ranks(self, store, min_delta: float = GRAPH_RANK_DELTA) -> int:
+        """
+        Escribe link_rank de los hosts cuyo valor cambió más de min_delta. Los
+        hosts con link_rank que ya no están en el grafo vuelven a 0 aunque el
+        valor sea menor que min_delta (si no, seguirían subiendo la prioridad
+        de sus links) y dejan de seguirse. Tras load(full=True) _pushed parte
+        de la DB, así que esto también cubre lo escrito antes de un reinicio.
+        """
+        ranks = self.link_ranks()
+        rows = [(h, r) for h, r in ranks.items()
+                if abs(r - self._pushed.get(h, 0.0)) > min_delta]
+        gone = [h for h in self._pushed if h not in ranks]
+        n = store.set_host_ranks(rows, min_delta) if rows else 0
+        if gone:
+            n += store.set_host_ranks([(h, 0.0) for h in gone], 0.0)
+        self._pushed.update(rows)
+        for h in gone:
+            del self._pushed[h]
+        return n
+
+    # ── consultas ────────────────────────────────────────────────────────────
+
+    def _scores(self, i: int) -> dict:
+        g = lambda a: round(a[i], 8) if i < len(a) else 0.0
+        return {"pagerank": g(self.pagerank), "hub": g(self.hub), "authority": g(self.authority)}
+
+    def out_edges(self, i: int):
+        for k in range(self.indptr[i], self.indptr[i + 1]):
+            yield self.indices[k], self.weights[k]
+
+    def in_edges(self, i: int):
+        for k in range(self._rptr[i], self._rptr[i + 1]):
+            yield self._rind[k], self._rw[k]
+
+    def node(self, host: str) -> dict | None:
+        with self._lock:
+            i = self.ids.get(host)
+            if i is None or i >= len(self.indptr) - 1:
+                return None
+            return {"host": host, "out": self.indptr[i + 1] - self.indptr[i],
+                    "in": self._rptr[i + 1] - self._rptr[i], **self._scores(i)}
+
+    def top(self, n: int = 20, by: str = "pagerank") -> list[dict]:
+        if by not in ("pagerank", "hub", "authority"):
+            raise ValueError(f"by desconocido: {by!r} (pagerank / hub / authority)")
+        with self._lock:
+            scores = getattr(self, by)
+            best = sorted(range(len(scores)), key=lambda i: -scores[i])[:n]
+            return [self.node(self.hosts[i]) for i in best]
+
+    def subgraph(self, center: str = "", depth: int = 1, limit: int = 200) -> dict:
+        """
+        Vecindario de `center` (en ambos sentidos) hasta `depth` saltos y como
+        mucho `limit` nodos, priorizando por PageRank en cada nivel. Sin center,
+        los `limit` nodos de mayor PageRank. Formato nodes/edges (d3, cytoscape…).
+        """
+        with self._lock:
+            pr = self.pagerank
+            key = lambda i: -(pr[i] if i < len(pr) else 0.0)
+            if center:
+                c = self.ids.get(_host_key(center))
+                if c is None:
+                    return {"nodes": [], "edges": [], "center": center}
+                keep, level = {c: 0}, [c]
+                for d in range(1, depth + 1):
+                    nxt = {v for u in level
+                           for v, _ in (*self.out_edges(u), *self.in_edges(u))
+                           if v not in keep}
+                    level = sorted(nxt, key=key)[:max(0, limit - len(keep))]
+                    keep.update((v, d) for v in level)
+                    if not level:
+                        break
+            else:
+                keep = {i: None for i in sorted(range(self.n_nodes), key=key)[:limit]}
+            nodes = [{"id": self.hosts[i], "depth": keep[i], **self.node(self.hosts[i])}
+                     for i in keep]
+            edges = [{"source": self.hosts[u], "target": self.hosts[v], "weight": w}
+                     for u in keep for v, w in self.out_edges(u) if v in keep]
+            return {"nodes": nodes, "edges": edges, "center": center or None}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  REFRESCO PERIÓDICO
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_graph() -> LinkGraph:
+    global _graph
+    with _lock:
+        if _graph is None:
+            _graph = LinkGraph()
+        return _graph
+
+def refresh_graph(full: bool = False, store=None) -> dict:
+    """Carga links nuevos (o todo si full), recalcula PageRank/HITS y actualiza link_rank."""
+    if store is None:
+        from collector.storage import get_storage
+        store = get_storage()
+    g  = get_graph()
+    t0 = perf_counter()
+    with g._lock:
+        added = g.load(store, full=full)
+        iters = g.compute_pagerank()
+        g.compute_hits()
+        written = g.push_ranks(store)
+    report = {"started_at": utc_now_iso(), "full": full, "links_added": added,
+              "nodes": g.n_nodes, "edges": g.n_edges, "iterations": iters,
+              "ranks_written": written, "elapsed_s": round(perf_counter() - t0, 2)}
+    with _lock:
+        _status["last_refresh"] = report["started_at"]
+        if full:
+            _status["last_rebuild"] = report["started_at"]
+        _status["last_report"] = report
+        _status["runs"] += 1
+    return report
+
+def _loop(interval_min: float, rebuild_h: float):
+    last_full = None
+    while not _stop.wait(timeout=0 if _status["runs"] == 0 else interval_min * 60):
+        full = (last_full is None or
+                (rebuild_h > 0 and monotonic() - last_full > rebuild_h * 3600))
+        try:
+            refresh_graph(full=full)
+            if full:
+                last_full = monotonic()
+        except Exception as e:
+            with _lock:
+                _status["last_report"] = {"error": str(e), "started_at": utc_now_iso()}
+                _status["runs"] += 1
+
+def start_linkgraph(interval_min: float = GRAPH_INTERVAL_MIN,
+                    rebuild_h: float = GRAPH_REBUILD_H) -> bool:
+    """Arranca el hilo del grafo en segundo plano (interval_min <= 0 lo desactiva)."""
+    global _thread
+    if interval_min <= 0 or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(interval_min, rebuild_h),
+                               name="scracher-linkgraph", daemon=True)
+    _thread.start()
+    return True
+
+def stop_linkgraph(timeout: float = 10):
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+
+def linkgraph_status() -> dict:
+    g = get_graph()
+    with _lock:
+        st = dict(_status)
+    st.update(running=_thread is not None and _thread.is_alive(),
+              nodes=g.n_nodes, edges=g.n_edges, pending=len(g._delta),
+              last_link_id=g.last_link_id, iterations=g.iterations,
+              interval_min=GRAPH_INTERVAL_MIN, rebuild_h=GRAPH_REBUILD_H,
+              damping=GRAPH_DAMPING)
+    return st
@@ -27,7 +27,7 @@ OCR_LANGS = os.getenv("OCR_LANGS", "eng+spa+rus")
 def ocr_screenshot(rel_path: str) -> dict:
     """
     Extrae texto de un screenshot via Tesseract OCR.
-    rel_path: ruta relativa como 'screenshots/domain_20240101.png'
+    rel_path: ruta relativa como 'screenshots/<sha256>.webp'
     Devuelve dict con text, confidence, available.
     """
     if not OCR_AVAILABLE:
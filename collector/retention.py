@@ -0,0 +1,253 @@
+"""
+SCRACHER v3 — Retention
+Políticas de retención para las tablas que crecen sin límite (rescan_log,
+alert_log, screenshots, discovered_links): las filas antiguas se mueven a
+ficheros JSONL comprimidos en data/archive/ y después se compacta scrs.db
+(y los ficheros separados de SQLITE_SPLIT_HOT) con PRAGMA incremental_vacuum.
+Con RETAIN_DELETE_FILES, las capturas que ya no referencia ninguna fila se
+borran del disco (collector.shotstore.gc_screenshots: un fichero puede ser de
+varias filas y sitios).
+"""
+
+import os
+import gzip
+import json
+import threading
+from pathlib import Path
+from time import perf_counter, sleep
+from datetime import datetime, timedelta, timezone
+
+from collector.db import connect_file, connect_table, split_aliases, utc_now_iso
+
+ROOT        = Path(__file__).resolve().parents[1]
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", str(ROOT / "data" / "archive")))
+
+# Días de retención por tabla (0 = conservar siempre)
+RETENTION_DAYS = {
+    "rescan_log":       int(os.getenv("RETAIN_RESCAN_LOG_DAYS",  "30")),
+    "alert_log":        int(os.getenv("RETAIN_ALERT_LOG_DAYS",   "90")),
+    "screenshots":      int(os.getenv("RETAIN_SCREENSHOTS_DAYS", "60")),
+    "discovered_links": int(os.getenv("RETAIN_DISCOVERED_DAYS",  "30")),
+    "work_queue":       int(os.getenv("RETAIN_WORK_QUEUE_DAYS",  "7")),
+}
+RETAIN_DELETE_FILES  = os.getenv("RETAIN_DELETE_FILES", "false").lower() == "true"
+RETAIN_BATCH         = int(os.getenv("RETAIN_BATCH", "5000"))
+RETAIN_VACUUM_PAGES  = int(os.getenv("RETAIN_VACUUM_PAGES", "2000"))
+RETENTION_INTERVAL_H = float(os.getenv("RETENTION_INTERVAL_H", "24"))
+
+# Filas candidatas a archivo; el parámetro es la fecha de corte (ISO UTC).
+#  - screenshots: nunca la última captura de cada sitio (miniaturas, OCR en FTS)
+#  - discovered_links: solo links ya escaneados que no se han vuelto a ver. Sus
+#    pares en link_sources (url, sitio fuente, host) se conservan como lápida:
+#    el link no vuelve a la frontera si reaparece y el grafo de links
+#    (collector.linkgraph) mantiene sus aristas. link_sources no se archiva.
+#  - work_queue: solo trabajos terminados (done/failed)
+_POLICIES = {
+    "rescan_log":  "ran_at < :cutoff",
+    "alert_log":   "sent_at < :cutoff",
+    "screenshots": """created_at < :cutoff AND EXISTS (
+                        SELECT 1 FROM screenshots n
+                        WHERE n.shop_id=screenshots.shop_id
+                          AND n.created_at > screenshots.created_at)""",
+    "discovered_links": """scanned=1 AND (last_seen < :cutoff
+                        OR (last_seen IS NULL AND discovered_at < :cutoff))""",
+    "work_queue":  "status IN ('done','failed') AND finished_at < :cutoff",
+}
+
+# Contadores de totales históricos: los triggers de stats restan las filas que
+# se archivan, así que cada lote suma las suyas a 'archived:*' en la misma
+# transacción (stat_counters del fichero de la tabla; get_stats() los suma).
+_ARCHIVED_COUNTERS = {
+    "alert_log":        ("archived:alerts:sent", lambda r: r.get("sent") == 1),
+    "discovered_links": ("archived:links",       lambda r: True),
+}
+
+_thread  = None
+_stop    = threading.Event()
+_lock    = threading.Lock()
+_status  = {"running": False, "last_run": None, "last_report": None, "runs": 0}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  ARCHIVO
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _archive_path(table: str) -> Path:
+    """Un fichero por tabla y mes; cada ejecución añade un miembro gzip."""
+    month = datetime.now(timezone.utc).strftime("%Y%m")
+    return ARCHIVE_DIR / f"{table}-{month}.jsonl.gz"
+
+def archive_table(table: str, days: int) -> int:
+    """
+    Mueve al archivo las filas de `table` más antiguas que `days` días.
+    Trabaja por lotes de RETAIN_BATCH con una transacción corta cada uno.
+    El lote se escribe (y se vuelca) al fichero antes de confirmar el DELETE:
+    tras una caída, como mucho se repiten filas en el archivo, nunca se pierden.
+    Los totales del dashboard no bajan: ver _ARCHIVED_COUNTERS.
+    """
+    if days <= 0:
+        return 0
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat(timespec="seconds")
+    where  = _POLICIES[table]
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    path   = _archive_path(table)
+    moved  = 0
+    conn   = connect_table(table)
+    try:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = [dict(r) for r in conn.execute(
+                f"SELECT * FROM {table} WHERE {where} ORDER BY id LIMIT :n",
+                {"cutoff": cutoff, "n": RETAIN_BATCH}).fetchall()]
+            if not rows:
+                conn.rollback()
+                break
+            with gzip.open(path, "at", encoding="utf-8") as fh:
+                for r in rows:
+                    fh.write(json.dumps(r, ensure_ascii=False, default=str) + "\n")
+            conn.executemany(f"DELETE FROM {table} WHERE id=?", [(r["id"],) for r in rows])
+            if table in _ARCHIVED_COUNTERS:
+                name, counts = _ARCHIVED_COUNTERS[table]
+                conn.execute("""
+                    INSERT INTO stat_counters(name,value) VALUES (?,?)
+                    ON CONFLICT(name) DO UPDATE SET value=value+excluded.value
+                """, (name, sum(1 for r in rows if counts(r))))
+            conn.commit()
+            moved += len(rows)
+            if len(rows) < RETAIN_BATCH:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return moved
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  VACUUM
+# ─────────────────────────────────────────────────────────────────────────────
+
+def db_space(alias: str = "main") -> dict:
+    conn = connect_file(alias)
+    page_size  = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist   = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vac   = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    conn.close()
+    return {
+        "page_size":     page_size,
+        "size_bytes":    page_size * page_count,
+        "free_bytes":    page_size * freelist,
+        "auto_vacuum":   {0: "none", 1: "full", 2: "incremental"}.get(auto_vac, str(auto_vac)),
+    }
+
+def _vacuum_file(alias: str, step_pages: int, pause_s: float) -> int:
+    before = db_space(alias)
+    if before["auto_vacuum"] != "incremental":
+        return 0
+    conn = connect_file(alias)
+    try:
+        while not _stop.is_set():
+            if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({int(step_pages)})")
+            conn.commit()
+            sleep(pause_s)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return before["size_bytes"] - db_space(alias)["size_bytes"]
+
+def incremental_vacuum(step_pages: int = RETAIN_VACUUM_PAGES, pause_s: float = 0.05) -> int:
+    """
+    Devuelve páginas libres al sistema en pasos cortos para no bloquear a
+    los escritores. Requiere auto_vacuum=INCREMENTAL (DBs nuevas ya lo traen;
+    las anteriores necesitan enable_incremental_vacuum() una vez).
+    Recorre scrs.db y cada fichero separado; devuelve los bytes recuperados.
+    """
+    return sum(_vacuum_file(alias, step_pages, pause_s)
+               for alias in ["main"] + split_aliases())
+
+def enable_incremental_vacuum() -> dict:
+    """
+    Cambia una DB existente a auto_vacuum=INCREMENTAL. Exige un VACUUM completo
+    (reescribe el fichero entero y bloquea la DB mientras dura): operación manual.
+    """
+    before = db_space()
+    conn = connect_file()
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    after = db_space()
+    return {"before": before, "after": after,
+            "reclaimed_bytes": before["size_bytes"] - after["size_bytes"]}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  EJECUCIÓN
+# ─────────────────────────────────────────────────────────────────────────────
+
+def run_retention(vacuum: bool = True) -> dict:
+    """Archiva todas las tablas según RETENTION_DAYS y compacta. Devuelve un informe."""
+    t0      = perf_counter()
+    before  = db_space()
+    report  = {"started_at": utc_now_iso(), "archived": {}, "errors": {}}
+    for table, days in RETENTION_DAYS.items():
+        try:
+            report["archived"][table] = archive_table(table, days)
+        except Exception as e:
+            report["errors"][table] = str(e)
+    if RETAIN_DELETE_FILES:
+        from collector.shotstore import gc_screenshots
+        try:
+            report["screenshot_files"] = gc_screenshots()
+        except Exception as e:
+            report["errors"]["screenshot_files"] = str(e)
+    report["reclaimed_bytes"] = incremental_vacuum() if vacuum else 0
+    report["space"]       = db_space()
+    report["size_before"] = before["size_bytes"]
+    report["elapsed_s"]   = round(perf_counter() - t0, 2)
+    with _lock:
+        _status["last_run"]    = report["started_at"]
+        _status["last_report"] = report
+        _status["runs"]       += 1
+    return report
+
+def _loop(interval_h: float):
+    while not _stop.wait(timeout=0 if _status["runs"] == 0 else interval_h * 3600):
+        try:
+            run_retention()
+        except Exception as e:
+            with _lock:
+                _status["last_report"] = {"error": str(e), "started_at": utc_now_iso()}
+                _status["runs"] += 1
+
+def start_retention(interval_h: float = RETENTION_INTERVAL_H) -> bool:
+    """Arranca el hilo de retención en segundo plano (interval_h <= 0 lo desactiva)."""
+    global _thread
+    if interval_h <= 0 or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(interval_h,),
+                               name="scracher-retention", daemon=True)
+    _thread.start()
+    return True
+
+def stop_retention(timeout: float = 10):
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+
+def retention_status() -> dict:
+    with _lock:
+        st = dict(_status)
+    st["running"]     = _thread is not None and _thread.is_alive()
+    st["policies"]    = RETENTION_DAYS
+    st["archive_dir"] = str(ARCHIVE_DIR)
+    st["interval_h"]  = RETENTION_INTERVAL_H
+    st["space"]       = db_space()
+    st["split_space"] = {a: db_space(a) for a in split_aliases()}
+    return st
@@ -11,14 +11,14 @@ import threading
 import itertools
 from time import perf_counter, sleep
 from datetime import datetime
-
-from collector.db import (
-    init_db, upsert_shop, replace_tech, add_screenshot, list_shops,
-    delete_shop_by_id, replace_keywords, replace_tags, replace_wallets,
-    add_discovered_links, upsert_threat_intel, log_alert,
-    get_pending_discovered, mark_discovered_scanned, get_stats, export_all_json,
-)
-from collector.scrape import scrape_one
+from concurrent.futures import wait as futures_wait
+
+from collector.storage import get_storage, close_storage
+from collector.db import FRONTIER_ROUND
+from collector.writer import writer_status
+from collector.retention import (run_retention, enable_incremental_vacuum, db_space,
+                                 start_retention, stop_retention)
+from collector.scrape import scrape_one, attach_capture
 from collector.dashboard_launcher import start_dashboard
 from collector.alerts import dispatch_alerts, alerts_status
 from collector.scheduler import scheduler_status, start_scheduler, list_jobs, schedule_rescan
@@ -190,6 +190,7 @@ def status_panel(stats):
     al  = alerts_status()
     sc  = scheduler_status()
     ocr = ocr_check_status()
+    wr  = writer_status()
     vt  = bool(os.getenv('VT_API_KEY', ''))
 
     print(f"\n  {GY}SITES{R}    "
@@ -217,7 +218,8 @@ def status_panel(stats):
           f"  {mod('OCR',        ocr.get('available', False)          )}")
     print(f"  {mod('SCHEDULER',  sc.get('running', False), str(sc.get('job_count',0))+' jobs')} "
           f"  {mod('SLACK',      al.get('slack', False)               )} "
-          f"  {mod('EMAIL',      al.get('email', False)               )}")
+          f"  {mod('EMAIL',      al.get('email', False)               )} "
+          f"  {mod('WRITER',     wr.get('running', False), 'q:'+str(wr.get('queue_depth',0)))}")
 
     top = stats.get('top_threats', [])
     if top:
@@ -405,10 +407,12 @@ def run_scan(urls, use_threat_intel=None):
     if use_threat_intel is None:
         use_threat_intel = ask_threat_intel()
 
-    init_db()
+    store = get_storage()
     scan_header(len(urls), use_threat_intel)
 
     ok_n = fail_n = new_links = new_wallets = 0
+    failed  = set()
+    shots   = []
     t_all   = perf_counter()
     spinner = Spinner()
 
@@ -426,32 +430,12 @@ def run_scan(urls, use_threat_intel=None):
             rl       = threat.get('risk_level', 'unknown')
             ext_risk = ti.get('external_risk', 'unknown')
 
-            shop_id = upsert_shop(
-                url=data['url'], domain=data.get('domain'),
-                title=data.get('title'), status='ok',
-                risk_score=threat.get('risk_score', 0), risk_level=rl,
-                external_risk=ext_risk,
-                content_hash=data.get('content_hash'),
-                language=data.get('language'),
-            )
-            replace_tech(shop_id, data.get('tech', []))
-            replace_keywords(shop_id, threat.get('keywords', []))
-            replace_tags(shop_id, threat.get('tags', []))
-            wallets = data.get('wallets', {})
-            replace_wallets(shop_id, wallets)
-            if use_threat_intel and ti:
-                upsert_threat_intel(shop_id, ti)
-
-            sc_d     = data.get('screenshot') or {}
-            ocr_text = data.get('ocr', {}).get('text') or None
-            if sc_d.get('path'):
-                add_screenshot(shop_id, sc_d['path'],
-                               sc_d.get('width'), sc_d.get('height'), ocr_text)
-
-            onion_links = data.get('onion_links', [])
-            if onion_links:
-                add_discovered_links(shop_id, onion_links)
-                new_links += len(onion_links)
+            shop_id, _ = store.persist_scan_result(data, threat_intel=use_threat_intel)
+            stored = attach_capture(data, shop_id)
+            if stored is not None:
+                shots.append(stored)
+            wallets     = data.get('wallets', {})
+            new_links  += len(data.get('onion_links', []))
 
             wallet_count = sum(len(v) for v in wallets.values())
             new_wallets += wallet_count
@@ -467,8 +451,8 @@ def run_scan(urls, use_threat_intel=None):
                 'language': data.get('language'),
             })
             for ar in alert_results:
-                log_alert(shop_id, ar.get('channel','?'), rl,
-                          ar.get('sent', False), ar.get('reason'))
+                store.log_alert(shop_id, ar.get('channel','?'), rl,
+                                ar.get('sent', False), ar.get('reason'))
 
             schedule_rescan(shop_id, data['url'], rl)
             ok_n += 1
@@ -478,19 +462,28 @@ def run_scan(urls, use_threat_intel=None):
             elapsed = perf_counter() - t0
             spinner.stop()
             fail_n += 1
-            upsert_shop(url=u, domain=None, title=None, status='error', notes=str(e))
+            failed.add(u)
+            store.upsert_shop(url=u, domain=None, title=None, status='error', notes=str(e))
             scan_row_err(i, u, str(e), elapsed)
 
         scan_progress(i, len(urls), ok_n, fail_n, perf_counter() - t_all)
 
+    # Las capturas van por detrás del análisis: esperarlas antes del resumen
+    pending = [f for f in shots if not f.done()]
+    if pending:
+        spinner.start(f"Waiting for {len(pending)} screenshot(s)...")
+        futures_wait(pending, timeout=300)
+        spinner.stop()
+
     scan_footer(ok_n, fail_n, new_links, new_wallets, perf_counter() - t_all)
+    return failed
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  STATISTICS
 # ─────────────────────────────────────────────────────────────────────────────
 
 def show_stats():
-    stats = get_stats()
+    stats = get_storage().get_stats()
     total = max(stats.get('total', 1), 1)
     bar_w = 36
 
@@ -527,6 +520,14 @@ def show_stats():
     if coins:
         cs = '   '.join(f"{YL}{c['coin']}{R}:{WH}{c['c']}{R}" for c in coins)
         print(f"\n  {GY}Crypto wallets:{R}  {cs}")
+
+    wr = writer_status()
+    print(f"\n  {GY}DB writer:{R}  "
+          f"{GY}queue:{R} {WH}{wr['queue_depth']}/{wr['queue_size']}{R}"
+          f"   {GY}batches:{R} {CY}{wr['batches']}{R}"
+          f"   {GY}items:{R} {CY}{wr['items']}{R}"
+          f"   {GY}commit avg/max:{R} {WH}{wr['avg_commit_ms']}/{wr['max_commit_ms']}ms{R}"
+          f"   {GY}blocked:{R} {YL}{wr['blocked_puts']}{R}")
     print()
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -534,21 +535,26 @@ def show_stats():
 # ─────────────────────────────────────────────────────────────────────────────
 
 def crawl_discovered():
-    pending = get_pending_discovered(limit=100)
+    store   = get_storage()
+    pending = store.get_pending_discovered(limit=FRONTIER_ROUND)
     if not pending:
         pok('No pending links to crawl.')
         return
     section('CRAWL DISCOVERED')
-    pwarn(f"{len(pending)} discovered links pending")
+    pwarn(f"{len(pending)} best pending links (by frontier priority)")
+    for r in pending[:5]:
+        print(f"    {GY}>{R}  {CY}{r['priority']:5.2f}{R}  {WH}{_short(r['url'], 60)}{R}"
+              f"  {GY}seen {r['times_seen']}x{' · ' + str(r['failures']) + ' fail' if r['failures'] else ''}{R}")
     choice = prompt(f"How many to scan? {GY}[Enter=all / number]{R}")
     if choice.isdigit():
         pending = pending[:int(choice)]
-    urls = [r['url'] for r in pending]
-    ids  = [r['id']  for r in pending]
-    run_scan(urls)
-    for lid in ids:
-        mark_discovered_scanned(lid)
-    pok(f"Marked {len(ids)} as scanned.")
+    failed = run_scan([r['url'] for r in pending]) or set()
+    for r in pending:
+        if r['url'] in failed:
+            store.mark_discovered_failed(r['id'])
+        else:
+            store.mark_discovered_scanned(r['id'])
+    pok(f"Marked {len(pending) - len(failed)} as scanned, {len(failed)} failed.")
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  SCHEDULER
@@ -558,22 +564,52 @@ def scheduler_menu():
     sc = scheduler_status()
     section('SCHEDULER')
 
-    if not sc['available']:
-        perr('APScheduler not installed.')
-        print(f"  {GY}Run: pip install apscheduler sqlalchemy{R}\n")
-        return
-
     running = sc.get('running', False)
     state   = f"{GR}{B}[RUNNING]{R}" if running else f"{RD}[STOPPED]{R}"
-    print(f"\n  Status: {state}   {GY}Jobs:{R} {WH}{sc['job_count']}{R}")
-
-    print(f"\n  {GY}Intervals:{R}")
+    print(f"\n  Status: {state}   {GY}Jobs:{R} {WH}{sc['job_count']}{R}"
+          f"   {GY}Due:{R} {YL}{sc.get('due', 0)}{R}"
+          f"   {GY}Running:{R} {CY}{sc.get('inflight', 0)}/{sc.get('workers', 0)}{R}")
+
+    lag = sc.get('lag', {})
+    print(f"  {GY}Lag:{R}    backlog {WH}{lag.get('backlog_s', 0)/60:.0f}m{R}"
+          f"   p50 {WH}{lag.get('p50_s', 0)/60:.0f}m{R}"
+          f"   p95 {WH}{lag.get('p95_s', 0)/60:.0f}m{R}"
+          f"   max {WH}{lag.get('max_s', 0)/60:.0f}m{R}")
+    if sc.get('via_queue'):
+        try:
+            from collector.workqueue import queue_status
+            q = queue_status(0)
+            c = q.get('counts', {})
+            print(f"  {GY}Queue:{R}  {WH}{c.get('ready', 0)}{R} ready  {CY}{c.get('leased', 0)}{R} leased"
+                  f"  {RD}{c.get('failed', 0)}{R} failed   {GY}workers:{R} "
+                  + (", ".join(w['worker'] for w in q.get('workers', [])) or f"{GY}none{R}"))
+        except Exception as e:
+            pwarn(f"Queue: {e}")
+    bud = sc.get('budget', {})
+    if bud.get('per_min'):
+        print(f"  {GY}Budget:{R} {WH}{bud['last_min']}/{bud['per_min']:g}{R} per min"
+              f"   tokens {CY}{bud['tokens']:.1f}/{bud['burst']}{R}"
+              f"   throttled {YL}{bud['throttled']}{R}"
+              f"   {GY}jitter ±{bud.get('jitter', 0)*100:.0f}%{R}")
+    stages = sc.get('engine', {}).get('stages', {})
+    if stages:
+        print(f"  {GY}Stages:{R} " + "   ".join(
+            f"{name} {CY}{st['active']}/{st['limit']}{R}{GY}+{st['waiting']}{R}"
+            for name, st in stages.items()))
+
+    load = sc.get('load', {})
+    print(f"\n  {GY}Intervals:{R}  {GY}({'adaptive' if sc.get('adaptive') else 'fixed'}){R}")
     for level, hours in sc['intervals'].items():
         color = RISK_C.get(level, GY)
         tag   = RISK_TAG.get(level, '[???]')
-        print(f"    {color}{tag}{R}  every {WH}{hours}h{R}")
-
-    jobs = list_jobs()
+        lo, hi = sc.get('bounds', {}).get(level, (hours, hours))
+        daily = load.get('by_risk', {}).get(level, {}).get('daily', 0)
+        print(f"    {color}{tag}{R}  every {WH}{hours}h{R}  {GY}[{lo:g}h–{hi:g}h]{R}  {CY}{daily:.0f}/day{R}")
+    if load:
+        print(f"  {GY}Projected:{R} {WH}{load.get('daily_fetches', 0):.0f}{R} fetches/day"
+              f"  {GY}(fixed intervals: {load.get('fixed_daily_fetches', 0):.0f}){R}")
+
+    jobs = list_jobs(8)
     if jobs:
         print(f"\n  {GY}Upcoming rescans:{R}")
         for j in jobs[:8]:
@@ -600,11 +636,10 @@ def scheduler_menu():
 
 def export_flow():
     from collector.exporter import export_json, export_csv, export_html_report
-    shops = export_all_json()
-    stats = get_stats()
+    stats = get_storage().get_stats()
 
     section('EXPORT')
-    print(f"  {GY}{len(shops)} sites in database{R}\n")
+    print(f"  {GY}{stats.get('total',0)} sites in database{R}\n")
     print(f"  {GR}[1]{R}  JSON   {GY}structured, wallets + threat intel{R}")
     print(f"  {GR}[2]{R}  CSV    {GY}flat table, Excel compatible{R}")
     print(f"  {GR}[3]{R}  HTML   {GY}forensic report for LEA / CERT{R}")
@@ -613,9 +648,10 @@ def export_flow():
 
     opt   = prompt()
     paths = []
-    if opt in ('1','4'): paths.append(export_json(shops))
-    if opt in ('2','4'): paths.append(export_csv(shops))
-    if opt in ('3','4'): paths.append(export_html_report(shops, stats))
+    store = get_storage()
+    if opt in ('1','4'): paths.append(export_json(store.iter_export_shops()))
+    if opt in ('2','4'): paths.append(export_csv(store.iter_export_shops()))
+    if opt in ('3','4'): paths.append(export_html_report(store.iter_export_shops(), stats))
 
     if paths:
         print()
@@ -656,22 +692,25 @@ def delete_flow():
                 out.add(int(chunk))
         return sorted(out)
 
+    store = get_storage()
     while True:
         section('DATABASE MANAGEMENT')
         print(f"\n  {GR}[1]{R}  List last 25"
               f"   {GR}[2]{R}  Search"
               f"   {YL}[3]{R}  Delete by ID"
+              f"   {CY}[4]{R}  Rebuild stats"
+              f"   {CY}[5]{R}  Archive + vacuum"
               f"   {GY}[0]{R}  Back\n")
         opt = prompt()
         if opt == '0':
             return
         elif opt == '1':
-            print_table(list_shops(25)); pause()
+            print_table(store.list_shops(25)); pause()
         elif opt == '2':
             q = prompt('Search (url / domain / title):')
-            print_table(list_shops(25, q=q)); pause()
+            print_table(store.list_shops(25, q=q)); pause()
         elif opt == '3':
-            print_table(list_shops(25))
+            print_table(store.list_shops(25))
             sids = prompt('IDs to delete (e.g. 1,3-7):')
             ids  = parse_ids(sids)
             if not ids:
@@ -680,8 +719,30 @@ def delete_flow():
             confirm = prompt("Type DELETE to confirm:")
             if confirm != 'DELETE':
                 print(f"\n  {GY}Cancelled.{R}\n"); continue
-            deleted = sum(1 for sid in ids if delete_shop_by_id(sid))
+            deleted = sum(1 for sid in ids if store.delete_shop(sid))
             pok(f"Deleted: {WH}{deleted}{R}")
+        elif opt == '4':
+            store.rebuild_stats()
+            pok('Materialized stats rebuilt.'); pause()
+        elif opt == '5':
+            if store.name != 'sqlite':
+                pwarn(f"Retention/vacuum only applies to SQLite (backend: {store.name})."); pause()
+                continue
+            sp = db_space()
+            if sp['auto_vacuum'] != 'incremental':
+                pwarn("DB without incremental auto_vacuum: space is only reclaimed after a full VACUUM.")
+                if prompt("Run full VACUUM now? (locks the DB) [y/N]").lower() == 'y':
+                    res = enable_incremental_vacuum()
+                    pok(f"VACUUM done: {WH}{res['reclaimed_bytes']/1048576:.1f} MB{R} reclaimed")
+            rep = run_retention()
+            for table, n in rep['archived'].items():
+                print(f"  {GY}{table:<18}{R} {WH}{n}{R} rows archived")
+            for table, err in rep['errors'].items():
+                perr(f"{table}: {err}")
+            pok(f"Reclaimed {WH}{rep['reclaimed_bytes']/1048576:.1f} MB{R} · "
+                f"DB {WH}{rep['space']['size_bytes']/1048576:.1f} MB{R} "
+                f"({rep['elapsed_s']}s)")
+            pause()
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  BROWSER
@@ -713,13 +774,17 @@ def main_menu():
         except ImportError:
             pass
 
-    init_db()
+    store = get_storage()
+    store.init()
     start_scheduler()
+    # archivo + vacuum en segundo plano también sin dashboard (solo SQLite)
+    if store.name == "sqlite":
+        start_retention()
     host, port = '127.0.0.1', 8000
 
     while True:
         banner()
-        stats = get_stats()
+        stats = get_storage().get_stats()
         status_panel(stats)
         main_menu_draw(stats)
 
@@ -756,9 +821,15 @@ def main_menu():
             print(f"\n  {GY}Session terminated. Stay sharp.{R}\n")
             try:
                 from collector.scheduler import stop_scheduler
+                from collector.engine import stop_engine
+                from collector.capture import stop_capture_service
                 stop_scheduler()
+                stop_capture_service()
+                stop_engine()
+                stop_retention()
             except Exception:
                 pass
+            close_storage()
             break
         else:
             perr('Invalid option.')
@@ -1,24 +1,23 @@
 """
 SCRACHER v3 — Scheduler
 Re-escaneo periódico automático de sitios conocidos.
-FIX: job function a nivel de módulo para ser serializable por APScheduler.
+La cola es la propia tabla shops: next_scan_at + índice parcial. Un único hilo
+despachador saca por lotes los sitios vencidos y los reparte al pool de
+escaneo compartido (collector.engine); no hay un job por sitio, así que
+arrancar, listar y contar cuesta lo mismo con cien sitios que con cien mil.
+Con RESCAN_ADAPTIVE cada sitio tiene su propio intervalo, estimado a partir de
+cuántas veces ha cambiado su content_hash, dentro de los límites de su riesgo.
+Cada vencimiento lleva ±RESCAN_JITTER y el despacho pasa por un cubo de tokens
+(RESCAN_FETCH_PER_MIN): tras un reinicio o una importación grande la cola
+atrasada se vacía a ritmo constante en vez de en ráfaga.
 """
 
 import os
-import logging
-from pathlib import Path
-from datetime import datetime, timezone
-
-try:
-    from apscheduler.schedulers.background import BackgroundScheduler
-    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-    from apscheduler.executors.pool import ThreadPoolExecutor
-    APSCHEDULER_AVAILABLE = True
-except ImportError:
-    APSCHEDULER_AVAILABLE = False
-
-ROOT   = Path(__file__).resolve().parents[1]
-DB_URL = f"sqlite:///{ROOT / 'data' / 'scheduler.db'}"
+import random
+import threading
+from time import monotonic
+from collections import deque
+from datetime import datetime, timedelta, timezone
 
 RESCAN_INTERVALS = {
     "critical": int(os.getenv("RESCAN_CRITICAL_H", "6")),
@@ -26,170 +25,395 @@ RESCAN_INTERVALS = {
     "medium":   int(os.getenv("RESCAN_MEDIUM_H",   "24")),
     "low":      int(os.getenv("RESCAN_LOW_H",       "48")),
 }
-
-logging.getLogger("apscheduler").setLevel(logging.WARNING)
-
-_scheduler = None
+DEFAULT_INTERVAL_H = 48   # riesgos sin intervalo propio (clean, unknown)
+
+# Intervalo adaptativo: límites por riesgo (por defecto base/3 … base×4)
+RESCAN_ADAPTIVE = os.getenv("RESCAN_ADAPTIVE", "true").lower() == "true"
+ADAPT_WINDOW    = int(os.getenv("RESCAN_ADAPT_WINDOW", "10"))   # escaneos que se miran
+ADAPT_FACTOR    = float(os.getenv("RESCAN_ADAPT_FACTOR", "0.5"))  # pasadas por cambio esperado⁻¹
+RESCAN_BOUNDS = {
+    level: (float(os.getenv(f"RESCAN_{level.upper()}_MIN_H", str(hours / 3))),
+            float(os.getenv(f"RESCAN_{level.upper()}_MAX_H", str(hours * 4))))
+    for level, hours in RESCAN_INTERVALS.items()
+}
+DEFAULT_BOUNDS = (DEFAULT_INTERVAL_H / 3, DEFAULT_INTERVAL_H * 4)
+
+SCHED_TICK_S  = float(os.getenv("SCHED_TICK_S", "30"))   # sondeo de la cola cuando no hay nada vencido
+SCHED_BATCH   = int(os.getenv("SCHED_BATCH", "20"))      # sitios por reclamación
+RESCAN_WORKERS = int(os.getenv("RESCAN_WORKERS", "4"))  # re-escaneos a la vez dentro del engine
+
+RESCAN_JITTER  = float(os.getenv("RESCAN_JITTER", "0.1"))          # ±10 % sobre cada intervalo
+RESCAN_PER_MIN = float(os.getenv("RESCAN_FETCH_PER_MIN", "30"))    # presupuesto global (0 = sin límite)
+RESCAN_BURST   = int(os.getenv("RESCAN_BURST", "5"))               # tokens acumulables en reposo
+
+# Con RESCAN_VIA_QUEUE los vencidos se encolan en collector.workqueue y los
+# ejecutan los procesos `python -m collector.worker` en vez del engine local
+RESCAN_VIA_QUEUE = os.getenv("RESCAN_VIA_QUEUE", "false").lower() == "true"
+_QUEUE_PRIORITY  = {"critical": 3, "high": 2, "medium": 1}
+
+_thread   = None
+_running  = False
+_stop     = threading.Event()
+_wake     = threading.Event()   # un worker terminó: hay hueco para el siguiente lote
+_lock     = threading.Lock()
+_inflight = set()
+_status   = {"dispatched": 0, "last_dispatch": None, "last_error": None}
+_lags     = deque(maxlen=500)  # retraso (s) sobre next_scan_at de los últimos despachos
+_load     = {"at": None, "value": None}   # caché de projected_load() (recorre shops)
+_recent   = deque()                        # instantes (monotonic) de los despachos del último minuto
+
+
+class _Budget:
+    """Cubo de tokens: per_min re-escaneos por minuto, ráfaga máxima de `burst`."""
+
+    def __init__(self, per_min: float, burst: int):
+        self.rate      = max(0.0, per_min) / 60
+        self.cap       = max(1, burst)
+        self.tokens    = float(self.cap)
+        self.t         = monotonic()
+        self.throttled = 0
+        self.lock      = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+    def take(self, n: int) -> int:
+        """Concede hasta n tokens (todos si no hay límite)."""
+        if self.rate <= 0:
+            return n
+        with self.lock:
+            self._refill()
+            k = min(n, int(self.tokens))
+            self.tokens -= k
+            if k < n:
+                self.throttled += 1
+            return k
+
+    def refund(self, n: int):
+        if self.rate > 0 and n > 0:
+            with self.lock:
+                self.tokens = min(self.cap, self.tokens + n)
+
+    def wait_s(self) -> float:
+        """Segundos hasta el siguiente token."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def status(self) -> dict:
+        with self.lock:
+            self._refill()
+            return {"per_min": round(self.rate * 60, 1), "burst": self.cap,
+                    "tokens": round(self.tokens, 2), "throttled": self.throttled}
+
+_budget = _Budget(RESCAN_PER_MIN, RESCAN_BURST)
+
+def _jittered(hours: float) -> float:
+    return hours * (1 + random.uniform(-RESCAN_JITTER, RESCAN_JITTER))
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-#  JOB FUNCTION — DEBE estar a nivel de módulo para ser serializable
+#  JOB FUNCTION
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _rescan_job(shop_id: int, url: str):
+def rescan_shop(shop_id: int, url: str) -> str:
     """
-    Función de re-escaneo periódico.
-    Definida a nivel de módulo para que APScheduler pueda serializarla.
+    Re-escanea un sitio y lo vuelve a programar según su riesgo actual.
+    Devuelve el risk_level; los errores se propagan (los workers de
+    collector.worker reintentan).
     """
-    from collector.scrape import scrape_one
-    from collector.db import (
-        upsert_shop, replace_tech, add_screenshot,
-        replace_keywords, replace_tags, add_discovered_links,
-    )
+    from collector.scrape import scrape_one, attach_capture
+    from collector.storage import get_storage
     from collector.alerts import dispatch_alerts
 
-    try:
-        data   = scrape_one(url)
-        threat = data.get("threat", {})
-        rl     = threat.get("risk_level", "unknown")
-
-        sid = upsert_shop(
-            url=data["url"], domain=data.get("domain"),
-            title=data.get("title"), status="ok",
-            risk_score=threat.get("risk_score", 0), risk_level=rl,
-            content_hash=data.get("content_hash"),
-            language=data.get("language"),
-        )
-        replace_tech(sid, data.get("tech", []))
-        replace_keywords(sid, threat.get("keywords", []))
-        replace_tags(sid, threat.get("tags", []))
-
-        sc = data.get("screenshot") or {}
-        if sc.get("path"):
-            add_screenshot(sid, sc["path"], sc.get("width"), sc.get("height"))
-
-        if data.get("onion_links"):
-            add_discovered_links(sid, data["onion_links"])
-
-        dispatch_alerts({
-            "shop_id": sid, "url": data["url"],
-            "domain": data.get("domain"), "title": data.get("title"),
-            "risk_level": rl,
-            "risk_score": threat.get("risk_score", 0),
-            "tags": threat.get("tags", []),
-            "keywords": threat.get("keywords", []),
-        })
+    data   = scrape_one(url)
+    threat = data.get("threat", {})
+    rl     = threat.get("risk_level", "unknown")
 
-        _log_rescan(shop_id, url, "ok", rl)
+    sid, _ = get_storage().persist_scan_result(data, threat_intel=False)
+    attach_capture(data, sid)
 
+    dispatch_alerts({
+        "shop_id": sid, "url": data["url"],
+        "domain": data.get("domain"), "title": data.get("title"),
+        "risk_level": rl,
+        "risk_score": threat.get("risk_score", 0),
+        "tags": threat.get("tags", []),
+        "keywords": threat.get("keywords", []),
+    })
+
+    schedule_rescan(sid, data["url"], rl)
+    return rl
+
+def _rescan_job(shop_id: int, url: str):
+    try:
+        rl = rescan_shop(shop_id, url)
+        _log_rescan(shop_id, url, "ok", rl)
     except Exception as e:
         _log_rescan(shop_id, url, "error", str(e))
 
 
 # ─────────────────────────────────────────────────────────────────────────────
+#  DISPATCHER
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _job_done(shop_id: int):
+    def done(_future):
+        with _lock:
+            _inflight.discard(shop_id)
+        _wake.set()
+    return done
+
+def dispatch_due() -> int:
+    """
+    Reclama tantos sitios vencidos como workers libres (máx. SCHED_BATCH) y
+    tokens quedan en el presupuesto por minuto. Con RESCAN_VIA_QUEUE los
+    encola para los workers, manteniendo como mucho SCHED_BATCH listos.
+    Al reclamar ya se fija su siguiente pasada, así que un sitio nunca corre
+    dos veces a la vez y los atrasos se resuelven con un único escaneo.
+    """
+    from collector.storage import get_storage
+    from collector.engine import get_engine
+    if RESCAN_VIA_QUEUE:
+        from collector.workqueue import get_broker
+        free = SCHED_BATCH - get_broker().counts()["ready"]
+    else:
+        with _lock:
+            free = RESCAN_WORKERS - len(_inflight)
+    if free <= 0 or not _running:
+        return 0
+    want = _budget.take(min(free, SCHED_BATCH))
+    if want == 0:
+        return 0
+    try:
+        rows = get_storage().claim_due_rescans(want, RESCAN_INTERVALS, DEFAULT_INTERVAL_H,
+                                               RESCAN_JITTER)
+    except Exception:
+        _budget.refund(want)
+        raise
+    _budget.refund(want - len(rows))
+    now = datetime.now(timezone.utc)
+    with _lock:
+        _lags.extend(max(0.0, (now - datetime.fromisoformat(r["next_scan_at"])).total_seconds())
+                     for r in rows)
+    if RESCAN_VIA_QUEUE:
+        from collector.workqueue import get_broker, job
+        get_broker().enqueue([job("rescan", r["id"], {"url": r["url"]},
+                                  _QUEUE_PRIORITY.get(r["risk_level"], 0)) for r in rows])
+    else:
+        engine = get_engine()
+        for r in rows:
+            with _lock:
+                _inflight.add(r["id"])
+            engine.submit(_rescan_job, int(r["id"]), r["url"]).add_done_callback(_job_done(r["id"]))
+    if rows:
+        t = monotonic()
+        with _lock:
+            _status["dispatched"]   += len(rows)
+            _status["last_dispatch"] = now.isoformat(timespec="seconds")
+            _recent.extend([t] * len(rows))
+    return len(rows)
+
+def _budget_status() -> dict:
+    st = _budget.status()
+    cutoff = monotonic() - 60
+    with _lock:
+        while _recent and _recent[0] < cutoff:
+            _recent.popleft()
+        st["last_min"] = len(_recent)
+    st["jitter"] = RESCAN_JITTER
+    return st
+
+def _lag_metrics(oldest_due: str | None) -> dict:
+    """
+    backlog_s: cuánto lleva vencido el sitio más atrasado que sigue en cola.
+    p50/p95/max: retraso con que se despacharon los últimos re-escaneos.
+    """
+    now = datetime.now(timezone.utc)
+    backlog = 0.0
+    if oldest_due:
+        backlog = max(0.0, (now - datetime.fromisoformat(oldest_due)).total_seconds())
+    with _lock:
+        lags = sorted(_lags)
+    def pct(p):
+        return round(lags[min(len(lags) - 1, int(p * len(lags)))], 1) if lags else 0.0
+    return {"backlog_s": round(backlog, 1), "p50_s": pct(0.50), "p95_s": pct(0.95),
+            "max_s": round(lags[-1], 1) if lags else 0.0, "samples": len(lags)}
+
+def _loop():
+    while not _stop.is_set():
+        _wake.clear()
+        try:
+            n = dispatch_due()
+        except Exception as e:
+            n = 0
+            with _lock:
+                _status["last_error"] = str(e)
+        if n == 0:
+            # sin tokens: despertar justo cuando llegue el siguiente, no al tick
+            with _lock:
+                busy = len(_inflight) >= RESCAN_WORKERS
+            wait = SCHED_TICK_S
+            if not busy and _budget.wait_s() > 0:
+                wait = min(SCHED_TICK_S, _budget.wait_s())
+            _wake.wait(timeout=wait)
 
-def get_scheduler():
-    global _scheduler
-    if not APSCHEDULER_AVAILABLE:
-        return None
-    if _scheduler is None:
-        jobstores    = {"default": SQLAlchemyJobStore(url=DB_URL)}
-        executors    = {"default": ThreadPoolExecutor(max_workers=2)}
-        job_defaults = {"coalesce": True, "max_instances": 1, "misfire_grace_time": 3600}
-        _scheduler   = BackgroundScheduler(
-            jobstores=jobstores,
-            executors=executors,
-            job_defaults=job_defaults,
-        )
-    return _scheduler
 
+# ─────────────────────────────────────────────────────────────────────────────
 
 def start_scheduler():
-    sched = get_scheduler()
-    if sched and not sched.running:
-        sched.start()
-        return True
-    return False
+    global _thread, _running
+    if _thread is not None and _thread.is_alive():
+        return False
+    _stop.clear()
+    _running = True
+    _thread  = threading.Thread(target=_loop, name="scracher-scheduler", daemon=True)
+    _thread.start()
+    return True
 
 
 def stop_scheduler():
-    sched = get_scheduler()
-    if sched and sched.running:
-        sched.shutdown(wait=False)
+    """Deja de despachar; los re-escaneos ya en el engine terminan solos."""
+    global _running
+    _running = False
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  INTERVALO ADAPTATIVO
+# ─────────────────────────────────────────────────────────────────────────────
+
+def estimate_interval(history: list[dict], risk_level: str) -> float:
+    """
+    Intervalo (h) a partir de los últimos escaneos (más reciente primero).
+    Tasa de cambio λ = (cambios + ½) / (horas observadas + base): el término
+    ½/base es un prior que, sin historial, devuelve exactamente el intervalo
+    base del riesgo. Se re-escanea cada ADAPT_FACTOR/λ horas, acotado a
+    RESCAN_BOUNDS: páginas estáticas se alargan hacia el máximo y los mercados
+    que cambian en cada pasada bajan hacia el mínimo.
+    """
+    base   = RESCAN_INTERVALS.get(risk_level, DEFAULT_INTERVAL_H)
+    lo, hi = RESCAN_BOUNDS.get(risk_level, DEFAULT_BOUNDS)
+    scans  = [h for h in history if h.get("scanned_at") and h.get("content_hash")]
+    changes, span = 0, 0.0
+    if len(scans) >= 2:
+        changes = sum(1 for a, b in zip(scans, scans[1:]) if a["content_hash"] != b["content_hash"])
+        span = (datetime.fromisoformat(scans[0]["scanned_at"])
+                - datetime.fromisoformat(scans[-1]["scanned_at"])).total_seconds() / 3600
+    rate = (changes + 0.5) / (max(span, 0.0) + base)
+    return round(min(hi, max(lo, ADAPT_FACTOR / rate)), 2)
+
+def rescan_interval(shop_id: int, risk_level: str) -> float:
+    """Intervalo que toca a un sitio: adaptado si RESCAN_ADAPTIVE, fijo por riesgo si no."""
+    if not RESCAN_ADAPTIVE:
+        return RESCAN_INTERVALS.get(risk_level, DEFAULT_INTERVAL_H)
+    from collector.storage import get_storage
+    return estimate_interval(get_storage().get_change_history(shop_id, ADAPT_WINDOW), risk_level)
+
+def projected_load(max_age_s: float = 60) -> dict:
+    """
+    Re-escaneos (fetches por Tor) previstos al día con los intervalos actuales,
+    frente a los que saldrían con RESCAN_INTERVALS fijos. Cacheado max_age_s.
+    """
+    if _load["at"] is not None and monotonic() - _load["at"] < max_age_s:
+        return _load["value"]
+    from collector.storage import get_storage
+    by_risk, total, fixed = {}, 0.0, 0.0
+    for r in get_storage().rescan_load():
+        base  = RESCAN_INTERVALS.get(r["risk_level"], DEFAULT_INTERVAL_H)
+        daily = float(r["daily"]) + int(r["unset"]) * 24 / base
+        by_risk[r["risk_level"] or "unknown"] = {"shops": r["shops"], "daily": round(daily, 1)}
+        total += daily
+        fixed += r["shops"] * 24 / base
+    value = {"daily_fetches": round(total, 1), "fixed_daily_fetches": round(fixed, 1),
+             "by_risk": by_risk}
+    _load.update(at=monotonic(), value=value)
+    return value
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+
 def schedule_rescan(shop_id: int, url: str, risk_level: str = "low") -> bool:
-    sched = get_scheduler()
-    if not sched:
+    """Fija el siguiente re-escaneo a ahora + intervalo del sitio (reemplaza el anterior)."""
+    from collector.storage import get_storage
+    try:
+        hours   = rescan_interval(int(shop_id), risk_level)
+        next_at = (datetime.now(timezone.utc)
+                   + timedelta(hours=_jittered(hours))).isoformat(timespec="seconds")
+        return get_storage().set_next_scan(int(shop_id), next_at, hours) > 0
+    except Exception:
         return False
 
-    hours  = RESCAN_INTERVALS.get(risk_level, 48)
-    job_id = f"rescan_{shop_id}"
-
-    sched.add_job(
-        _rescan_job,
-        trigger="interval",
-        hours=hours,
-        id=job_id,
-        kwargs={"shop_id": int(shop_id), "url": str(url)},
-        name=f"Rescan [{risk_level.upper()}] {url[:60]}",
-        replace_existing=True,
-    )
-    return True
-
 
 def unschedule_rescan(shop_id: int) -> bool:
-    sched = get_scheduler()
-    if not sched:
+    from collector.storage import get_storage
+    try:
+        return get_storage().set_next_scan(int(shop_id), None) > 0
+    except Exception:
         return False
-    job_id = f"rescan_{shop_id}"
-    if sched.get_job(job_id):
-        sched.remove_job(job_id)
-        return True
-    return False
 
 
-def list_jobs() -> list[dict]:
-    sched = get_scheduler()
-    if not sched:
+def list_jobs(limit: int = 50) -> list[dict]:
+    """Próximos re-escaneos (ya ordenados por el índice de next_scan_at)."""
+    from collector.storage import get_storage
+    try:
+        rows = get_storage().rescan_queue(limit)
+    except Exception:
         return []
     jobs = []
-    for job in sched.get_jobs():
-        next_run = job.next_run_time
+    for r in rows:
+        rl = r["risk_level"] or "unknown"
         jobs.append({
-            "id":       job.id,
-            "name":     job.name,
-            "next_run": next_run.isoformat() if next_run else None,
-            "trigger":  str(job.trigger),
+            "id":       f"rescan_{r['id']}",
+            "shop_id":  r["id"],
+            "name":     f"Rescan [{rl.upper()}] {r['url'][:60]}",
+            "next_run": r["next_scan_at"],
+            "trigger":  f"every {r.get('rescan_interval_h') or RESCAN_INTERVALS.get(rl, DEFAULT_INTERVAL_H):g}h",
         })
-    return sorted(jobs, key=lambda j: j["next_run"] or "")
+    return jobs
 
 
 def _log_rescan(shop_id: int, url: str, status: str, detail: str):
     try:
-        from collector.db import connect
-        conn = connect()
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS rescan_log (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              shop_id INTEGER, url TEXT, status TEXT, detail TEXT, ran_at TEXT
-            )
-        """)
-        conn.execute("""
-            INSERT INTO rescan_log(shop_id, url, status, detail, ran_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (shop_id, url, status, str(detail)[:500],
-              datetime.now(timezone.utc).isoformat(timespec="seconds")))
-        conn.commit()
-        conn.close()
+        from collector.storage import get_storage
+        get_storage().log_rescan(shop_id, url, status, detail)
     except Exception:
         pass
 
 
 def scheduler_status() -> dict:
+    from collector.storage import get_storage
+    from collector.engine import engine_status
+    try:
+        counts = get_storage().rescan_queue_counts()
+        load   = projected_load()
+    except Exception:
+        counts = {"scheduled": 0, "due": 0, "oldest_due": None}
+        load   = {}
+    with _lock:
+        st = dict(_status)
+        inflight = len(_inflight)
     return {
-        "available": APSCHEDULER_AVAILABLE,
-        "running":   (_scheduler is not None and _scheduler.running),
-        "job_count": len(list_jobs()),
+        "available": True,
+        "running":   _thread is not None and _thread.is_alive(),
+        "job_count": counts["scheduled"],
+        "due":       counts["due"],
+        "inflight":  inflight,
+        "workers":   RESCAN_WORKERS,
+        "via_queue": RESCAN_VIA_QUEUE,
         "intervals": RESCAN_INTERVALS,
+        "adaptive":  RESCAN_ADAPTIVE,
+        "bounds":    RESCAN_BOUNDS,
+        "load":      load,
+        "lag":       _lag_metrics(counts.get("oldest_due")),
+        "budget":    _budget_status(),
+        "engine":    engine_status(),
+        **st,
     }
@@ -7,6 +7,7 @@ import re
 import hashlib
 import os
 import warnings
+from concurrent.futures import Future
 from urllib.parse import urlparse
 import requests
 from requests.adapters import HTTPAdapter
@@ -14,11 +15,13 @@ from urllib3.util.retry import Retry
 from urllib3.exceptions import InsecureRequestWarning
 
 from collector.tech_detect    import detect_from_headers, detect_from_html, merge_unique
-from collector.capture        import take_screenshot
-from collector.content_analyze import analyze_content, detect_language
+from collector.capture        import submit_capture
+from collector.content_analyze import analyze_content, detect_language, extract_text
 from collector.link_extract   import extract_onion_links
 from collector.crypto_extract import extract_wallets, wallets_summary
 from collector.ocr_extract    import ocr_screenshot
+from collector.shotstore      import SHOT_DEDUP, store_screenshot
+from collector.engine         import stage, get_engine
 
 warnings.filterwarnings("ignore", category=InsecureRequestWarning)
 
@@ -26,6 +29,8 @@ TOR_SOCKS  = os.getenv("TOR_SOCKS", "socks5h://127.0.0.1:9050")
 USE_VT     = bool(os.getenv("VT_API_KEY", ""))
 ENABLE_OCR = os.getenv("ENABLE_OCR", "true").lower() == "true"
 ENABLE_TI  = os.getenv("ENABLE_THREAT_INTEL", "true").lower() == "true"
+# true: scrape_one() no espera a la captura; la guarda attach_capture() al terminar
+CAPTURE_ASYNC = os.getenv("CAPTURE_ASYNC", "true").lower() == "true"
 
 def _make_session():
     s = requests.Session()
@@ -67,7 +72,8 @@ def scrape_one(url: str, run_threat_intel: bool = None) -> dict:
     """
     do_ti = run_threat_intel if run_threat_intel is not None else ENABLE_TI
 
-    final_url, headers, html = fetch(url)
+    with stage("fetch"):
+        final_url, headers, html = fetch(url)
     domain = get_domain(final_url)
     title  = extract_title(html)
     chash  = content_hash(html)
@@ -85,14 +91,13 @@ def scrape_one(url: str, run_threat_intel: bool = None) -> dict:
     # Links .onion descubiertos
     onion_links = extract_onion_links(html, base_url=final_url)
 
-    # Screenshot + OCR
+    # Screenshot + OCR: la captura va al servicio de capturas mientras seguimos
     screenshot = {"path": None, "width": None, "height": None}
     ocr_result = {"available": False, "text": ""}
+    capture = None
     try:
-        rel_path, w, h = take_screenshot(final_url)
-        screenshot = {"path": rel_path, "width": w, "height": h}
-        if ENABLE_OCR and rel_path:
-            ocr_result = ocr_screenshot(rel_path)
+        ctype   = next((v for k, v in headers.items() if k.lower() == "content-type"), "text/html")
+        capture = submit_capture(final_url, html=html if "html" in ctype.lower() else None)
     except Exception as e:
         screenshot["error"] = str(e)
 
@@ -105,12 +110,26 @@ def scrape_one(url: str, run_threat_intel: bool = None) -> dict:
         except Exception as e:
             threat_intel = {"error": str(e), "external_risk": "unknown"}
 
+    # La etapa "screenshot" solo limita la espera síncrona; en modo asíncrono
+    # la concurrencia la fija el servicio (CAPTURE_BROWSERS × CAPTURE_CONTEXTS)
+    if capture is not None and not CAPTURE_ASYNC:
+        try:
+            with stage("screenshot"):
+                shot = capture.result()
+            screenshot, ocr_result = _screenshot_result(shot, final_url, chash)
+        except Exception as e:
+            screenshot["error"] = str(e)
+        capture = None
+    elif capture is not None:
+        screenshot["pending"] = True
+
     return {
         "url":          final_url,
         "domain":       domain,
         "title":        title,
         "content_hash": chash,
         "language":     lang,
+        "text":         extract_text(html),
         "tech":         tech,
         "threat":       threat,
         "threat_intel": threat_intel,
@@ -119,4 +138,74 @@ def scrape_one(url: str, run_threat_intel: bool = None) -> dict:
         "screenshot":   screenshot,
         "ocr":          ocr_result,
         "onion_links":  onion_links,
+        "capture":      capture,      # Future de la captura pendiente (CAPTURE_ASYNC) o None
     }
+
+
+def _screenshot_result(shot, url: str, content_hash: str | None = None) -> tuple[dict, dict]:
+    """
+    (png, w, h) de la captura → dicts screenshot y ocr de scrape_one(). La imagen
+    va al almacén de capturas; si el HTML (content_hash) no cambió y es casi
+    igual a la última del sitio no se guarda (path None, duplicate True) ni se
+    le pasa OCR.
+    """
+    from collector.storage import get_storage
+    png, w, h = shot
+    ocr_result = {"available": False, "text": ""}
+    saved = store_screenshot(png, get_storage().last_screenshot(url) if SHOT_DEDUP else None,
+                             content_hash)
+    screenshot = {"path": saved["path"], "width": w, "height": h,
+                  "sha256": saved["sha256"], "phash": saved["phash"],
+                  "content_hash": content_hash}
+    if saved["duplicate"]:
+        screenshot.update(duplicate=True, same_as=saved.get("same_as"))
+    elif ENABLE_OCR:
+        with stage("ocr"):
+            ocr_result = ocr_screenshot(saved["path"])
+    return screenshot, ocr_result
+
+def _store_capture(shop_id: int, url: str, shot, content_hash: str | None = None):
+    from collector.storage import get_storage
+    screenshot, ocr_result = _screenshot_result(shot, url, content_hash)
+    if screenshot["path"]:
+        get_storage().add_screenshot(shop_id, screenshot["path"], screenshot["width"],
+                                     screenshot["height"], ocr_result.get("text") or None,
+                                     screenshot["sha256"], screenshot["phash"], content_hash)
+    return screenshot
+
+def attach_capture(data: dict, shop_id: int) -> Future | None:
+    """
+    Llamar tras persistir un resultado de scrape_one(): cuando termine su captura
+    pendiente, OCR y fila en screenshots (en el pool de escaneo, no en el hilo
+    de capturas). Devuelve un Future que resuelve al dict screenshot, o None.
+    """
+    capture = data.get("capture")
+    if capture is None:
+        return None
+    stored = Future()
+
+    def _done(f: Future):
+        if f.cancelled():
+            stored.cancel()
+            return
+        if f.exception() is not None:
+            stored.set_exception(f.exception())
+            return
+        try:
+            job = get_engine().submit(_store_capture, shop_id, data["url"], f.result(),
+                                      data.get("content_hash"))
+        except Exception as e:              # pool ya parado (cierre del proceso)
+            stored.set_exception(e)
+            return
+        job.add_done_callback(_stored)
+
+    def _stored(j: Future):
+        if j.cancelled():
+            stored.cancel()
+        elif j.exception() is not None:
+            stored.set_exception(j.exception())
+        else:
+            stored.set_result(j.result())
+
+    capture.add_done_callback(_done)
+    return stored
@@ -0,0 +1,236 @@
+"""
+SCRACHER v3 — Screenshot store
+Almacén de capturas direccionado por contenido: cada imagen se guarda una sola
+vez como screenshots/<sha256>.webp, y varias filas de `screenshots` pueden
+apuntar al mismo fichero.
+Antes de guardar se calcula un hash perceptual: un dHash de 64 bits por
+casilla de una rejilla SHOT_HASH_GRID×SHOT_HASH_GRID sobre el viewport (un
+solo dHash de la página entera no ve cambios de texto). Si ninguna casilla
+difiere en más de SHOT_DEDUP_BITS bits de la última captura del sitio, la
+captura se descarta: no hay fichero, ni fila, ni OCR. Solo se descarta si el
+HTML es el mismo (content_hash del escaneo): con contenido nuevo la captura
+se guarda y pasa por OCR siempre. Sin Pillow se guarda el PNG tal cual y solo
+se descartan copias exactas (mismo sha256).
+Los ficheros que ya no referencia ninguna fila (sitios borrados, filas
+archivadas) se eliminan con release() / gc_screenshots().
+"""
+
+import os
+import io
+import hashlib
+import threading
+from pathlib import Path
+from time import time
+
+ROOT       = Path(__file__).resolve().parents[1]
+STATIC_DIR = ROOT / "dashboard" / "static"
+SHOT_DIR   = STATIC_DIR / "screenshots"
+
+SHOT_FORMAT     = os.getenv("SHOT_FORMAT", "webp").strip().lower()   # webp / png
+SHOT_QUALITY    = int(os.getenv("SHOT_QUALITY", "80"))               # calidad WebP (con pérdida)
+SHOT_DEDUP      = os.getenv("SHOT_DEDUP", "true").lower() == "true"
+SHOT_DEDUP_BITS = int(os.getenv("SHOT_DEDUP_BITS", "4"))             # distancia Hamming máx. por casilla (de 64)
+SHOT_HASH_GRID  = int(os.getenv("SHOT_HASH_GRID", "8"))              # casillas por lado del dHash
+SHOT_HASH_TOP   = int(os.getenv("SHOT_HASH_TOP", "768"))             # alto del recorte (viewport de capture.py)
+SHOT_GC_GRACE_S = float(os.getenv("SHOT_GC_GRACE_S", "600"))         # no borrar ficheros más recientes
+
+WEBP_MAX_SIDE = 16383   # límite del formato; capturas más altas se quedan en PNG
+
+# Pillow es opcional (el mismo que usa OCR)
+try:
+    from PIL import Image, features
+    PIL_AVAILABLE  = True
+    WEBP_AVAILABLE = bool(features.check("webp"))
+except ImportError:
+    PIL_AVAILABLE  = False
+    WEBP_AVAILABLE = False
+
+_lock  = threading.Lock()
+_stats = {"stored": 0, "reused": 0, "near_dup": 0, "exact_dup": 0,
+          "png_bytes": 0, "stored_bytes": 0, "gc_removed": 0, "gc_bytes": 0}
+
+
+def _count(**kw):
+    with _lock:
+        for k, v in kw.items():
+            _stats[k] += v
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  HASH PERCEPTUAL
+# ─────────────────────────────────────────────────────────────────────────────
+
+def dhash(img) -> str:
+    """
+    dHash de 64 bits: imagen en grises a 9×8 y un bit por píxel según sea más
+    claro que su vecino derecho. Robusto a recompresión y cambios pequeños
+    (un contador, un reloj); sobre una página entera tampoco ve texto nuevo,
+    por eso se aplica por casillas (tile_hash).
+    """
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    px    = list(small.getdata())
+    bits  = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def tile_hash(img) -> str:
+    """
+    dHash de cada casilla de una rejilla SHOT_HASH_GRID×SHOT_HASH_GRID sobre
+    los primeros SHOT_HASH_TOP px de la página, concatenados (16 hex por
+    casilla). Cada casilla cubre un trozo pequeño, así que un bloque de texto
+    distinto ya mueve bits; una palabra suelta puede no hacerlo, y para eso
+    está la comprobación de content_hash en store_screenshot().
+    """
+    g    = max(1, SHOT_HASH_GRID)
+    w, h = img.size
+    top  = img.convert("L").crop((0, 0, w, min(h, SHOT_HASH_TOP)))
+    th   = top.size[1]
+    return "".join(dhash(top.crop((w * c // g, th * r // g, w * (c + 1) // g, th * (r + 1) // g)))
+                   for r in range(g) for c in range(g))
+
+def distance(a: str, b: str) -> int | None:
+    """Máxima distancia Hamming entre casillas; None si los hashes no son comparables."""
+    if not a or not b or len(a) != len(b):
+        return None
+    return max(hamming(a[i:i + 16], b[i:i + 16]) for i in range(0, len(a), 16))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  ESCRITURA
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _encode(png: bytes, img) -> tuple[bytes, str]:
+    """PNG de Playwright → (bytes, extensión) en SHOT_FORMAT si se puede."""
+    if (img is None or SHOT_FORMAT != "webp" or not WEBP_AVAILABLE
+            or max(img.size) > WEBP_MAX_SIDE):
+        return png, "png"
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="WEBP", quality=SHOT_QUALITY, method=4)
+    return buf.getvalue(), "webp"
+
+def _write(data: bytes, ext: str) -> tuple[str, str]:
+    """Escribe `data` en SHOT_DIR por su sha256 (atómico). Devuelve (rel_path, sha256)."""
+    sha   = hashlib.sha256(data).hexdigest()
+    fname = f"{sha}.{ext}"
+    path  = SHOT_DIR / fname
+    if path.exists():
+        os.utime(path)      # reutilizado: que el GC no lo vea como viejo
+        _count(reused=1)
+    else:
+        SHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        _count(stored=1, stored_bytes=len(data))
+    return f"screenshots/{fname}", sha
+
+def store_screenshot(png: bytes, previous: dict | None = None,
+                     content_hash: str | None = None) -> dict:
+    """
+    Guarda el PNG de una captura. `previous` es la última captura del sitio
+    ({"path", "sha256", "phash", "content_hash"} o None) y `content_hash` el
+    del escaneo que la produjo: si no coinciden la captura se guarda siempre.
+    Devuelve {"path", "sha256", "phash", "duplicate"}; con duplicate=True no
+    se ha escrito nada y path es None.
+    """
+    _count(png_bytes=len(png))
+    img = phash = None
+    if PIL_AVAILABLE:
+        img = Image.open(io.BytesIO(png))
+        img.load()
+        phash = tile_hash(img)
+
+    prev = previous or {}
+    if content_hash is not None and prev.get("content_hash") != content_hash:
+        prev = {}       # contenido nuevo: nada con lo que deduplicar
+    dist = distance(phash, prev.get("phash"))
+    if SHOT_DEDUP and dist is not None and dist <= SHOT_DEDUP_BITS:
+        _count(near_dup=1)
+        return {"path": None, "sha256": prev.get("sha256"), "phash": phash,
+                "duplicate": True, "same_as": prev.get("path")}
+
+    data, ext = _encode(png, img)
+    sha = hashlib.sha256(data).hexdigest()
+    if SHOT_DEDUP and prev.get("sha256") == sha:
+        _count(exact_dup=1)
+        return {"path": None, "sha256": sha, "phash": phash,
+                "duplicate": True, "same_as": prev.get("path")}
+
+    rel_path, sha = _write(data, ext)
+    return {"path": rel_path, "sha256": sha, "phash": phash, "duplicate": False}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  GC
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _unlink_unreferenced(paths, grace_s: float, store=None) -> dict:
+    from collector.storage import get_storage
+    paths = sorted({p for p in paths if p})
+    if not paths:
+        return {"removed": 0, "bytes": 0}
+    live    = (store or get_storage()).referenced_screenshots(paths)
+    cutoff  = time() - grace_s
+    removed = freed = 0
+    for rel in paths:
+        if rel in live:
+            continue
+        f = STATIC_DIR / rel
+        try:
+            st = f.stat()
+            if st.st_mtime > cutoff:    # recién escrito: su fila puede estar en camino
+                continue
+            f.unlink()
+            removed += 1
+            freed   += st.st_size
+        except OSError:
+            pass
+    _count(gc_removed=removed, gc_bytes=freed)
+    return {"removed": removed, "bytes": freed}
+
+def release(paths, grace_s: float = SHOT_GC_GRACE_S, store=None) -> dict:
+    """
+    Tras borrar filas: elimina los ficheros de `paths` que ya no referencia
+    nadie. `store` es el backend que borró (por defecto get_storage()).
+    """
+    try:
+        return _unlink_unreferenced(paths, grace_s, store)
+    except Exception as e:
+        return {"removed": 0, "bytes": 0, "error": str(e)}
+
+def gc_screenshots(grace_s: float = SHOT_GC_GRACE_S, batch: int = 1000) -> dict:
+    """Barrido completo de SHOT_DIR: elimina todo fichero sin fila en screenshots."""
+    if not SHOT_DIR.exists():
+        return {"scanned": 0, "removed": 0, "bytes": 0}
+    scanned = removed = freed = 0
+    chunk = []
+    for f in SHOT_DIR.iterdir():
+        if not f.is_file() or f.suffix == ".tmp" or f.name.startswith("."):
+            continue
+        chunk.append(f"screenshots/{f.name}")
+        if len(chunk) >= batch:
+            r = _unlink_unreferenced(chunk, grace_s)
+            scanned += len(chunk); removed += r["removed"]; freed += r["bytes"]
+            chunk = []
+    if chunk:
+        r = _unlink_unreferenced(chunk, grace_s)
+        scanned += len(chunk); removed += r["removed"]; freed += r["bytes"]
+    return {"scanned": scanned, "removed": removed, "bytes": freed}
+
+
+def shotstore_status() -> dict:
+    with _lock:
+        st = dict(_stats)
+    st["format"]   = "webp" if SHOT_FORMAT == "webp" and WEBP_AVAILABLE else "png"
+    st["phash"]    = PIL_AVAILABLE
+    st["dedup"]    = SHOT_DEDUP
+    st["max_bits"] = SHOT_DEDUP_BITS
+    st["grid"]     = SHOT_HASH_GRID
+    if st["png_bytes"]:
+        st["ratio"] = round(st["stored_bytes"] / st["png_bytes"], 3)
+    return st
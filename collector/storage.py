@@ -0,0 +1,313 @@
+"""
+SCRACHER v3 — Storage
+Interfaz de almacenamiento común para CLI, scheduler y dashboard.
+  DB_BACKEND=sqlite   → data/scrs.db (collector.db + writer por lotes), por defecto
+  DB_BACKEND=postgres → DATABASE_URL (collector.pg_backend), para varios colectores
+                        escribiendo sobre el mismo dataset
+"""
+
+import os
+import threading
+from abc import ABC, abstractmethod
+
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").strip().lower()
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+class Storage(ABC):
+    """
+    Operaciones que usan CLI, scheduler y dashboard. Cada backend las implementa
+    todas y devuelve dicts (o listas de dicts) con las mismas claves; un backend
+    incompleto falla al instanciarse (TypeError), no a mitad de un escaneo.
+    """
+
+    name = "base"
+
+    # ── ciclo de vida ────────────────────────────────────────────────────────
+    @abstractmethod
+    def init(self):                                  ...
+    def close(self):                                 pass
+    def status(self) -> dict:                        return {"backend": self.name}
+
+    # ── escritura ────────────────────────────────────────────────────────────
+    @abstractmethod
+    def persist_scan_result(self, data: dict, threat_intel: bool = True) -> tuple[int, bool]:
+        ...
+    @abstractmethod
+    def upsert_shop(self, url, domain, title, status, risk_score=0.0, risk_level="unknown",
+                    external_risk="unknown", content_hash=None, language=None, notes=None) -> int:
+        ...
+    @abstractmethod
+    def log_alert(self, shop_id, channel, risk_level, sent, reason=None):
+        ...
+    @abstractmethod
+    def log_rescan(self, shop_id, url, status, detail):
+        ...
+    @abstractmethod
+    def add_screenshot(self, shop_id, path, width, height, ocr_text=None,
+                       sha256=None, phash=None, content_hash=None):
+        ...
+    @abstractmethod
+    def delete_shop(self, shop_id) -> int:           ...
+    @abstractmethod
+    def delete_error_shops(self) -> int:             ...
+    @abstractmethod
+    def mark_discovered_scanned(self, link_id):      ...
+    @abstractmethod
+    def mark_discovered_failed(self, link_id):       ...
+    @abstractmethod
+    def rebuild_stats(self):                         ...
+
+    # ── almacén de capturas (collector.shotstore) ────────────────────────────
+    @abstractmethod
+    def last_screenshot(self, url) -> dict | None:   ...
+    @abstractmethod
+    def referenced_screenshots(self, paths) -> set[str]:
+        ...
+
+    # ── cola de re-escaneo (shops.next_scan_at) ──────────────────────────────
+    @abstractmethod
+    def set_next_scan(self, shop_id, next_at, interval_h=None) -> int:
+        ...
+    @abstractmethod
+    def claim_due_rescans(self, limit, intervals, default_h=48, jitter=0.0) -> list[dict]:
+        ...
+    @abstractmethod
+    def rescan_queue(self, limit=50) -> list[dict]:  ...
+    @abstractmethod
+    def rescan_queue_counts(self) -> dict:           ...
+    @abstractmethod
+    def rescan_load(self) -> list[dict]:             ...
+    @abstractmethod
+    def get_change_history(self, shop_id, limit=10) -> list[dict]:
+        ...
+
+    # ── grafo de links (collector.linkgraph) ─────────────────────────────────
+    @abstractmethod
+    def iter_link_edges(self, after_id=0):           ...
+    @abstractmethod
+    def max_link_id(self) -> int:                    ...
+    @abstractmethod
+    def get_host_ranks(self) -> dict:                ...
+    @abstractmethod
+    def set_host_ranks(self, ranks, min_delta=0.01) -> int:
+        ...
+
+    # ── cola de trabajo con leases (collector.workqueue) ─────────────────────
+    @abstractmethod
+    def enqueue_work(self, items) -> int:            ...
+    @abstractmethod
+    def claim_work(self, worker, limit, lease_s) -> list[dict]:
+        ...
+    @abstractmethod
+    def heartbeat_work(self, worker, ids, lease_s) -> list[int]:
+        ...
+    @abstractmethod
+    def complete_work(self, worker, job_id, result=None) -> bool:
+        ...
+    @abstractmethod
+    def fail_work(self, worker, job_id, error, retry_s) -> str | None:
+        ...
+    @abstractmethod
+    def work_queue_counts(self) -> dict:             ...
+    @abstractmethod
+    def work_queue_workers(self) -> list[dict]:      ...
+    @abstractmethod
+    def list_work(self, status="", limit=50) -> list[dict]:
+        ...
+
+    # ── lectura ──────────────────────────────────────────────────────────────
+    @abstractmethod
+    def get_stats(self) -> dict:                     ...
+    @abstractmethod
+    def list_shops(self, limit=50, q="", risk_level="") -> list[dict]:
+        ...
+    @abstractmethod
+    def search_shops(self, q, limit=50, risk_level="") -> list[dict]:
+        ...
+    @abstractmethod
+    def list_dashboard_shops(self, q="", tech="", risk="", ext_risk="", limit=500) -> list[dict]:
+        ...
+    @abstractmethod
+    def list_manage_shops(self, q="", risk="", limit=200) -> list[dict]:
+        ...
+    @abstractmethod
+    def tech_counts(self, limit=60) -> list[dict]:   ...
+    @abstractmethod
+    def get_shop_detail(self, shop_id) -> dict | None:
+        ...
+    @abstractmethod
+    def get_scan_history(self, shop_id, limit=50) -> list[dict]:
+        ...
+    @abstractmethod
+    def get_state_at_scan(self, shop_id, scan_id) -> dict | None:
+        ...
+    @abstractmethod
+    def list_wallets(self, coin="", q="", limit=500) -> list[dict]:
+        ...
+    @abstractmethod
+    def wallet_coins(self) -> list[dict]:            ...
+    @abstractmethod
+    def list_wallet_rows(self, coin="") -> list[dict]:
+        ...
+    @abstractmethod
+    def get_wallet_shops(self, address) -> list[dict]:
+        ...
+    @abstractmethod
+    def get_related_shops(self, shop_id) -> list[dict]:
+        ...
+    @abstractmethod
+    def list_wallet_clusters(self, limit=100, min_shared=1) -> list[dict]:
+        ...
+    @abstractmethod
+    def list_discovered(self, scanned="", limit=500) -> list[dict]:
+        ...
+    @abstractmethod
+    def get_pending_discovered(self, limit=50) -> list[dict]:
+        ...
+    @abstractmethod
+    def top_threats(self, limit=50) -> list[dict]:   ...
+    @abstractmethod
+    def iter_export_shops(self):                     ...
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  SQLITE — delega en collector.db; las escrituras de escaneo van al writer
+# ─────────────────────────────────────────────────────────────────────────────
+
+class SQLiteStorage(Storage):
+
+    name = "sqlite"
+
+    def __init__(self):
+        from collector import db
+        self._db = db
+
+    def init(self):
+        self._db.init_db()
+
+    def close(self):
+        from collector.writer import stop_writer
+        stop_writer()
+        self._db.close_all_connections()
+
+    def status(self) -> dict:
+        from collector.writer import writer_status
+        return {"backend": self.name, "path": str(self._db.DB_PATH),
+                "schema_version": self._db.schema_version(), "writer": writer_status(),
+                "split": {a: str(self._db.hot_path(a)) for a in self._db.split_aliases()}}
+
+    def persist_scan_result(self, data, threat_intel=True):
+        from collector.writer import persist_scan_result
+        return persist_scan_result(data, threat_intel)
+
+    def _hot_write(self, table, direct, fn, *args):
+        """Tablas en fichero propio (SQLITE_SPLIT_HOT) van por su writer; si no, directo."""
+        if self._db.table_schema(table) == "main":
+            return direct(*args)
+        from collector.writer import get_writer
+        return get_writer(self._db.table_schema(table)).submit(fn, *args).result()
+
+    def upsert_shop(self, *args, **kwargs):          return self._db.upsert_shop(*args, **kwargs)
+    def log_alert(self, shop_id, channel, risk_level, sent, reason=None):
+        return self._hot_write("alert_log", self._db.log_alert, self._db._write_alert,
+                               shop_id, channel, risk_level, sent, reason)
+    def log_rescan(self, shop_id, url, status, detail):
+        return self._hot_write("rescan_log", self._db.log_rescan, self._db._write_rescan,
+                               shop_id, url, status, detail)
+    def add_screenshot(self, shop_id, path, width, height, ocr_text=None,
+                       sha256=None, phash=None, content_hash=None):
+        return self._db.add_screenshot(shop_id, path, width, height, ocr_text, sha256, phash,
+                                       content_hash)
+    def delete_shop(self, shop_id):                  return self._db.delete_shop_by_id(shop_id)
+    def delete_error_shops(self):                    return self._db.delete_error_shops()
+    def mark_discovered_scanned(self, link_id):
+        return self._hot_write("discovered_links", self._db.mark_discovered_scanned,
+                               self._db._mark_scanned, link_id)
+    def mark_discovered_failed(self, link_id):
+        return self._hot_write("discovered_links", self._db.mark_discovered_failed,
+                               self._db._mark_failed, link_id)
+    def rebuild_stats(self):                         return self._db.rebuild_stats()
+
+    def last_screenshot(self, url):                  return self._db.last_screenshot(url)
+    def referenced_screenshots(self, paths):         return self._db.referenced_screenshots(paths)
+
+    def set_next_scan(self, shop_id, next_at, interval_h=None):
+        return self._db.set_next_scan(shop_id, next_at, interval_h)
+    def claim_due_rescans(self, limit, intervals, default_h=48, jitter=0.0):
+        return self._db.claim_due_rescans(limit, intervals, default_h, jitter)
+    def rescan_queue(self, limit=50):                return self._db.rescan_queue(limit)
+    def rescan_queue_counts(self):                   return self._db.rescan_queue_counts()
+    def rescan_load(self):                           return self._db.rescan_load()
+    def get_change_history(self, shop_id, limit=10): return self._db.get_change_history(shop_id, limit)
+
+    def iter_link_edges(self, after_id=0):           return self._db.iter_link_edges(after_id)
+    def max_link_id(self):                           return self._db.max_link_id()
+    def get_host_ranks(self):                        return self._db.get_host_ranks()
+    def set_host_ranks(self, ranks, min_delta=0.01):
+        return self._hot_write("discovered_hosts", self._db.set_host_ranks,
+                               self._db._write_host_ranks, ranks, min_delta)
+
+    def enqueue_work(self, items):                   return self._db.enqueue_work(items)
+    def claim_work(self, worker, limit, lease_s):    return self._db.claim_work(worker, limit, lease_s)
+    def heartbeat_work(self, worker, ids, lease_s):  return self._db.heartbeat_work(worker, ids, lease_s)
+    def complete_work(self, worker, job_id, result=None):
+        return self._db.complete_work(worker, job_id, result)
+    def fail_work(self, worker, job_id, error, retry_s):
+        return self._db.fail_work(worker, job_id, error, retry_s)
+    def work_queue_counts(self):                     return self._db.work_queue_counts()
+    def work_queue_workers(self):                    return self._db.work_queue_workers()
+    def list_work(self, status="", limit=50):        return self._db.list_work(status, limit)
+
+    def get_stats(self):                             return self._db.get_stats()
+    def list_shops(self, limit=50, q="", risk_level=""):
+        return [dict(r) for r in self._db.list_shops(limit, q=q, risk_level=risk_level)]
+    def search_shops(self, q, limit=50, risk_level=""):
+        return self._db.search_shops(q, limit=limit, risk_level=risk_level)
+    def list_dashboard_shops(self, *args, **kwargs): return self._db.list_dashboard_shops(*args, **kwargs)
+    def list_manage_shops(self, *args, **kwargs):    return self._db.list_manage_shops(*args, **kwargs)
+    def tech_counts(self, limit=60):                 return self._db.tech_counts(limit)
+    def get_shop_detail(self, shop_id):              return self._db.get_shop_detail(shop_id)
+    def get_scan_history(self, shop_id, limit=50):   return self._db.get_scan_history(shop_id, limit)
+    def get_state_at_scan(self, shop_id, scan_id):   return self._db.get_state_at_scan(shop_id, scan_id)
+    def list_wallets(self, coin="", q="", limit=500):
+        return self._db.list_wallets(coin, q, limit)
+    def wallet_coins(self):                          return self._db.wallet_coins()
+    def list_wallet_rows(self, coin=""):             return self._db.list_wallet_rows(coin)
+    def get_wallet_shops(self, address):             return self._db.get_wallet_shops(address)
+    def get_related_shops(self, shop_id):            return self._db.get_related_shops(shop_id)
+    def list_wallet_clusters(self, limit=100, min_shared=1):
+        return self._db.list_wallet_clusters(limit, min_shared)
+    def list_discovered(self, scanned="", limit=500):
+        return self._db.list_discovered(scanned, limit)
+    def get_pending_discovered(self, limit=50):
+        return [dict(r) for r in self._db.get_pending_discovered(limit)]
+    def top_threats(self, limit=50):                 return self._db.top_threats(limit)
+    def iter_export_shops(self):                     return self._db.iter_export_shops()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_storage() -> Storage:
+    """Backend configurado en DB_BACKEND (instancia única por proceso)."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if DB_BACKEND in ("postgres", "postgresql", "pg"):
+                from collector.pg_backend import PostgresStorage
+                _storage = PostgresStorage()
+            elif DB_BACKEND == "sqlite":
+                _storage = SQLiteStorage()
+            else:
+                raise ValueError(f"DB_BACKEND desconocido: {DB_BACKEND!r} (sqlite / postgres)")
+        return _storage
+
+
+def close_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+            _storage = None
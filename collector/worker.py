@@ -0,0 +1,283 @@
+"""
+SCRACHER v3 — Worker
+Proceso que consume la cola de collector.workqueue: reclama trabajos con
+lease, los ejecuta en el pool de escaneo (collector.engine, con sus límites
+por etapa) y renueva los leases con heartbeats mientras duran.
+Se pueden lanzar tantos como se quiera, en este host o en otros que vean la
+misma DB (DB_BACKEND=postgres para varios hosts):
+
+  python -m collector.worker                       # worker con WORKER_CONCURRENCY huecos
+  python -m collector.worker --id nodo-b -c 8
+  python -m collector.worker --enqueue targets.txt # solo encolar y salir
+"""
+
+import os
+import signal
+import argparse
+import threading
+from time import monotonic
+from datetime import datetime, timezone
+
+from collector.workqueue import (get_broker, default_worker_id, enqueue_scans,
+                                 WQ_LEASE_S, WQ_HEARTBEAT_S, WQ_RETRY_S)
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_S      = float(os.getenv("WORKER_POLL_S", "5"))   # espera cuando la cola está vacía
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  HANDLERS — uno por kind; devuelven un dict (resultado) o lanzan excepción
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _scan(job: dict) -> dict:
+    from collector.scrape import scrape_one, attach_capture
+    from collector.storage import get_storage
+    from collector.alerts import dispatch_alerts
+    from collector.scheduler import schedule_rescan
+
+    payload = job["payload"]
+    use_ti  = bool(payload.get("threat_intel", False))
+    store   = get_storage()
+    try:
+        data = scrape_one(job["target"], run_threat_intel=use_ti)
+    except Exception as e:
+        if job["attempts"] >= job["max_attempts"]:
+            store.upsert_shop(url=job["target"], domain=None, title=None,
+                              status="error", notes=str(e))
+            if payload.get("link_id"):
+                store.mark_discovered_failed(payload["link_id"])
+        raise
+    threat = data.get("threat", {})
+    rl     = threat.get("risk_level", "unknown")
+
+    sid, _ = store.persist_scan_result(data, threat_intel=use_ti)
+    attach_capture(data, sid)
+    for ar in dispatch_alerts({
+        "shop_id": sid, "url": data["url"],
+        "domain": data.get("domain"), "title": data.get("title"),
+        "risk_level": rl, "risk_score": threat.get("risk_score", 0),
+        "tags": threat.get("tags", []),
+        "keywords": threat.get("keywords", []),
+        "external_risk": data.get("threat_intel", {}).get("external_risk", "unknown"),
+    }):
+        store.log_alert(sid, ar.get("channel", "?"), rl, ar.get("sent", False), ar.get("reason"))
+    schedule_rescan(sid, data["url"], rl)
+    if payload.get("link_id"):
+        store.mark_discovered_scanned(payload["link_id"])
+    return {"shop_id": sid, "risk_level": rl}
+
+def _rescan(job: dict) -> dict:
+    from collector.scheduler import rescan_shop, _log_rescan
+    shop_id = int(job["target"])
+    url     = job["payload"].get("url", "")
+    try:
+        rl = rescan_shop(shop_id, url)
+    except Exception as e:
+        _log_rescan(shop_id, url, "error", str(e))
+        raise
+    _log_rescan(shop_id, url, "ok", rl)
+    return {"shop_id": shop_id, "risk_level": rl}
+
+HANDLERS = {"scan": _scan, "rescan": _rescan}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  WORKER
+# ─────────────────────────────────────────────────────────────────────────────
+
+class Worker:
+    """
+    Bucle reclamar → ejecutar → cerrar. Un hilo aparte renueva cada
+    WQ_HEARTBEAT_S los leases de los trabajos en curso; si uno se pierde (el
+    worker estuvo parado más que el lease) el trabajo sigue, pero su cierre
+    se ignora ("rejected") porque ya lo tiene otro worker.
+    """
+
+    def __init__(self, broker=None, worker_id: str | None = None,
+                 concurrency: int = WORKER_CONCURRENCY, lease_s: float = WQ_LEASE_S,
+                 heartbeat_s: float = WQ_HEARTBEAT_S, retry_s: float = WQ_RETRY_S,
+                 handlers: dict | None = None, executor=None):
+        self.broker      = broker or get_broker()
+        self.id          = worker_id or default_worker_id()
+        self.concurrency = max(1, concurrency)
+        self.lease_s     = lease_s
+        self.heartbeat_s = heartbeat_s
+        self.retry_s     = retry_s
+        self.handlers    = handlers or HANDLERS
+        self._executor   = executor
+        self._stop       = threading.Event()
+        self._wake       = threading.Event()
+        self._hb_stop    = threading.Event()
+        self._lock       = threading.Lock()
+        self._inflight   = {}
+        self._m = {"claimed": 0, "done": 0, "failed": 0, "retried": 0, "rejected": 0,
+                   "lost_leases": 0, "started_at": None, "last_error": None}
+
+    def _submit(self, fn, *args):
+        if self._executor is None:
+            from collector.engine import get_engine
+            self._executor = get_engine()
+        return self._executor.submit(fn, *args)
+
+    def _run(self, job: dict):
+        try:
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"kind desconocido: {job['kind']!r}")
+            result = handler(job)
+            ok = self.broker.complete(self.id, job["id"], result)
+            with self._lock:
+                self._m["done" if ok else "rejected"] += 1
+        except Exception as e:
+            status = self.broker.fail(self.id, job["id"], str(e), self.retry_s)
+            with self._lock:
+                self._m["retried" if status == "queued" else "failed"] += 1
+                self._m["last_error"] = f"{job['kind']} {job['target']}: {e}"
+        finally:
+            with self._lock:
+                self._inflight.pop(job["id"], None)
+            self._wake.set()
+
+    def poll(self) -> int:
+        """Reclama y lanza tantos trabajos como huecos libres. Devuelve cuántos."""
+        with self._lock:
+            free = self.concurrency - len(self._inflight)
+        if free <= 0:
+            return 0
+        jobs = self.broker.claim(self.id, free, self.lease_s)
+        for j in jobs:
+            with self._lock:
+                self._inflight[j["id"]] = j
+                self._m["claimed"] += 1
+            self._submit(self._run, j)
+        return len(jobs)
+
+    def _heartbeat_loop(self):
+        while not self._hb_stop.wait(timeout=self.heartbeat_s):
+            with self._lock:
+                ids = list(self._inflight)
+            if not ids:
+                continue
+            try:
+                held = set(self.broker.heartbeat(self.id, ids, self.lease_s))
+            except Exception as e:
+                with self._lock:
+                    self._m["last_error"] = f"heartbeat: {e}"
+                continue
+            with self._lock:
+                # los que terminaron entre la lectura y el UPDATE no cuentan
+                self._m["lost_leases"] += sum(1 for i in ids
+                                              if i not in held and i in self._inflight)
+
+    def run(self, once: bool = False):
+        """Bucle principal hasta stop(); once=True sale cuando la cola se vacía."""
+        self._m["started_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self._hb_stop.clear()
+        hb = threading.Thread(target=self._heartbeat_loop, name="scracher-heartbeat", daemon=True)
+        hb.start()
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    n = self.poll()
+                except Exception as e:
+                    n = 0
+                    with self._lock:
+                        self._m["last_error"] = str(e)
+                with self._lock:
+                    idle = not self._inflight
+                if once and n == 0 and idle:
+                    break
+                if n == 0:
+                    self._wake.wait(timeout=WORKER_POLL_S if idle else self.heartbeat_s)
+        finally:
+            self.drain()
+            self._hb_stop.set()
+
+    def drain(self, timeout: float | None = None):
+        """Espera a que terminen los trabajos en curso (el heartbeat sigue renovándolos)."""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._inflight:
+                    return
+            if deadline is not None and monotonic() > deadline:
+                return
+            self._wake.wait(timeout=1)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def status(self) -> dict:
+        with self._lock:
+            st = dict(self._m)
+            st["inflight"] = len(self._inflight)
+        st.update(id=self.id, concurrency=self.concurrency, broker=self.broker.name,
+                  lease_s=self.lease_s, heartbeat_s=self.heartbeat_s)
+        return st
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _read_targets(path: str) -> list[str]:
+    urls, seen = [], set()
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            u = line.strip()
+            if not u or u.startswith("#"):
+                continue
+            if not u.startswith("http"):
+                u = "http://" + u
+            if u not in seen:
+                urls.append(u); seen.add(u)
+    return urls
+
+def main(argv=None):
+    env = os.path.join(os.path.dirname(__file__), "..", ".env")
+    if os.path.isfile(env):
+        try:
+            from dotenv import load_dotenv
+            load_dotenv(env)
+        except ImportError:
+            pass
+
+    ap = argparse.ArgumentParser(prog="python -m collector.worker",
+                                 description="Worker de la cola de escaneo de SCRACHER")
+    ap.add_argument("--id", default=None, help="identificador del worker (host:pid por defecto)")
+    ap.add_argument("-c", "--concurrency", type=int, default=WORKER_CONCURRENCY)
+    ap.add_argument("--once", action="store_true", help="salir cuando la cola quede vacía")
+    ap.add_argument("--enqueue", metavar="FILE", help="encolar las URLs del fichero y salir")
+    ap.add_argument("--threat-intel", action="store_true", help="con --enqueue: VirusTotal/URLhaus")
+    args = ap.parse_args(argv)
+
+    from collector.storage import get_storage, close_storage
+    get_storage().init()
+
+    if args.enqueue:
+        urls = _read_targets(args.enqueue)
+        n = enqueue_scans(urls, threat_intel=args.threat_intel)
+        print(f"{n} encolados ({len(urls) - n} ya en cola)")
+        close_storage()
+        return
+
+    w = Worker(worker_id=args.id, concurrency=args.concurrency)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: w.stop())
+    print(f"worker {w.id}  broker={w.broker.name}  concurrency={w.concurrency}")
+    try:
+        w.run(once=args.once)
+    finally:
+        from collector.engine import stop_engine
+        from collector.capture import stop_capture_service
+        stop_capture_service(drain_s=60)    # capturas pendientes → OCR/fila en el pool
+        stop_engine(wait=True)
+        close_storage()
+        st = w.status()
+        print(f"done={st['done']} retried={st['retried']} failed={st['failed']}"
+              f" lost_leases={st['lost_leases']}")
+
+
+if __name__ == "__main__":
+    main()
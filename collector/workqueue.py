@@ -0,0 +1,271 @@
+"""
+SCRACHER v3 — Work queue
+Cola de trabajo con leases para repartir escaneos entre varios procesos
+`python -m collector.worker`, en el mismo host o en otros.
+Un trabajo reclamado queda 'leased' durante WQ_LEASE_S; el worker lo renueva
+con heartbeats mientras escanea. Si el worker cae, el lease vence y otro lo
+vuelve a reclamar (visibility timeout); tras max_attempts queda 'failed'.
+  WORK_BROKER=db    → tabla work_queue del backend de collector.storage
+                      (SQLite para procesos en un host; Postgres para varios hosts)
+  WORK_BROKER=local → cola en memoria del propio proceso (pruebas, un solo nodo)
+Los resultados no pasan por la cola: cada worker los escribe en el storage
+configurado, así que todos acaban en la misma DB.
+"""
+
+import os
+import json
+import socket
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+
+WORK_BROKER      = os.getenv("WORK_BROKER", "db").strip().lower()
+WQ_LEASE_S       = float(os.getenv("WQ_LEASE_S", "300"))      # visibility timeout
+WQ_HEARTBEAT_S   = float(os.getenv("WQ_HEARTBEAT_S", "60"))   # renovación de leases
+WQ_MAX_ATTEMPTS  = int(os.getenv("WQ_MAX_ATTEMPTS", "3"))
+WQ_RETRY_S       = float(os.getenv("WQ_RETRY_S", "60"))       # espera tras el 1er fallo (se dobla)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def default_worker_id() -> str:
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+def job(kind: str, target: str, payload: dict | None = None, priority: int = 0,
+        max_attempts: int = WQ_MAX_ATTEMPTS, delay_s: float = 0) -> dict:
+    """Trabajo listo para Broker.enqueue(). kind: 'scan' (target=url) o 'rescan' (target=shop_id)."""
+    return {"kind": kind, "target": str(target), "payload": payload, "priority": priority,
+            "max_attempts": max_attempts, "delay_s": delay_s}
+
+
+class Broker(ABC):
+    """
+    Operaciones de la cola. claim() devuelve dicts con id, kind, target,
+    payload (dict), priority, attempts (incluido el actual), max_attempts.
+    complete()/fail() solo tienen efecto si el lease sigue siendo de `worker`.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def enqueue(self, items: list[dict]) -> int:                        ...
+    @abstractmethod
+    def claim(self, worker: str, limit: int, lease_s: float = WQ_LEASE_S) -> list[dict]:
+        ...
+    @abstractmethod
+    def heartbeat(self, worker: str, ids: list[int], lease_s: float = WQ_LEASE_S) -> list[int]:
+        ...
+    @abstractmethod
+    def complete(self, worker: str, job_id: int, result=None) -> bool:  ...
+    @abstractmethod
+    def fail(self, worker: str, job_id: int, error: str, retry_s: float = WQ_RETRY_S) -> str | None:
+        ...
+    @abstractmethod
+    def counts(self) -> dict:                                           ...
+    @abstractmethod
+    def workers(self) -> list[dict]:                                    ...
+    @abstractmethod
+    def list_jobs(self, status: str = "", limit: int = 50) -> list[dict]:
+        ...
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  DB — tabla work_queue del storage (SQLite: BEGIN IMMEDIATE; PG: SKIP LOCKED)
+# ─────────────────────────────────────────────────────────────────────────────
+
+class DBBroker(Broker):
+
+    name = "db"
+
+    def __init__(self, storage=None):
+        if storage is None:
+            from collector.storage import get_storage
+            storage = get_storage()
+        self._s = storage
+
+    def enqueue(self, items):                          return self._s.enqueue_work(items)
+    def claim(self, worker, limit, lease_s=WQ_LEASE_S):
+        return self._s.claim_work(worker, limit, lease_s)
+    def heartbeat(self, worker, ids, lease_s=WQ_LEASE_S):
+        return self._s.heartbeat_work(worker, ids, lease_s)
+    def complete(self, worker, job_id, result=None):   return self._s.complete_work(worker, job_id, result)
+    def fail(self, worker, job_id, error, retry_s=WQ_RETRY_S):
+        return self._s.fail_work(worker, job_id, error, retry_s)
+    def counts(self):                                  return self._s.work_queue_counts()
+    def workers(self):                                 return self._s.work_queue_workers()
+    def list_jobs(self, status="", limit=50):          return self._s.list_work(status, limit)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  LOCAL — misma semántica en memoria; `clock` permite simular el paso del tiempo
+# ─────────────────────────────────────────────────────────────────────────────
+
+class LocalBroker(Broker):
+
+    name = "local"
+
+    def __init__(self, clock=None):
+        self._clock = clock or (lambda: datetime.now(timezone.utc))
+        self._lock  = threading.Lock()
+        self._jobs  = {}
+        self._next  = 1
+
+    def _iso(self, dt: datetime) -> str:
+        return dt.isoformat(timespec="seconds")
+
+    def _expire(self, now_iso: str):
+        for j in self._jobs.values():
+            if j["status"] == "leased" and j["lease_until"] < now_iso:
+                if j["attempts"] >= j["max_attempts"]:
+                    j.update(status="failed", finished_at=now_iso, lease_owner=None,
+                             last_error=j["last_error"] or "lease expired")
+                else:
+                    j.update(status="queued", lease_owner=None, lease_until=None)
+
+    def enqueue(self, items):
+        now = self._clock()
+        n = 0
+        with self._lock:
+            active = {(j["kind"], j["target"]) for j in self._jobs.values()
+                      if j["status"] in ("queued", "leased")}
+            for it in items:
+                key = (it["kind"], str(it["target"]))
+                if key in active:
+                    continue
+                active.add(key)
+                self._jobs[self._next] = {
+                    "id": self._next, "kind": it["kind"], "target": str(it["target"]),
+                    "payload": json.loads(json.dumps(it.get("payload") or {})),
+                    "priority": it.get("priority", 0), "status": "queued", "attempts": 0,
+                    "max_attempts": it.get("max_attempts", WQ_MAX_ATTEMPTS),
+                    "available_at": self._iso(now + timedelta(seconds=it.get("delay_s", 0))),
+                    "lease_owner": None, "lease_until": None, "heartbeat_at": None,
+                    "enqueued_at": self._iso(now), "finished_at": None,
+                    "last_error": None, "result": None,
+                }
+                self._next += 1
+                n += 1
+        return n
+
+    def claim(self, worker, limit, lease_s=WQ_LEASE_S):
+        now = self._clock()
+        iso = self._iso(now)
+        with self._lock:
+            self._expire(iso)
+            ready = sorted((j for j in self._jobs.values()
+                            if j["status"] == "queued" and j["available_at"] <= iso),
+                           key=lambda j: (-j["priority"], j["available_at"], j["id"]))[:limit]
+            for j in ready:
+                j.update(status="leased", lease_owner=worker, heartbeat_at=iso,
+                         lease_until=self._iso(now + timedelta(seconds=lease_s)),
+                         attempts=j["attempts"] + 1)
+            return [{k: j[k] for k in ("id", "kind", "target", "payload", "priority",
+                                       "attempts", "max_attempts", "enqueued_at")}
+                    for j in ready]
+
+    def heartbeat(self, worker, ids, lease_s=WQ_LEASE_S):
+        now = self._clock()
+        held = []
+        with self._lock:
+            for i in ids:
+                j = self._jobs.get(i)
+                if j and j["status"] == "leased" and j["lease_owner"] == worker:
+                    j.update(lease_until=self._iso(now + timedelta(seconds=lease_s)),
+                             heartbeat_at=self._iso(now))
+                    held.append(i)
+        return held
+
+    def complete(self, worker, job_id, result=None):
+        with self._lock:
+            j = self._jobs.get(job_id)
+            if not j or j["status"] != "leased" or j["lease_owner"] != worker:
+                return False
+            j.update(status="done", finished_at=self._iso(self._clock()), lease_owner=None,
+                     lease_until=None, result=result)
+            return True
+
+    def fail(self, worker, job_id, error, retry_s=WQ_RETRY_S):
+        now = self._clock()
+        with self._lock:
+            j = self._jobs.get(job_id)
+            if not j or j["status"] != "leased" or j["lease_owner"] != worker:
+                return None
+            j.update(lease_owner=None, lease_until=None, last_error=(error or "")[:500])
+            if j["attempts"] >= j["max_attempts"]:
+                j.update(status="failed", finished_at=self._iso(now))
+            else:
+                j.update(status="queued", available_at=self._iso(
+                    now + timedelta(seconds=retry_s * 2 ** (j["attempts"] - 1))))
+            return j["status"]
+
+    def counts(self):
+        iso = self._iso(self._clock())
+        with self._lock:
+            c = {"queued": 0, "ready": 0, "leased": 0, "done": 0, "failed": 0}
+            for j in self._jobs.values():
+                c[j["status"]] += 1
+                if j["status"] == "queued" and j["available_at"] <= iso:
+                    c["ready"] += 1
+            return c
+
+    def workers(self):
+        with self._lock:
+            by = {}
+            for j in self._jobs.values():
+                if j["status"] != "leased":
+                    continue
+                w = by.setdefault(j["lease_owner"], {"worker": j["lease_owner"], "leased": 0,
+                                                     "last_heartbeat": None, "next_expiry": None})
+                w["leased"] += 1
+                w["last_heartbeat"] = max(filter(None, [w["last_heartbeat"], j["heartbeat_at"]]))
+                w["next_expiry"]    = min(filter(None, [w["next_expiry"], j["lease_until"]]))
+            return [by[k] for k in sorted(by)]
+
+    def list_jobs(self, status="", limit=50):
+        with self._lock:
+            rows = [dict(j) for j in self._jobs.values() if not status or j["status"] == status]
+        return sorted(rows, key=lambda j: -j["id"])[:limit]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_broker() -> Broker:
+    """Broker configurado en WORK_BROKER (instancia única por proceso)."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            if WORK_BROKER == "db":
+                _broker = DBBroker()
+            elif WORK_BROKER == "local":
+                _broker = LocalBroker()
+            else:
+                raise ValueError(f"WORK_BROKER desconocido: {WORK_BROKER!r} (db / local)")
+        return _broker
+
+
+def set_broker(broker: Broker | None):
+    """Sustituye el broker del proceso (p.ej. un LocalBroker en pruebas)."""
+    global _broker
+    with _broker_lock:
+        _broker = broker
+
+
+def enqueue_scans(urls: list[str], threat_intel: bool = False, priority: int = 0,
+                  link_ids: dict | None = None) -> int:
+    """Encola escaneos de URLs; link_ids {url: id} marca el link descubierto al terminar."""
+    link_ids = link_ids or {}
+    return get_broker().enqueue([
+        job("scan", u, {"threat_intel": threat_intel,
+                        **({"link_id": link_ids[u]} if u in link_ids else {})}, priority)
+        for u in urls])
+
+
+def queue_status(limit: int = 20) -> dict:
+    b = get_broker()
+    try:
+        return {"broker": b.name, "counts": b.counts(), "workers": b.workers(),
+                "recent": b.list_jobs(limit=limit), "lease_s": WQ_LEASE_S,
+                "heartbeat_s": WQ_HEARTBEAT_S, "max_attempts": WQ_MAX_ATTEMPTS}
+    except Exception as e:
+        return {"broker": b.name, "error": str(e)}
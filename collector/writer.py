@@ -0,0 +1,272 @@
+"""
+SCRACHER v3 — DB Writer
+Hilo escritor único para scrs.db: consume resultados de escaneo de una cola
+acotada y los confirma en grupo (group commit) por número o por tiempo.
+CLI, dashboard y scheduler envían aquí en vez de competir por el lock de SQLite.
+Con SQLITE_SPLIT_HOT cada fichero separado (logs, frontier) tiene su propio writer.
+"""
+
+import os
+import queue
+import threading
+from time import perf_counter, monotonic
+from concurrent.futures import Future
+
+from collector.db import (connect_file, table_schema, write_scan_result,
+                          _write_discovered_links)
+
+WRITER_QUEUE_SIZE  = int(os.getenv("WRITER_QUEUE_SIZE", "256"))
+WRITER_BATCH_SIZE  = int(os.getenv("WRITER_BATCH_SIZE", "32"))
+WRITER_FLUSH_MS    = int(os.getenv("WRITER_FLUSH_MS", "100"))
+WRITER_PUT_TIMEOUT = float(os.getenv("WRITER_PUT_TIMEOUT_S", "60"))
+WRITER_LINK_RETRIES = int(os.getenv("WRITER_LINK_RETRIES", "3"))  # reintentos si el writer de frontier va lleno
+
+_STOP = object()
+
+_writers = {}
+_writer_lock = threading.Lock()
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "future")
+
+    def __init__(self, fn, args, kwargs):
+        self.fn     = fn
+        self.args   = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class DBWriter:
+    """
+    Escritor por lotes. Cada trabajo es fn(conn, *args, **kwargs) y se ejecuta
+    dentro de un SAVEPOINT: un trabajo que falla no tumba al resto del lote.
+    """
+
+    def __init__(self, alias="main", queue_size=WRITER_QUEUE_SIZE,
+                 batch_size=WRITER_BATCH_SIZE, flush_ms=WRITER_FLUSH_MS):
+        self.alias       = alias
+        self._q          = queue.Queue(maxsize=queue_size)
+        self._batch_size = max(1, batch_size)
+        self._flush_s    = max(0, flush_ms) / 1000
+        self._thread     = None
+        self._lock       = threading.Lock()
+        self._handoffs   = set()     # hilos que esperan hueco en el writer de frontier
+        self._m = {
+            "batches": 0, "items": 0, "errors": 0, "blocked_puts": 0,
+            "deferred_links": 0, "dropped_links": 0,
+            "last_batch": 0, "max_batch": 0,
+            "last_commit_ms": 0.0, "max_commit_ms": 0.0, "total_commit_ms": 0.0,
+        }
+
+    # ── ciclo de vida ────────────────────────────────────────────────────────
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        if self.running:
+            return False
+        name = "scracher-db-writer" + ("" if self.alias == "main" else f"-{self.alias}")
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout: float = 30):
+        """Vacía la cola pendiente y para el hilo."""
+        if not self.running:
+            return
+        self._q.put(_STOP)
+        self._thread.join(timeout=timeout)
+        for t in list(self._handoffs):
+            t.join(timeout=timeout)
+
+    # ── productores ──────────────────────────────────────────────────────────
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Encola fn(conn, *args, **kwargs). Bloquea si la cola está llena
+        (backpressure) y lanza queue.Full tras WRITER_PUT_TIMEOUT segundos.
+        """
+        job = _Job(fn, args, kwargs)
+        try:
+            self._put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._m["blocked_puts"] += 1
+            self._q.put(job, timeout=WRITER_PUT_TIMEOUT)
+        return job.future
+
+    def try_submit(self, fn, *args, **kwargs) -> Future:
+        """Como submit() pero sin esperar: lanza queue.Full si la cola está llena."""
+        job = _Job(fn, args, kwargs)
+        self._put_nowait(job)
+        return job.future
+
+    def _put_nowait(self, job):
+        if not self.running:
+            self.start()
+        self._q.put_nowait(job)
+
+    def submit_scan_result(self, data: dict, threat_intel: bool = True) -> Future:
+        """
+        Future con (shop_id, changed), resuelto tras el commit del lote.
+        Si los links viven en scrs_frontier.db se encolan en su writer cuando
+        el sitio ya tiene id, sin alargar la transacción de scrs.db.
+        """
+        links = data.get("onion_links")
+        if not links or table_schema("discovered_links") == "main":
+            return self.submit(write_scan_result, data, threat_intel)
+        fut = self.submit(write_scan_result, data, threat_intel, links=False)
+
+        risk = data.get("threat", {}).get("risk_level")
+
+        def _queue_links(f):
+            # corre en este hilo escritor: nunca bloquear aquí
+            if f.exception() is not None:
+                return
+            args = (_write_discovered_links, f.result()[0], links, risk)
+            try:
+                get_writer("frontier").try_submit(*args)
+            except queue.Full:
+                with self._lock:
+                    self._m["deferred_links"] += 1
+                t = threading.Thread(target=self._handoff_links, args=args,
+                                     name="scracher-db-links", daemon=True)
+                self._handoffs.add(t)
+                t.start()
+        fut.add_done_callback(_queue_links)
+        return fut
+
+    def _handoff_links(self, *args):
+        """Encola los links en el writer de frontier esperando hueco, fuera del hilo escritor."""
+        try:
+            for _ in range(max(1, WRITER_LINK_RETRIES)):
+                try:
+                    get_writer("frontier").submit(*args)
+                    return
+                except queue.Full:
+                    continue
+            with self._lock:
+                self._m["dropped_links"] += len(args[2])
+        finally:
+            self._handoffs.discard(threading.current_thread())
+
+    # ── consumidor ───────────────────────────────────────────────────────────
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._q.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = monotonic() + self._flush_s
+            # Se confirma en cuanto la cola queda vacía; solo se espera (hasta
+            # flush_ms) mientras siguen llegando trabajos de varios productores.
+            while len(batch) < self._batch_size:
+                try:
+                    job = self._q.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - monotonic()
+                    if len(batch) < 2 or remaining <= 0:
+                        break
+                    try:
+                        job = self._q.get(timeout=min(remaining, 0.005))
+                    except queue.Empty:
+                        break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        t0   = perf_counter()
+        conn = None
+        done = []
+        try:
+            # dentro del try: si no se puede abrir/adjuntar la DB, cada trabajo
+            # del lote recibe el error y el hilo escritor sigue vivo
+            conn = connect_file(self.alias)
+            conn.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    res = job.fn(conn, *job.args, **job.kwargs)
+                    conn.execute("RELEASE SAVEPOINT job")
+                    done.append((job, res, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO SAVEPOINT job")
+                    conn.execute("RELEASE SAVEPOINT job")
+                    done.append((job, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            done = [(job, None, e) for job in batch]
+
+        ms = (perf_counter() - t0) * 1000
+        errors = sum(1 for _, _, err in done if err is not None)
+        with self._lock:
+            m = self._m
+            m["batches"]         += 1
+            m["items"]           += len(batch)
+            m["errors"]          += errors
+            m["last_batch"]       = len(batch)
+            m["max_batch"]        = max(m["max_batch"], len(batch))
+            m["last_commit_ms"]   = round(ms, 1)
+            m["max_commit_ms"]    = round(max(m["max_commit_ms"], ms), 1)
+            m["total_commit_ms"] += ms
+
+        for job, res, err in done:
+            if err is not None:
+                job.future.set_exception(err)
+            else:
+                job.future.set_result(res)
+
+    # ── métricas ─────────────────────────────────────────────────────────────
+
+    def metrics(self) -> dict:
+        with self._lock:
+            m = dict(self._m)
+        total_ms = m.pop("total_commit_ms")
+        m["avg_commit_ms"] = round(total_ms / m["batches"], 1) if m["batches"] else 0.0
+        m["queue_depth"]   = self._q.qsize()
+        m["queue_size"]    = self._q.maxsize
+        m["running"]       = self.running
+        return m
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+
+def get_writer(alias: str = "main") -> DBWriter:
+    """Writer del fichero `alias` ("main" = scrs.db, "logs", "frontier")."""
+    with _writer_lock:
+        if alias not in _writers:
+            _writers[alias] = DBWriter(alias)
+        return _writers[alias]
+
+
+def stop_writer():
+    # primero main: sus callbacks pueden encolar links en el de frontier
+    for alias in sorted(_writers, key=lambda a: a != "main"):
+        _writers[alias].stop()
+
+
+def persist_scan_result(data: dict, threat_intel: bool = True) -> tuple[int, bool]:
+    """Envía el resultado al writer y espera a su commit. Devuelve (shop_id, changed)."""
+    return get_writer().submit_scan_result(data, threat_intel).result()
+
+
+def writer_status() -> dict:
+    st = get_writer().metrics()
+    with _writer_lock:
+        others = {a: w for a, w in _writers.items() if a != "main"}
+    if others:
+        st["files"] = {a: w.metrics() for a, w in others.items()}
+    return st
@@ -5,7 +5,6 @@ Escaneo en tiempo real via SSE, gestión DB, exportación, estadísticas.
 """
 
 import json
-import sqlite3
 import asyncio
 import threading
 import queue
@@ -23,9 +22,10 @@ from fastapi.templating import Jinja2Templates
 # Añadir raíz del proyecto al path para importar collector.*
 ROOT     = Path(__file__).resolve().parents[1]
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH  = ROOT / "data" / "scrs.db"
 sys.path.insert(0, str(ROOT))
 
+from collector.storage import get_storage
+
 app       = FastAPI(title="SCRACHER v3")
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
@@ -34,6 +34,21 @@ _static.mkdir(parents=True, exist_ok=True)
 (_static / "screenshots").mkdir(exist_ok=True)
 app.mount("/static", StaticFiles(directory=str(_static)), name="static")
 
+@app.on_event("startup")
+def _startup():
+    store = get_storage()
+    store.init()
+    if store.name == "sqlite":
+        from collector.retention import start_retention
+        start_retention()
+    from collector.linkgraph import start_linkgraph
+    start_linkgraph()
+
+@app.on_event("shutdown")
+def _shutdown():
+    from collector.capture import stop_capture_service
+    stop_capture_service(drain_s=10)
+
 # Cola global para SSE del escaneo
 _scan_queue: queue.Queue = queue.Queue()
 _scan_running = False
@@ -42,43 +57,9 @@ _scan_running = False
 #  DB HELPERS
 # ─────────────────────────────────────────────────────────────────────────────
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
-
-def table_exists(conn, name: str) -> bool:
-    return conn.execute(
-        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
-    ).fetchone() is not None
-
 def get_stats():
-    conn = get_db()
-    s = {
-        "total":         conn.execute("SELECT COUNT(*) FROM shops").fetchone()[0],
-        "ok":            conn.execute("SELECT COUNT(*) FROM shops WHERE status='ok'").fetchone()[0],
-        "errors":        conn.execute("SELECT COUNT(*) FROM shops WHERE status='error'").fetchone()[0],
-        "critical":      conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='critical'").fetchone()[0],
-        "high":          conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='high'").fetchone()[0],
-        "medium":        conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='medium'").fetchone()[0],
-        "low":           conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='low'").fetchone()[0],
-        "clean":         conn.execute("SELECT COUNT(*) FROM shops WHERE risk_level='clean'").fetchone()[0],
-        "pending_links": conn.execute("SELECT COUNT(*) FROM discovered_links WHERE scanned=0").fetchone()[0],
-        "total_links":   conn.execute("SELECT COUNT(*) FROM discovered_links").fetchone()[0],
-        "wallets_total": conn.execute("SELECT COUNT(*) FROM wallets").fetchone()[0] if table_exists(conn,"wallets") else 0,
-        "alerts_sent":   conn.execute("SELECT COUNT(*) FROM alert_log WHERE sent=1").fetchone()[0] if table_exists(conn,"alert_log") else 0,
-    }
-    s["top_threats"] = [dict(r) for r in conn.execute("""
-        SELECT category, COUNT(*) AS c FROM threat_keywords
-        GROUP BY category ORDER BY c DESC LIMIT 8
-    """).fetchall()]
-    s["top_coins"] = [dict(r) for r in conn.execute("""
-        SELECT coin, COUNT(DISTINCT address) AS c FROM wallets
-        GROUP BY coin ORDER BY c DESC
-    """).fetchall()] if table_exists(conn,"wallets") else []
-    conn.close()
-    return s
+    # SQLite: contadores materializados por triggers (coste constante)
+    return get_storage().get_stats()
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  INDEX
@@ -86,28 +67,10 @@ def get_stats():
 
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request, q: str="", tech: str="", risk: str="", ext_risk: str=""):
-    conn = get_db()
-    sql = """
-        SELECT s.*,
-               (SELECT path FROM screenshots WHERE shop_id=s.id
-                ORDER BY created_at DESC LIMIT 1) AS screenshot
-        FROM shops s WHERE 1=1
-    """
-    params = []
-    if q:
-        like = f"%{q}%"
-        sql += " AND (s.url LIKE ? OR s.domain LIKE ? OR s.title LIKE ?)"
-        params += [like, like, like]
-    if risk:     sql += " AND s.risk_level=?";   params.append(risk)
-    if ext_risk: sql += " AND s.external_risk=?"; params.append(ext_risk)
-    if tech:
-        sql += " AND EXISTS (SELECT 1 FROM tech t WHERE t.shop_id=s.id AND t.name=?)"
-        params.append(tech)
-    sql += " ORDER BY s.risk_score DESC, s.detected_at DESC LIMIT 500"
-    shops = conn.execute(sql, params).fetchall()
-    techs = conn.execute("SELECT name, COUNT(*) AS c FROM tech GROUP BY name ORDER BY c DESC LIMIT 60").fetchall()
+    store = get_storage()
+    shops = store.list_dashboard_shops(q=q, tech=tech, risk=risk, ext_risk=ext_risk)
+    techs = store.tech_counts(60)
     stats = get_stats()
-    conn.close()
     return templates.TemplateResponse("index.html", {
         "request": request, "shops": shops, "techs": techs,
         "q": q, "tech": tech, "risk": risk, "ext_risk": ext_risk, "stats": stats,
@@ -119,54 +82,31 @@ def index(request: Request, q: str="", tech: str="", risk: str="", ext_risk: str
 
 @app.get("/shop/{shop_id}", response_class=HTMLResponse)
 def shop_detail(request: Request, shop_id: int):
-    conn = get_db()
-    shop = conn.execute("SELECT * FROM shops WHERE id=?", (shop_id,)).fetchone()
-    if not shop:
-        conn.close()
+    store  = get_storage()
+    detail = store.get_shop_detail(shop_id)
+    if not detail:
         return HTMLResponse("Not found", status_code=404)
-    tech        = conn.execute("""
-        SELECT category, name, version, confidence, source FROM tech
-        WHERE shop_id=? ORDER BY confidence DESC, name
-    """, (shop_id,)).fetchall()
-    screenshots = conn.execute("""
-        SELECT path, created_at, ocr_text FROM screenshots
-        WHERE shop_id=? ORDER BY created_at DESC LIMIT 10
-    """, (shop_id,)).fetchall()
-    keywords    = conn.execute("""
-        SELECT keyword, category, severity, count FROM threat_keywords
-        WHERE shop_id=? ORDER BY
-          CASE severity WHEN 'critical' THEN 1 WHEN 'high' THEN 2
-          WHEN 'medium' THEN 3 ELSE 4 END, count DESC
-    """, (shop_id,)).fetchall()
-    tags        = [r["tag"] for r in conn.execute(
-        "SELECT tag FROM tags WHERE shop_id=?", (shop_id,)).fetchall()]
-    links       = conn.execute("""
-        SELECT url, domain, discovered_at, scanned FROM discovered_links
-        WHERE source_id=? ORDER BY discovered_at DESC LIMIT 100
-    """, (shop_id,)).fetchall()
-    wallets     = conn.execute("""
-        SELECT coin, address, addr_type FROM wallets
-        WHERE shop_id=? ORDER BY coin, address
-    """, (shop_id,)).fetchall() if table_exists(conn,"wallets") else []
-    ti          = conn.execute(
-        "SELECT * FROM threat_intel WHERE shop_id=?", (shop_id,)
-    ).fetchone() if table_exists(conn,"threat_intel") else None
-    alerts      = conn.execute("""
-        SELECT channel, risk_level, sent, reason, sent_at FROM alert_log
-        WHERE shop_id=? ORDER BY sent_at DESC LIMIT 10
-    """, (shop_id,)).fetchall() if table_exists(conn,"alert_log") else []
-    conn.close()
     return templates.TemplateResponse("shop.html", {
-        "request": request, "shop": shop, "tech": tech,
-        "screenshots": screenshots, "keywords": keywords, "tags": tags,
-        "links": links, "wallets": wallets,
-        "threat_intel": dict(ti) if ti else {}, "alerts": alerts, "stats": get_stats(),
+        "request": request, **detail,
+        "history": store.get_scan_history(shop_id, limit=30),
+        "related": store.get_related_shops(shop_id),
+        "stats": get_stats(),
     })
 
+@app.get("/api/shop/{shop_id}/history")
+def api_shop_history(shop_id: int, limit: int=50):
+    return JSONResponse(get_storage().get_scan_history(shop_id, limit=min(max(limit, 1), 500)))
+
+@app.get("/api/shop/{shop_id}/history/{scan_id}")
+def api_shop_state(shop_id: int, scan_id: int):
+    state = get_storage().get_state_at_scan(shop_id, scan_id)
+    if state is None:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return JSONResponse(state)
+
 @app.post("/shop/{shop_id}/delete")
 def delete_shop(shop_id: int):
-    from collector.db import delete_shop_by_id
-    delete_shop_by_id(shop_id)
+    get_storage().delete_shop(shop_id)
     return JSONResponse({"ok": True})
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -178,26 +118,22 @@ def scan_page(request: Request):
     stats = get_stats()
     return templates.TemplateResponse("scan.html", {"request": request, "stats": stats})
 
-def _run_scan_thread(urls: list, use_ti: bool):
-    """Escaneo en hilo separado, emite eventos a _scan_queue."""
+def _run_scan_thread(urls: list, use_ti: bool) -> set:
+    """Escaneo en hilo separado, emite eventos a _scan_queue. Devuelve las URLs fallidas."""
     global _scan_running
     _scan_running = True
+    failed = set()
 
     def emit(event: str, data: dict):
         _scan_queue.put({"event": event, "data": data})
 
     try:
-        from collector.db import (
-            init_db, upsert_shop, replace_tech, add_screenshot,
-            replace_keywords, replace_tags, replace_wallets,
-            add_discovered_links, upsert_threat_intel, log_alert,
-        )
-        from collector.scrape import scrape_one
+        from collector.scrape import scrape_one, attach_capture
         from collector.alerts import dispatch_alerts
         from collector.scheduler import schedule_rescan
         import time
 
-        init_db()
+        store = get_storage()
         emit("start", {"total": len(urls), "threat_intel": use_ti})
 
         ok = fail = new_links = new_wallets = 0
@@ -214,28 +150,11 @@ def _run_scan_thread(urls: list, use_ti: bool):
                 rl      = threat.get("risk_level", "unknown")
                 ext     = ti.get("external_risk", "unknown")
 
-                sid = upsert_shop(
-                    url=data["url"], domain=data.get("domain"),
-                    title=data.get("title"), status="ok",
-                    risk_score=threat.get("risk_score", 0), risk_level=rl,
-                    external_risk=ext, content_hash=data.get("content_hash"),
-                    language=data.get("language"),
-                )
-                replace_tech(sid, data.get("tech", []))
-                replace_keywords(sid, threat.get("keywords", []))
-                replace_tags(sid, threat.get("tags", []))
-                wallets = data.get("wallets", {})
-                replace_wallets(sid, wallets)
-                if use_ti and ti:
-                    upsert_threat_intel(sid, ti)
-                sc = data.get("screenshot") or {}
-                if sc.get("path"):
-                    add_screenshot(sid, sc["path"], sc.get("width"), sc.get("height"),
-                                   data.get("ocr", {}).get("text"))
+                sid, _ = store.persist_scan_result(data, threat_intel=use_ti)
+                attach_capture(data, sid)
+                wallets     = data.get("wallets", {})
                 onion_links = data.get("onion_links", [])
-                if onion_links:
-                    add_discovered_links(sid, onion_links)
-                    new_links += len(onion_links)
+                new_links  += len(onion_links)
                 wcount = sum(len(v) for v in wallets.values())
                 new_wallets += wcount
 
@@ -248,8 +167,8 @@ def _run_scan_thread(urls: list, use_ti: bool):
                     "external_risk": ext,
                 })
                 for ar in alert_results:
-                    log_alert(sid, ar.get("channel","?"), rl,
-                              ar.get("sent", False), ar.get("reason"))
+                    store.log_alert(sid, ar.get("channel","?"), rl,
+                                    ar.get("sent", False), ar.get("reason"))
                 schedule_rescan(sid, data["url"], rl)
                 ok += 1
 
@@ -270,9 +189,10 @@ def _run_scan_thread(urls: list, use_ti: bool):
             except Exception as e:
                 elapsed = time.perf_counter() - t0
                 fail += 1
+                failed.add(url)
                 try:
-                    upsert_shop(url=url, domain=None, title=None,
-                                status="error", notes=str(e))
+                    store.upsert_shop(url=url, domain=None, title=None,
+                                      status="error", notes=str(e))
                 except Exception:
                     pass
                 emit("result", {
@@ -290,6 +210,7 @@ def _run_scan_thread(urls: list, use_ti: bool):
         emit("error", {"message": str(e)})
     finally:
         _scan_running = False
+    return failed
 
 @app.post("/scan/start")
 async def scan_start(request: Request):
@@ -345,17 +266,19 @@ async def crawl_discovered(request: Request):
         return JSONResponse({"error": "Scan already running"}, status_code=409)
     body  = await request.json()
     limit = int(body.get("limit", 50))
-    from collector.db import get_pending_discovered, mark_discovered_scanned
-    pending = get_pending_discovered(limit=limit)
+    store   = get_storage()
+    pending = store.get_pending_discovered(limit=limit)
     if not pending:
         return JSONResponse({"error": "No pending links"}, status_code=400)
     urls = [r["url"] for r in pending]
-    ids  = [r["id"]  for r in pending]
 
     def run():
-        _run_scan_thread(urls, False)
-        for lid in ids:
-            mark_discovered_scanned(lid)
+        failed = _run_scan_thread(urls, False)
+        for r in pending:
+            if r["url"] in failed:
+                store.mark_discovered_failed(r["id"])
+            else:
+                store.mark_discovered_scanned(r["id"])
 
     t = threading.Thread(target=run, daemon=True)
     t.start()
@@ -367,28 +290,11 @@ async def crawl_discovered(request: Request):
 
 @app.get("/wallets", response_class=HTMLResponse)
 def wallets_view(request: Request, coin: str="", q: str=""):
-    conn = get_db()
-    sql = """
-        SELECT w.coin, w.address, w.addr_type,
-               s.id AS shop_id, s.domain, s.title, s.risk_level
-        FROM wallets w JOIN shops s ON w.shop_id=s.id WHERE 1=1
-    """
-    params = []
-    if coin: sql += " AND w.coin=?"; params.append(coin.upper())
-    if q:
-        like = f"%{q}%"
-        sql += " AND (w.address LIKE ? OR s.domain LIKE ?)"
-        params += [like, like]
-    sql += " ORDER BY s.risk_score DESC LIMIT 500"
-    rows  = conn.execute(sql, params).fetchall()
-    coins = [dict(r) for r in conn.execute(
-        "SELECT coin, COUNT(*) AS c FROM wallets GROUP BY coin ORDER BY c DESC"
-    ).fetchall()]
-    stats = get_stats()
-    conn.close()
+    store = get_storage()
     return templates.TemplateResponse("wallets.html", {
-        "request": request, "rows": rows, "coins": coins,
-        "selected_coin": coin, "q": q, "stats": stats,
+        "request": request, "rows": store.list_wallets(coin=coin, q=q.strip()),
+        "coins": store.wallet_coins(), "selected_coin": coin, "q": q.strip(),
+        "stats": get_stats(), "clusters": store.list_wallet_clusters(limit=50),
     })
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -397,14 +303,8 @@ def wallets_view(request: Request, coin: str="", q: str=""):
 
 @app.get("/discovered", response_class=HTMLResponse)
 def discovered(request: Request, scanned: str=""):
-    conn = get_db()
-    sql = "SELECT * FROM discovered_links WHERE 1=1"
-    if scanned == "0": sql += " AND scanned=0"
-    elif scanned == "1": sql += " AND scanned=1"
-    sql += " ORDER BY discovered_at DESC LIMIT 500"
-    links = conn.execute(sql).fetchall()
+    links = get_storage().list_discovered(scanned=scanned, limit=500)
     stats = get_stats()
-    conn.close()
     return templates.TemplateResponse("discovered.html", {
         "request": request, "links": links, "scanned": scanned, "stats": stats,
     })
@@ -415,18 +315,8 @@ def discovered(request: Request, scanned: str=""):
 
 @app.get("/manage", response_class=HTMLResponse)
 def manage_page(request: Request, q: str="", risk: str=""):
-    conn = get_db()
-    sql = "SELECT id,url,domain,title,risk_level,risk_score,status,detected_at,scan_count FROM shops WHERE 1=1"
-    params = []
-    if q:
-        like = f"%{q}%"
-        sql += " AND (url LIKE ? OR domain LIKE ? OR title LIKE ?)"
-        params += [like, like, like]
-    if risk: sql += " AND risk_level=?"; params.append(risk)
-    sql += " ORDER BY detected_at DESC LIMIT 200"
-    shops = conn.execute(sql, params).fetchall()
+    shops = get_storage().list_manage_shops(q=q, risk=risk, limit=200)
     stats = get_stats()
-    conn.close()
     return templates.TemplateResponse("manage.html", {
         "request": request, "shops": shops, "q": q, "risk": risk, "stats": stats,
     })
@@ -437,17 +327,14 @@ async def api_delete(request: Request):
     ids  = body.get("ids", [])
     if not ids:
         return JSONResponse({"error": "No IDs"}, status_code=400)
-    from collector.db import delete_shop_by_id
-    deleted = sum(1 for sid in ids if delete_shop_by_id(int(sid)))
+    store   = get_storage()
+    deleted = sum(1 for sid in ids if store.delete_shop(int(sid)))
     return JSONResponse({"ok": True, "deleted": deleted})
 
 @app.post("/api/delete/errors")
 def api_delete_errors():
-    conn = get_db()
-    conn.execute("DELETE FROM shops WHERE status='error'")
-    conn.commit()
-    conn.close()
-    return JSONResponse({"ok": True})
+    deleted = get_storage().delete_error_shops()
+    return JSONResponse({"ok": True, "deleted": deleted})
 
 # ─────────────────────────────────────────────────────────────────────────────
 #  EXPORT
@@ -469,14 +356,13 @@ def export_page(request: Request):
 def api_export_fmt(fmt: str):
     if fmt not in ("json","csv","html","all"):
         return JSONResponse({"error": "Invalid format"}, status_code=400)
-    from collector.db import export_all_json
     from collector.exporter import export_json, export_csv, export_html_report
-    shops = export_all_json()
+    store = get_storage()
     stats = get_stats()
     paths = []
-    if fmt in ("json","all"): paths.append(export_json(shops))
-    if fmt in ("csv","all"):  paths.append(export_csv(shops))
-    if fmt in ("html","all"): paths.append(export_html_report(shops, stats))
+    if fmt in ("json","all"): paths.append(str(export_json(store.iter_export_shops())))
+    if fmt in ("csv","all"):  paths.append(str(export_csv(store.iter_export_shops())))
+    if fmt in ("html","all"): paths.append(str(export_html_report(store.iter_export_shops(), stats)))
     return JSONResponse({"ok": True, "files": paths})
 
 @app.get("/api/export/download/{filename}")
@@ -493,29 +379,133 @@ def download_export(filename: str):
 @app.get("/api/stats")
 def api_stats(): return JSONResponse(get_stats())
 
+@app.post("/api/stats/rebuild")
+def api_stats_rebuild():
+    get_storage().rebuild_stats()
+    return JSONResponse({"ok": True, "stats": get_stats()})
+
+@app.get("/api/writer/status")
+def api_writer_status():
+    from collector.writer import writer_status
+    return JSONResponse(writer_status())
+
+@app.get("/api/scheduler/status")
+def api_scheduler_status():
+    from collector.scheduler import scheduler_status
+    return JSONResponse(scheduler_status())
+
+@app.get("/api/capture/status")
+def api_capture_status():
+    from collector.capture import capture_status
+    return JSONResponse(capture_status())
+
+@app.post("/api/screenshots/gc")
+def api_screenshots_gc():
+    """Borra del disco las capturas que no referencia ninguna fila."""
+    from collector.shotstore import gc_screenshots
+    return JSONResponse(gc_screenshots())
+
+@app.get("/api/queue/status")
+def api_queue_status(limit: int=20):
+    from collector.workqueue import queue_status
+    return JSONResponse(queue_status(limit))
+
+@app.post("/api/queue/enqueue")
+async def api_queue_enqueue(request: Request):
+    """Encola URLs para los procesos `python -m collector.worker`."""
+    from collector.workqueue import enqueue_scans
+    body   = await request.json()
+    urls, seen = [], set()
+    for line in str(body.get("urls", "")).strip().split("\n"):
+        u = line.strip()
+        if not u or u.startswith("#"): continue
+        if not u.startswith("http"): u = "http://" + u
+        if u not in seen:
+            urls.append(u); seen.add(u)
+    if not urls:
+        return JSONResponse({"error": "No valid URLs"}, status_code=400)
+    n = enqueue_scans(urls, threat_intel=bool(body.get("threat_intel", False)),
+                      priority=int(body.get("priority", 0)))
+    return JSONResponse({"ok": True, "queued": n, "skipped": len(urls) - n})
+
+@app.get("/api/storage/status")
+def api_storage_status():
+    return JSONResponse(get_storage().status())
+
+@app.get("/api/retention/status")
+def api_retention_status():
+    from collector.retention import retention_status
+    return JSONResponse(retention_status())
+
+@app.post("/api/retention/run")
+def api_retention_run():
+    from collector.retention import run_retention
+    return JSONResponse(run_retention())
+
+@app.get("/api/graph/status")
+def api_graph_status():
+    from collector.linkgraph import linkgraph_status
+    return JSONResponse(linkgraph_status())
+
+@app.post("/api/graph/refresh")
+def api_graph_refresh(full: bool=False):
+    from collector.linkgraph import refresh_graph
+    return JSONResponse(refresh_graph(full=full))
+
+@app.get("/api/graph/subgraph")
+def api_graph_subgraph(host: str="", depth: int=1, limit: int=200):
+    """Vecindario de un host (o los de mayor PageRank) en formato nodes/edges."""
+    from collector.linkgraph import get_graph
+    return JSONResponse(get_graph().subgraph(host, depth=min(max(depth, 1), 4),
+                                             limit=min(max(limit, 1), 2000)))
+
+@app.get("/api/graph/top")
+def api_graph_top(by: str="pagerank", limit: int=20):
+    from collector.linkgraph import get_graph
+    try:
+        return JSONResponse(get_graph().top(min(max(limit, 1), 500), by=by))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
 @app.get("/api/export")
 def api_export_json():
-    from collector.db import export_all_json
-    shops = export_all_json()
-    return JSONResponse({"count": len(shops), "sites": shops})
+    store = get_storage()
+
+    def generator():
+        # Streaming: un sitio por chunk, "count" al final
+        count = 0
+        yield '{"sites": ['
+        for s in store.iter_export_shops():
+            yield ("," if count else "") + json.dumps(s, default=str)
+            count += 1
+        yield f'], "count": {count}}}'
+    return StreamingResponse(generator(), media_type="application/json")
+
+@app.get("/api/search")
+def api_search(q: str="", limit: int=50, risk: str=""):
+    rows = get_storage().search_shops(q, limit=min(max(limit, 1), 500), risk_level=risk)
+    return JSONResponse({"q": q, "count": len(rows), "results": rows})
 
 @app.get("/api/wallets")
 def api_wallets(coin: str=""):
-    conn = get_db()
-    sql = "SELECT coin,address,addr_type,shop_id FROM wallets WHERE 1=1"
-    params = []
-    if coin: sql += " AND coin=?"; params.append(coin.upper())
-    rows = [dict(r) for r in conn.execute(sql, params).fetchall()]
-    conn.close()
+    return JSONResponse(get_storage().list_wallet_rows(coin))
+
+@app.get("/api/wallets/shared")
+def api_wallets_shared(limit: int=100, min_shared: int=1):
+    return JSONResponse(get_storage().list_wallet_clusters(limit=min(limit, 1000),
+                                                          min_shared=min_shared))
+
+@app.get("/api/wallets/address/{address}")
+def api_wallet_address(address: str):
+    rows = get_storage().get_wallet_shops(address)
+    if not rows:
+        return JSONResponse({"error": "address not found"}, status_code=404)
     return JSONResponse(rows)
 
+@app.get("/api/shop/{shop_id}/related")
+def api_shop_related(shop_id: int):
+    return JSONResponse(get_storage().get_related_shops(shop_id))
+
 @app.get("/api/threats/top")
 def api_threats():
-    conn = get_db()
-    rows = [dict(r) for r in conn.execute("""
-        SELECT category,severity,keyword,SUM(count) AS total
-        FROM threat_keywords GROUP BY keyword
-        ORDER BY total DESC LIMIT 50
-    """).fetchall()]
-    conn.close()
-    return JSONResponse(rows)
+    return JSONResponse(get_storage().top_threats(50))
@@ -44,8 +44,8 @@ def main():
     # Inicializar DB
     sys.path.insert(0, str(ROOT))
     try:
-        from collector.db import init_db
-        init_db()
+        from collector.storage import get_storage
+        get_storage().init()
         print(f"  {GR}✓{R}  Base de datos lista")
     except Exception as e:
         print(f"  {RD}✗{R}  DB error: {e}")
@@ -66,7 +66,7 @@ def main():
     except Exception:
         pass
 
-    # Arrancar dashboard
+    # Arrancar dashboard (también lleva el hilo de retención: archivo + vacuum)
     if port_open(HOST, PORT):
         print(f"  {GY}→{R}  Dashboard ya corriendo en http://{HOST}:{PORT}")
     else:
@@ -109,7 +109,16 @@ def main():
         print(f"\n  {GY}Deteniendo...{R}")
         try:
             from collector.scheduler import stop_scheduler
+            from collector.engine import stop_engine
+            from collector.capture import stop_capture_service
             stop_scheduler()
+            stop_capture_service()
+            stop_engine()
+        except Exception:
+            pass
+        try:
+            from collector.storage import close_storage
+            close_storage()
         except Exception:
             pass
         print(f"  {GR}✓{R}  Hasta luego.\n")
@@ -0,0 +1,33 @@
+"""
+SCRACHER v3 — Fixtures comunes de los tests
+Cada test usa una scrs.db temporal; los writers y el pool de conexiones se
+cierran al terminar para que el siguiente test empiece limpio.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """collector.db apuntando a una DB temporal con el esquema al día (un fichero)."""
+    from collector import db
+    from collector.writer import stop_writer
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "scrs.db")
+    monkeypatch.setattr(db, "SQLITE_SPLIT_HOT", False)
+    db.init_db()
+    yield db
+    stop_writer()
+    db.close_all_connections()
+
+
+@pytest.fixture(params=["single", "split"])
+def sqlite_layouts(request, tmp_path, monkeypatch):
+    """Como sqlite_db, en los dos layouts: todo en scrs.db y SQLITE_SPLIT_HOT."""
+    from collector import db
+    from collector.writer import stop_writer
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "scrs.db")
+    monkeypatch.setattr(db, "SQLITE_SPLIT_HOT", request.param == "split")
+    db.init_db()
+    yield db
+    stop_writer()
+    db.close_all_connections()
@@ -0,0 +1,108 @@
+"""
+SCRACHER v3 — Tests del historial por deltas (scans + scan_changes)
+Cada scan guarda solo los cambios de tech/keywords/tags/wallets; reconstruir
+un scan pasado tiene que devolver exactamente lo que se persistió en él.
+"""
+
+
+def _tech(*items):
+    return [{"name": n, "category": "server", "version": v, "confidence": 1.0, "source": "header"}
+            for n, v in items]
+
+def _kw(*items):
+    return [{"keyword": k, "category": c, "severity": "medium", "count": n} for k, c, n in items]
+
+def _btc(*addrs):
+    return {"btc": [{"address": a, "type": "p2pkh"} for a in addrs]}
+
+# (tech, keywords, tags, wallets) de cada scan sucesivo del mismo sitio
+SCANS = [
+    (_tech(("nginx", "1.18")), _kw(("escrow", "market", 1)), ["market"], _btc("1A")),
+    # alta de tech, keyword y wallet; sin bajas
+    (_tech(("nginx", "1.18"), ("php", "8.1")), _kw(("escrow", "market", 1), ("cvv", "carding", 2)),
+     ["market"], _btc("1A", "1B")),
+    # modificaciones (versión, count) y bajas (tag, wallet)
+    (_tech(("nginx", "1.24"), ("php", "8.1")), _kw(("escrow", "market", 3), ("cvv", "carding", 2)),
+     [], _btc("1B")),
+    # sin cambios
+    (_tech(("nginx", "1.24"), ("php", "8.1")), _kw(("escrow", "market", 3), ("cvv", "carding", 2)),
+     [], _btc("1B")),
+    # todo nuevo: lo anterior se va entero
+    (_tech(("apache", "2.4")), _kw(("fullz", "carding", 1)), ["carding", "fraud"], _btc("1A", "1C")),
+    # vacío
+    ([], [], [], {}),
+]
+
+
+def _result(i, tech, keywords, tags, wallets):
+    return {
+        "url": "http://hist.onion", "domain": "hist.onion", "title": f"scan {i}",
+        "content_hash": f"h{i}", "text": "", "tech": tech,
+        "threat": {"risk_level": "high", "risk_score": 5.0, "tags": tags, "keywords": keywords},
+        "wallets": wallets, "screenshot": {}, "ocr": {"text": ""}, "onion_links": [],
+    }
+
+def _expected(tech, keywords, tags, wallets) -> dict:
+    return {
+        "tech":     {(t["name"], t["category"], t["version"], t["confidence"], t["source"])
+                     for t in tech},
+        "keywords": {(k["keyword"], k["category"], k["severity"], k["count"]) for k in keywords},
+        "tags":     set(tags),
+        "wallets":  {(coin, w["address"], w["type"]) for coin, ws in wallets.items() for w in ws},
+    }
+
+def _state(st: dict) -> dict:
+    return {
+        "tech":     {(t["name"], t["category"], t["version"], t["confidence"], t["source"])
+                     for t in st["tech"]},
+        "keywords": {(k["keyword"], k["category"], k["severity"], k["count"])
+                     for k in st["keywords"]},
+        "tags":     set(st["tags"]),
+        "wallets":  {(w["coin"], w["address"], w["addr_type"]) for w in st["wallets"]},
+    }
+
+def _live(db, sid) -> dict:
+    """Estado actual de las tablas hijas (lo que muestra el detalle del sitio)."""
+    return _state(db.get_shop_detail(sid))
+
+
+def test_each_past_scan_reconstructs_exactly(sqlite_db):
+    db = sqlite_db
+    sid, expected = None, []
+    for i, parts in enumerate(SCANS):
+        sid, _ = db.persist_scan_result(_result(i, *parts))
+        expected.append(_expected(*parts))
+
+    history = list(reversed(db.get_scan_history(sid)))
+    assert len(history) == len(SCANS)
+    for scan, want in zip(history, expected):
+        assert _state(db.get_state_at_scan(sid, scan["id"])) == want, scan["title"]
+
+    # el scan sin cambios no registra nada; el último deja las tablas vacías
+    assert history[3]["changes"] == 0
+    assert _live(db, sid) == expected[-1]
+
+
+def test_duplicate_child_rows_are_collapsed(sqlite_db):
+    db = sqlite_db
+    sid, _ = db.persist_scan_result(_result(0, *SCANS[0]))
+    conn = db.connect()
+    # una base anterior a los deltas podía tener la misma clave repetida
+    conn.execute("INSERT INTO tech(shop_id,name,category,version,confidence,source) "
+                 "VALUES (?,'nginx','server','1.0',1.0,'header')", (sid,))
+    conn.execute("INSERT INTO tags(shop_id,tag) VALUES (?,'market')", (sid,))
+    conn.commit(); conn.close()
+
+    db.persist_scan_result(_result(1, *SCANS[1]))
+    history = list(reversed(db.get_scan_history(sid)))
+    assert _state(db.get_state_at_scan(sid, history[-1]["id"])) == _expected(*SCANS[1])
+    assert _live(db, sid) == _expected(*SCANS[1])
+    conn = db.connect()
+    n_tech = conn.execute("SELECT COUNT(*) FROM tech WHERE shop_id=?", (sid,)).fetchone()[0]
+    n_tags = conn.execute("SELECT COUNT(*) FROM tags WHERE shop_id=?", (sid,)).fetchone()[0]
+    conn.close()
+    assert (n_tech, n_tags) == (2, 1)
+
+
+def test_unknown_scan_returns_none(sqlite_db):
+    assert sqlite_db.get_state_at_scan(1, 999) is None
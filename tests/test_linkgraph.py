@@ -0,0 +1,60 @@
+"""
+SCRACHER v3 — Tests del grafo de links (collector.linkgraph)
+Lo que importa fuera del grafo es discovered_hosts.link_rank: tras un
+reinicio del proceso y una reconstrucción completa no puede quedar ningún
+valor viejo subiendo la prioridad de la frontera.
+"""
+
+from collector import linkgraph
+
+
+def _scan(url, links):
+    return {"url": url, "domain": url.split("://", 1)[1], "title": url,
+            "content_hash": url, "tech": [], "text": "",
+            "threat": {"risk_level": "medium", "risk_score": 1.0, "tags": [], "keywords": []},
+            "wallets": {}, "screenshot": {}, "ocr": {"text": ""}, "onion_links": links}
+
+def _ranks(db) -> dict:
+    conn = db.connect()
+    rows = conn.execute("SELECT host, link_rank FROM discovered_hosts").fetchall()
+    conn.close()
+    return {r["host"]: r["link_rank"] for r in rows}
+
+def _restart(monkeypatch):
+    """Proceso nuevo: ni grafo ni memoria de lo ya escrito."""
+    monkeypatch.setattr(linkgraph, "_graph", None)
+
+
+def test_full_rebuild_after_restart_resets_stale_ranks(sqlite_db, monkeypatch):
+    from collector.storage import SQLiteStorage
+    db, store = sqlite_db, SQLiteStorage()
+    _restart(monkeypatch)
+    db.persist_scan_result(_scan("http://a.onion", ["http://b.onion/"]))
+    db.persist_scan_result(_scan("http://b.onion", ["http://c.onion/"]))
+    db.persist_scan_result(_scan("http://c.onion", ["http://a.onion/"]))
+    db.persist_scan_result(_scan("http://x.onion", ["http://y.onion/", "http://z.onion/"]))
+
+    linkgraph.refresh_graph(full=True, store=store)
+    before = _ranks(db)
+    assert before["y.onion"] > 0 and before["a.onion"] > 0
+
+    # y.onion sale del grafo (sus pares ya no están) y z.onion tiene un valor
+    # viejo por debajo de GRAPH_RANK_DELTA que ningún proceso recuerda
+    conn = db.connect_table("link_sources")
+    conn.execute("DELETE FROM link_sources WHERE domain IN ('y.onion', 'z.onion')")
+    conn.commit(); conn.close()
+    conn = db.connect_table("discovered_hosts")
+    conn.execute("UPDATE discovered_hosts SET link_rank=? WHERE host='z.onion'",
+                 (linkgraph.GRAPH_RANK_DELTA / 2,))
+    conn.commit(); conn.close()
+
+    _restart(monkeypatch)
+    report = linkgraph.refresh_graph(full=True, store=store)
+    after = _ranks(db)
+    assert after["y.onion"] == 0 and after["z.onion"] == 0
+    assert after["a.onion"] == before["a.onion"]
+    assert report["ranks_written"] >= 2
+    assert "y.onion" not in linkgraph.get_graph()._pushed
+
+    # nada más que escribir en la siguiente pasada incremental
+    assert linkgraph.refresh_graph(store=store)["ranks_written"] == 0
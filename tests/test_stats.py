@@ -0,0 +1,127 @@
+"""
+SCRACHER v3 — Tests de las estadísticas materializadas
+Los triggers de stat_counters / stat_groups / stat_wallet_refs (y
+wallet_clusters) tienen que dar lo mismo que rebuild_stats() después de
+altas, re-escaneos con deltas y bajas, con todo en scrs.db y con
+SQLITE_SPLIT_HOT.
+"""
+
+
+def _scan(url, risk="high", keywords=(), tags=(), wallets=None, links=()):
+    return {
+        "url": url, "domain": url.split("://", 1)[1], "title": url,
+        "content_hash": f"{url}:{risk}:{len(keywords)}:{len(links)}",
+        "tech": [], "text": "",
+        "threat": {"risk_level": risk, "risk_score": 5.0, "tags": list(tags),
+                   "keywords": [{"keyword": k, "category": c, "severity": "medium", "count": 1}
+                                for k, c in keywords]},
+        "wallets": wallets or {}, "screenshot": {}, "ocr": {"text": ""},
+        "onion_links": list(links),
+    }
+
+def _btc(*addrs):
+    return {"btc": [{"address": a, "type": "p2pkh"} for a in addrs]}
+
+
+def _snapshot(db) -> dict:
+    """Todas las tablas stat_* (sumadas entre ficheros), sin filas a cero."""
+    conn = db.connect()
+    try:
+        parts = " UNION ALL ".join(f"SELECT name, value FROM {a}.stat_counters"
+                                   for a in ["main"] + db._attached(conn))
+        return {
+            "counters": {r["name"]: r["value"] for r in conn.execute(
+                f"SELECT name, SUM(value) AS value FROM ({parts}) GROUP BY name "
+                f"HAVING SUM(value) != 0").fetchall()},
+            "groups": {(r["kind"], r["key"]): r["c"] for r in conn.execute(
+                "SELECT kind, key, c FROM stat_groups WHERE c != 0").fetchall()},
+            "wallet_refs": {(r["coin"], r["address"]): r["refs"] for r in conn.execute(
+                "SELECT coin, address, refs FROM stat_wallet_refs WHERE refs != 0").fetchall()},
+            "clusters": {(r["shop_a"], r["shop_b"]): r["shared"] for r in conn.execute(
+                "SELECT shop_a, shop_b, shared FROM wallet_clusters WHERE shared != 0").fetchall()},
+        }
+    finally:
+        conn.close()
+
+def _assert_matches_rebuild(db):
+    live = _snapshot(db)
+    db.rebuild_stats()
+    assert live == _snapshot(db)
+    return live
+
+
+def test_trigger_stats_match_rebuild(sqlite_layouts):
+    db = sqlite_layouts
+
+    a, _ = db.persist_scan_result(_scan(
+        "http://a.onion", "high", [("escrow", "market"), ("cvv", "carding")], ["market"],
+        _btc("1AAA", "1SHARED"), ["http://x.onion/", "http://y.onion/"]))
+    b, _ = db.persist_scan_result(_scan(
+        "http://b.onion", "medium", [("escrow", "market")], ["market"],
+        _btc("1SHARED"), ["http://x.onion/"]))
+    c = db.upsert_shop("http://c.onion", "c.onion", None, "error")
+    db.log_alert(a, "slack", "high", True, "new")
+    db.log_alert(b, "slack", "medium", False, "muted")
+
+    live = _assert_matches_rebuild(db)
+    assert live["counters"]["shops"] == 3
+    assert live["counters"]["links"] == 2
+    assert live["counters"]["alerts:sent"] == 1
+    assert live["clusters"] == {(a, b): 1}
+
+    # re-escaneos: cambia el riesgo, entra y sale un keyword y una wallet
+    db.persist_scan_result(_scan(
+        "http://a.onion", "critical", [("cvv", "carding"), ("fullz", "carding")], ["carding"],
+        _btc("1AAA", "1NEW"), ["http://z.onion/"]))
+    db.persist_scan_result(_scan(
+        "http://b.onion", "medium", [("escrow", "market")], ["market"],
+        _btc("1SHARED", "1NEW")))
+    pending = db.get_pending_discovered(10)
+    db.mark_discovered_scanned(pending[0]["id"])
+
+    live = _assert_matches_rebuild(db)
+    assert live["counters"]["risk:critical"] == 1
+    assert live["counters"]["links"] == 3
+    assert live["counters"]["links:pending"] == 2
+    assert live["groups"][("threat_category", "carding")] == 2
+    assert live["clusters"] == {(a, b): 1}
+
+    # bajas
+    assert db.delete_error_shops() == 1
+    db.delete_shop_by_id(a)
+
+    live = _assert_matches_rebuild(db)
+    assert live["counters"]["shops"] == 1
+    assert "status:error" not in live["counters"]
+    assert live["clusters"] == {}
+    assert live["wallet_refs"] == {("btc", "1SHARED"): 1, ("btc", "1NEW"): 1}
+    assert db.get_stats()["total"] == 1
+    assert c not in [r["id"] for r in db.list_shops(10)]
+
+
+def test_archived_rows_keep_dashboard_totals(sqlite_layouts, tmp_path, monkeypatch):
+    from collector import retention
+    db = sqlite_layouts
+    monkeypatch.setattr(retention, "ARCHIVE_DIR", tmp_path / "archive")
+    sid, _ = db.persist_scan_result(_scan("http://a.onion", links=["http://x.onion/",
+                                                                    "http://y.onion/"]))
+    db.log_alert(sid, "slack", "high", True, "new")
+    db.log_alert(sid, "slack", "high", False, "muted")
+    for link in db.get_pending_discovered(10):
+        db.mark_discovered_scanned(link["id"])
+    before = db.get_stats()
+
+    # todo queda fuera de plazo: fechas en el pasado
+    old = "2000-01-01T00:00:00+00:00"
+    for table, sql in (("alert_log", "UPDATE alert_log SET sent_at=?"),
+                       ("discovered_links", "UPDATE discovered_links SET last_seen=?")):
+        conn = db.connect_table(table)
+        conn.execute(sql, (old,)); conn.commit(); conn.close()
+    assert retention.archive_table("alert_log", 1) == 2
+    assert retention.archive_table("discovered_links", 1) == 2
+
+    after = db.get_stats()
+    assert (after["alerts_sent"], after["total_links"]) == (before["alerts_sent"],
+                                                            before["total_links"]) == (1, 2)
+    db.rebuild_stats()
+    assert db.get_stats()["total_links"] == 2
@@ -0,0 +1,174 @@
+"""
+SCRACHER v3 — Tests de la cola de trabajo con leases
+LocalBroker con reloj inyectado (sin esperas reales), el Worker sobre él y
+la tabla work_queue de SQLite para el caso del lease perdido.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from collector.workqueue import DBBroker, LocalBroker, job
+from collector.worker import Worker
+
+
+class Clock:
+    def __init__(self):
+        self.now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+@pytest.fixture
+def broker(clock):
+    return LocalBroker(clock=clock)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  LocalBroker
+# ─────────────────────────────────────────────────────────────────────────────
+
+def test_expired_lease_is_redelivered(broker, clock):
+    broker.enqueue([job("scan", "http://a.onion")])
+    first = broker.claim("w1", 10, lease_s=60)
+    assert [j["attempts"] for j in first] == [1]
+    assert broker.claim("w2", 10, lease_s=60) == []
+
+    clock.advance(59)
+    assert broker.claim("w2", 10, lease_s=60) == []
+    clock.advance(2)                                  # pasado el visibility timeout
+    again = broker.claim("w2", 10, lease_s=60)
+    assert [(j["id"], j["attempts"]) for j in again] == [(first[0]["id"], 2)]
+    assert broker.workers()[0]["worker"] == "w2"
+
+
+def test_heartbeat_extends_the_lease(broker, clock):
+    broker.enqueue([job("scan", "http://a.onion")])
+    jid = broker.claim("w1", 1, lease_s=60)[0]["id"]
+    for _ in range(5):                                # 5 × 50 s > 60 s de lease
+        clock.advance(50)
+        assert broker.heartbeat("w1", [jid], lease_s=60) == [jid]
+        assert broker.claim("w2", 1, lease_s=60) == []
+    assert broker.heartbeat("w2", [jid], lease_s=60) == []
+
+    clock.advance(61)                                 # sin heartbeat: se pierde
+    assert broker.claim("w2", 1, lease_s=60)[0]["id"] == jid
+    assert broker.heartbeat("w1", [jid], lease_s=60) == []
+
+
+def test_fail_backs_off_until_max_attempts(broker, clock):
+    broker.enqueue([job("scan", "http://a.onion", max_attempts=3)])
+    for attempt, wait in ((1, 10), (2, 20)):
+        j = broker.claim("w1", 1, lease_s=60)[0]
+        assert j["attempts"] == attempt
+        assert broker.fail("w1", j["id"], "boom", retry_s=10) == "queued"
+        clock.advance(wait - 1)                       # backoff retry_s·2^(intentos-1)
+        assert broker.claim("w1", 1, lease_s=60) == []
+        clock.advance(1)
+    j = broker.claim("w1", 1, lease_s=60)[0]
+    assert j["attempts"] == 3
+    assert broker.fail("w1", j["id"], "boom", retry_s=10) == "failed"
+    clock.advance(3600)
+    assert broker.claim("w1", 1, lease_s=60) == []
+    assert broker.counts()["failed"] == 1
+    assert broker.list_jobs("failed")[0]["last_error"] == "boom"
+
+
+def test_stale_owner_cannot_close_the_job(broker, clock):
+    broker.enqueue([job("scan", "http://a.onion")])
+    jid = broker.claim("w1", 1, lease_s=60)[0]["id"]
+    clock.advance(61)
+    assert broker.claim("w2", 1, lease_s=60)[0]["id"] == jid
+
+    assert broker.complete("w1", jid, {"late": True}) is False
+    assert broker.fail("w1", jid, "late", retry_s=10) is None
+    assert broker.list_jobs("leased")[0]["lease_owner"] == "w2"
+    assert broker.complete("w2", jid, {"ok": True}) is True
+    assert broker.counts()["done"] == 1
+
+
+def test_duplicate_targets_are_not_enqueued_twice(broker):
+    assert broker.enqueue([job("scan", "http://a.onion"), job("scan", "http://a.onion"),
+                           job("rescan", "7")]) == 2
+    assert broker.enqueue([job("scan", "http://a.onion")]) == 0
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  Worker sobre LocalBroker
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _worker(broker, handlers, **kw):
+    return Worker(broker=broker, worker_id="w1", concurrency=2, lease_s=60,
+                  heartbeat_s=3600, retry_s=10, handlers=handlers,
+                  executor=ThreadPoolExecutor(max_workers=2), **kw)
+
+
+def test_worker_runs_retries_and_fails_jobs(broker, clock):
+    calls = []
+
+    def scan(j):
+        calls.append((j["target"], j["attempts"]))
+        if j["target"] == "http://bad.onion":
+            raise RuntimeError("tor timeout")
+        return {"ok": j["target"]}
+
+    broker.enqueue([job("scan", "http://ok.onion"), job("scan", "http://bad.onion", max_attempts=2),
+                    job("nope", "x", max_attempts=1)])
+    w = _worker(broker, {"scan": scan})
+    w.run(once=True)
+    st = w.status()
+    assert (st["done"], st["retried"], st["failed"]) == (1, 1, 1)
+
+    clock.advance(10)                                 # backoff del primer fallo
+    w.run(once=True)
+    st = w.status()
+    assert (st["done"], st["retried"], st["failed"]) == (1, 1, 2)
+    assert calls.count(("http://bad.onion", 2)) == 1
+    assert broker.counts() == {"queued": 0, "ready": 0, "leased": 0, "done": 1, "failed": 2}
+
+
+def test_worker_result_is_rejected_after_losing_the_lease(broker, clock):
+    def slow(j):
+        clock.advance(120)                            # parado más que el lease
+        assert broker.claim("w2", 1, lease_s=60)[0]["id"] == j["id"]
+        return {"late": True}
+
+    broker.enqueue([job("scan", "http://a.onion")])
+    w = _worker(broker, {"scan": slow})
+    w.run(once=True)
+    assert w.status()["rejected"] == 1
+    assert broker.list_jobs("leased")[0]["lease_owner"] == "w2"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  work_queue en SQLite: el fallo de un worker sin lease no pisa al nuevo
+# ─────────────────────────────────────────────────────────────────────────────
+
+def test_db_stale_owner_cannot_fail_or_complete(sqlite_db):
+    from collector.storage import SQLiteStorage
+    db = sqlite_db
+    b  = DBBroker(SQLiteStorage())
+    b.enqueue([job("scan", "http://a.onion")])
+    jid = b.claim("w1", 1, lease_s=60)[0]["id"]
+
+    conn = db.connect_file()                          # el lease de w1 vence
+    conn.execute("UPDATE work_queue SET lease_until='2000-01-01T00:00:00+00:00' WHERE id=?",
+                 (jid,))
+    conn.commit(); conn.close()
+    assert b.claim("w2", 1, lease_s=60)[0]["id"] == jid
+
+    assert b.fail("w1", jid, "late", retry_s=10) is None
+    assert b.complete("w1", jid, {"late": True}) is False
+    row = b.list_jobs("leased")[0]
+    assert (row["lease_owner"], row["attempts"], row["last_error"]) == ("w2", 2, None)
+    assert b.heartbeat("w2", [jid], lease_s=60) == [jid]
+    assert b.fail("w2", jid, "boom", retry_s=10) == "queued"
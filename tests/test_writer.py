@@ -0,0 +1,50 @@
+"""
+SCRACHER v3 — Tests del writer por lotes (collector.writer)
+"""
+
+import sqlite3
+
+import pytest
+
+from collector import writer
+
+
+def _insert_alert(conn, reason):
+    return conn.execute(
+        "INSERT INTO alert_log(shop_id, channel, risk_level, sent, reason, sent_at) "
+        "VALUES (NULL, 'test', 'low', 0, ?, '2026-01-01T00:00:00+00:00')", (reason,)).lastrowid
+
+
+def test_failed_job_does_not_sink_the_batch(sqlite_db):
+    w = writer.DBWriter("main", flush_ms=50)
+    try:
+        bad = w.submit(lambda conn: conn.execute("INSERT INTO no_such_table VALUES (1)"))
+        ok  = w.submit(_insert_alert, "ok")
+        with pytest.raises(sqlite3.OperationalError):
+            bad.result(timeout=5)
+        assert ok.result(timeout=5) > 0
+    finally:
+        w.stop()
+
+
+def test_connect_error_fails_the_batch_and_keeps_the_writer(sqlite_db, monkeypatch):
+    real = writer.connect_file
+    calls = {"n": 0}
+
+    def flaky(alias):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise sqlite3.OperationalError("unable to open database file")
+        return real(alias)
+
+    monkeypatch.setattr(writer, "connect_file", flaky)
+    w = writer.DBWriter("main")
+    try:
+        first = w.submit(_insert_alert, "lost")
+        with pytest.raises(sqlite3.OperationalError):
+            first.result(timeout=5)
+        assert w.running
+        assert w.submit(_insert_alert, "after").result(timeout=5) > 0
+        assert w.metrics()["errors"] == 1
+    finally:
+        w.stop()